@@ -0,0 +1,53 @@
+import asyncio
+import inspect
+import logging
+from celery import Task
+
+logger = logging.getLogger(__name__)
+
+# Event loop процесса воркера: на нем живут пул asyncpg, HTTP клиенты и все асинхронные задачи
+_loop: asyncio.AbstractEventLoop | None = None
+
+
+def get_worker_loop() -> asyncio.AbstractEventLoop:
+    """Возвращает долгоживущий event loop текущего процесса (создается один раз)."""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+        logger.debug("Created worker event loop.")
+    return _loop
+
+
+def run_async(coro):
+    """Выполняет корутину на event loop процесса и возвращает ее результат."""
+    return get_worker_loop().run_until_complete(coro)
+
+
+def close_worker_loop():
+    """Завершает фоновые задачи и закрывает event loop процесса."""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        return
+    try:
+        pending = [task for task in asyncio.all_tasks(_loop) if not task.done()]
+        for task in pending:
+            task.cancel()
+        if pending:
+            _loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+        _loop.run_until_complete(_loop.shutdown_asyncgens())
+    finally:
+        _loop.close()
+        _loop = None
+
+
+class AsyncTask(Task):
+    """Базовый класс задач Celery: задачи, объявленные как async def, выполняются
+    на одном event loop процесса, общем с пулом БД и HTTP клиентами.
+    """
+
+    def __call__(self, *args, **kwargs):
+        result = super().__call__(*args, **kwargs)
+        if inspect.isawaitable(result):
+            return run_async(result)
+        return result
@@ -0,0 +1,70 @@
+"""Формат сообщений задач Celery (протокол 2) в Redis брокере.
+
+Используется там, где сообщения читаются или пишутся напрямую через redis.asyncio, минуя синхронный
+продюсер Celery: app.order_worker (чтение) и app.main (пакетная запись заказов из вебхуков).
+"""
+import base64
+import json
+import os
+import socket
+import uuid
+from datetime import datetime
+
+from app.tracing import inject_context
+
+_ORIGIN = f"{os.getpid()}@{socket.gethostname()}"
+
+
+def encode_task_message(task_name: str, args: list | tuple = (), kwargs: dict | None = None, queue: str = "celery",
+                        retries: int = 0, eta: datetime | None = None) -> bytes:
+    """Собирает сообщение задачи в формате kombu/Celery для LPUSH в список очереди queue.
+    retries и eta - номер повтора и время, раньше которого задачу не выполнять (как у self.retry в Celery).
+    """
+    task_id = str(uuid.uuid4())
+    kwargs = kwargs or {}
+    body = json.dumps([list(args), kwargs, {"callbacks": None, "errbacks": None, "chain": None, "chord": None}])
+    headers = {
+        "lang": "py",
+        "task": task_name,
+        "id": task_id,
+        "shadow": None,
+        "eta": eta.isoformat() if eta else None,
+        "expires": None,
+        "group": None,
+        "group_index": None,
+        "retries": retries,
+        "timelimit": [None, None],
+        "root_id": task_id,
+        "parent_id": None,
+        "argsrepr": repr(tuple(args))[:256],
+        "kwargsrepr": repr(kwargs)[:256],
+        "origin": _ORIGIN,
+        "ignore_result": False,
+    }
+    inject_context(headers) # traceparent для продолжения трейса в воркере
+    message = {
+        "body": base64.b64encode(body.encode()).decode(),
+        "content-encoding": "utf-8",
+        "content-type": "application/json",
+        "headers": headers,
+        "properties": {
+            "correlation_id": task_id,
+            "delivery_mode": 2,
+            "delivery_info": {"exchange": "", "routing_key": queue},
+            "priority": 0,
+            "body_encoding": "base64",
+            "delivery_tag": str(uuid.uuid4()),
+        },
+    }
+    return json.dumps(message).encode()
+
+
+def decode_task_message(raw: bytes) -> tuple[str | None, list, dict, dict]:
+    """Разбирает сообщение задачи из очереди: (имя задачи, args, kwargs, headers). Ошибки формата пробрасываются."""
+    message = json.loads(raw)
+    headers = message.get("headers", {})
+    body = message["body"]
+    if message.get("properties", {}).get("body_encoding") == "base64":
+        body = base64.b64decode(body)
+    args, kwargs, _ = json.loads(body)
+    return headers.get("task"), args, kwargs, headers
@@ -1,13 +1,92 @@
+import asyncio
 import asyncpg
 import os
 import logging
 import json # Добавляем импорт json
+import hashlib
+import time
+from contextlib import asynccontextmanager
+from datetime import datetime
+from pathlib import Path
+
+from app.metrics import (
+    DB_ACQUIRE_WAIT, DB_POOL_IN_USE, DB_QUERY_DURATION,
+    ORDERS_FAILED, ORDERS_DEAD_LETTERED, PENDING_DEPTH, PENDING_OLDEST_AGE,
+)
 
 logger = logging.getLogger(__name__)
 
 DATABASE_URL = os.getenv("DATABASE_URL")
 DB_POOL = None # Глобальная переменная для пула
 
+# --- Настройки пула (из переменных окружения) ---
+# Суммарно DB_POOL_MAX_SIZE * (процессов воркеров на реплику) * (реплик) должно укладываться в max_connections Postgres
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "1"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_MAX_INACTIVE_CONNECTION_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_CONNECTION_LIFETIME", "300")) # Сек. до закрытия простаивающего соединения
+# Кэш подготовленных выражений asyncpg на соединение: частые запросы (с постоянным текстом) подготавливаются один раз
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30")) # Сек. на один запрос
+DB_SLOW_QUERY_SECONDS = float(os.getenv("DB_SLOW_QUERY_SECONDS", "1.0")) # Порог логирования медленных запросов
+
+
+class PoolStats:
+    """Метрики пула процесса: ожидание соединения, занятые соединения, время запросов по тексту запроса."""
+
+    def __init__(self):
+        self.in_use = 0
+        self.acquire_count = 0
+        self.acquire_wait_total = 0.0
+        self.acquire_wait_max = 0.0
+        self.queries: dict[str, list] = {} # имя запроса -> [количество, суммарное время, максимум]
+
+    def record_acquire(self, wait: float):
+        self.acquire_count += 1
+        self.acquire_wait_total += wait
+        self.acquire_wait_max = max(self.acquire_wait_max, wait)
+        DB_ACQUIRE_WAIT.observe(wait)
+
+    def record_query(self, query, elapsed: float):
+        name = query_name(query)
+        stats = self.queries.setdefault(name, [0, 0.0, 0.0])
+        stats[0] += 1
+        stats[1] += elapsed
+        stats[2] = max(stats[2], elapsed)
+        DB_QUERY_DURATION.labels(name).observe(elapsed)
+        if elapsed >= DB_SLOW_QUERY_SECONDS:
+            logger.warning(f"Slow query ({elapsed:.3f}s): {name}")
+
+    def snapshot(self) -> dict:
+        return {
+            "pool_size": DB_POOL.get_size() if DB_POOL else 0,
+            "pool_idle": DB_POOL.get_idle_size() if DB_POOL else 0,
+            "in_use": self.in_use,
+            "acquire_count": self.acquire_count,
+            "acquire_wait_avg": self.acquire_wait_total / self.acquire_count if self.acquire_count else 0.0,
+            "acquire_wait_max": self.acquire_wait_max,
+            "queries": {
+                name: {"count": count, "avg": total / count, "max": max_elapsed}
+                for name, (count, total, max_elapsed) in self.queries.items()
+            },
+        }
+
+POOL_STATS = PoolStats()
+
+def query_name(query) -> str:
+    """Короткое имя запроса для метрик: первые слова текста без лишних пробелов."""
+    return " ".join(str(query).split())[:80]
+
+def get_pool_stats() -> dict:
+    """Возвращает текущие метрики пула процесса."""
+    return POOL_STATS.snapshot()
+
+def _on_query(record):
+    POOL_STATS.record_query(record.query, record.elapsed)
+
+async def _init_connection(conn):
+    """Настройка каждого нового соединения пула: замер времени всех запросов."""
+    conn.add_query_logger(_on_query)
+
 async def init_db_pool():
     """Инициализирует пул соединений asyncpg."""
     global DB_POOL
@@ -17,10 +96,14 @@ async def init_db_pool():
     try:
         DB_POOL = await asyncpg.create_pool(
             dsn=DATABASE_URL,
-            min_size=1, # Минимальное количество соединений
-            max_size=10 # Максимальное количество соединений
+            min_size=DB_POOL_MIN_SIZE, # Минимальное количество соединений
+            max_size=DB_POOL_MAX_SIZE, # Максимальное количество соединений
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_CONNECTION_LIFETIME,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            init=_init_connection,
         )
-        logger.info("Database connection pool initialized.")
+        logger.info(f"Database connection pool initialized (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE}).")
     except Exception as e:
         logger.exception("Failed to initialize database connection pool")
         DB_POOL = None
@@ -29,10 +112,25 @@ async def close_db_pool():
     """Закрывает пул соединений asyncpg."""
     global DB_POOL
     if DB_POOL:
+        logger.info(f"Database pool stats: {json.dumps(get_pool_stats(), ensure_ascii=False)}")
         await DB_POOL.close()
         logger.info("Database connection pool closed.")
         DB_POOL = None
 
+@asynccontextmanager
+async def _acquire():
+    """Берет соединение из пула, замеряя время ожидания и число занятых соединений."""
+    start = time.perf_counter()
+    async with DB_POOL.acquire() as conn:
+        POOL_STATS.record_acquire(time.perf_counter() - start)
+        POOL_STATS.in_use += 1
+        DB_POOL_IN_USE.inc()
+        try:
+            yield conn
+        finally:
+            POOL_STATS.in_use -= 1
+            DB_POOL_IN_USE.dec()
+
 def get_connection():
     """Возвращает соединение из пула.
     Используется как async context manager: async with get_connection() as conn:
@@ -42,29 +140,522 @@ def get_connection():
         # В реальном приложении здесь лучше выбросить исключение или обработать иначе
         raise ConnectionError("Database pool not available")
     # Возвращаем контекстный менеджер соединения из пула
-    return DB_POOL.acquire()
+    return _acquire()
+
+# --- Миграции схемы ---
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+MIGRATIONS_LOCK_ID = 72_640_001 # Ключ pg_advisory_lock: миграции применяет только один процесс одновременно
+
+async def run_migrations():
+    """Применяет новые версионные миграции из app/migrations (NNN_name.sql) по порядку.
+    Примененные версии хранятся в schema_migrations; каждая миграция выполняется в своей транзакции.
+    """
+    async with get_connection() as conn:
+        await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_ID)
+        try:
+            await conn.execute("""
+                CREATE TABLE IF NOT EXISTS schema_migrations (
+                    version TEXT PRIMARY KEY,
+                    applied_at TIMESTAMP DEFAULT now()
+                )
+            """)
+            applied = {row["version"] for row in await conn.fetch("SELECT version FROM schema_migrations")}
+            for path in sorted(MIGRATIONS_DIR.glob("*.sql")):
+                version = path.stem
+                if version in applied:
+                    continue
+                async with conn.transaction():
+                    await conn.execute(path.read_text(encoding="utf-8"))
+                    await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1)", version)
+                logger.info(f"Applied migration {version}")
+        finally:
+            await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_ID)
+
+# Максимальное количество попыток повторной синхронизации
+MAX_RETRIES = int(os.getenv("MAX_RETRIES", "5"))
+
+# Экспоненциальная задержка повтора по классу ошибки: (базовая задержка, максимум) в секундах.
+# Задержка попытки n: min(максимум, база * 2^n) с джиттером 50-100%.
+RETRY_BACKOFF = {
+    "network": (30.0, 1800.0),   # Сетевые ошибки и таймауты
+    "5xx": (60.0, 3600.0),       # Ошибки сервера
+    "429": (10.0, 600.0),        # Превышение лимита запросов (учитывается и Retry-After)
+    "4xx": (900.0, 21600.0),     # Ошибки запроса - вряд ли пройдут без исправления данных
+    "other": (120.0, 3600.0),
+}
+
+def _next_attempt_sql(retry_count_expr: str, base: str, cap: str, min_delay: str, max_retries: str) -> str:
+    """SQL выражение для next_attempt_at. Аргументы - SQL выражения (параметры или колонки):
+    база, максимум, минимальная задержка (Retry-After), MAX_RETRIES (см. _backoff_args).
+    После исчерпания попыток next_attempt_at = NULL: запись выпадает из частичного индекса и ждет переноса в dead_letter_sync.
+    """
+    return f"""CASE WHEN {retry_count_expr} >= {max_retries} THEN NULL
+        ELSE now() + make_interval(secs => GREATEST({min_delay}, LEAST({cap}, {base} * power(2, {retry_count_expr})) * (0.5 + random() / 2)))
+        END"""
+
+def _backoff_args(error_class: str, retry_after: float | None) -> tuple[float, float, float, int]:
+    base, cap = RETRY_BACKOFF.get(error_class, RETRY_BACKOFF["other"])
+    return base, cap, float(retry_after or 0.0), MAX_RETRIES
+
+_SAVE_TO_PENDING_SQL = f"""
+    INSERT INTO pending_sync (order_id, order_payload, error_message, last_attempt, next_attempt_at)
+    VALUES ($1, $2, $3, now(), {_next_attempt_sql("0", "$4", "$5", "$6", "$7")})
+    ON CONFLICT (order_id) DO UPDATE SET
+        order_payload = EXCLUDED.order_payload,
+        error_message = EXCLUDED.error_message,
+        retry_count = pending_sync.retry_count + 1,
+        last_attempt = now(),
+        next_attempt_at = {_next_attempt_sql("pending_sync.retry_count + 1", "$4", "$5", "$6", "$7")}
+"""
+
+_SCHEDULE_RETRY_SQL = f"""
+    UPDATE pending_sync
+    SET retry_count = retry_count + 1,
+        last_attempt = now(),
+        error_message = $1,
+        next_attempt_at = {_next_attempt_sql("retry_count + 1", "$3", "$4", "$5", "$6")}
+    WHERE id = $2
+"""
+
+PENDING_FLUSH_SIZE = int(os.getenv("PENDING_FLUSH_SIZE", "500")) # Записей pending_sync за одну запись в БД
+PENDING_FLUSH_WINDOW = float(os.getenv("PENDING_FLUSH_WINDOW", "0.1")) # Сек. накопления записей
+
+class PendingWriter:
+    """Буферизует сохранение неуспешных заказов в pending_sync и пишет их пачкой одним executemany
+    в транзакции. Повторные ошибки одного заказа в пределах пачки объединяются (последняя ошибка побеждает).
+    """
+
+    def __init__(self, max_size: int = PENDING_FLUSH_SIZE, window: float = PENDING_FLUSH_WINDOW):
+        self.max_size = max_size
+        self.window = window
+        self._buffer: dict[int, tuple] = {} # order_id -> аргументы _SAVE_TO_PENDING_SQL
+        self._waiters: list[asyncio.Future] = []
+        self._timer: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+    async def add(self, order_id: int, payload: dict, error: str, error_class: str, retry_after: float | None):
+        """Добавляет заказ в буфер и ждет записи пачки в БД. Ошибки записи пробрасываются."""
+        future = asyncio.get_running_loop().create_future()
+        self._buffer[order_id] = (order_id, json.dumps(payload), error, *_backoff_args(error_class, retry_after))
+        self._waiters.append(future)
+        if len(self._buffer) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        await future
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        records, self._buffer = list(self._buffer.values()), {}
+        waiters, self._waiters = self._waiters, []
+        task = asyncio.create_task(self._write(records, waiters))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _write(self, records: list[tuple], waiters: list[asyncio.Future]):
+        try:
+            async with get_connection() as conn:
+                async with conn.transaction():
+                    await conn.executemany(_SAVE_TO_PENDING_SQL, records)
+            logger.info(f"Saved {len(records)} orders to pending_sync in one batch.")
+        except Exception as e:
+            for future in waiters:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future in waiters:
+            if not future.done():
+                future.set_result(None)
+
+    async def drain(self):
+        """Записывает накопленные записи и дожидается всех записей в полете."""
+        self._flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+_pending_writer: PendingWriter | None = None
+
+def get_pending_writer() -> PendingWriter:
+    """Возвращает буферизованный писатель pending_sync текущего процесса (создается лениво внутри event loop)."""
+    global _pending_writer
+    if _pending_writer is None:
+        _pending_writer = PendingWriter()
+    return _pending_writer
 
 # Сохранение в таблицу отложенной синхронизации
-async def save_to_pending(order_id: int, payload: dict, error: str = ""):
-    """Сохраняет заказ в таблицу pending_sync при ошибке."""
+async def save_to_pending(order_id: int, payload: dict, error: str = "", error_class: str = "other", retry_after: float | None = None):
+    """Сохраняет заказ в таблицу pending_sync при ошибке и планирует следующую попытку (next_attempt_at).
+    Запись идет через буфер PendingWriter вместе с другими неуспешными заказами процесса.
+    """
     if not DB_POOL:
         logger.error("Cannot save to pending: DB Pool is not initialized.")
         return
     try:
-        async with get_connection() as conn:
-            await conn.execute("""
-                INSERT INTO pending_sync (order_id, order_payload, error_message)
-                VALUES ($1, $2, $3)
-                ON CONFLICT (order_id) DO UPDATE SET
-                    order_payload = EXCLUDED.order_payload,
-                    error_message = EXCLUDED.error_message,
-                    retry_count = pending_sync.retry_count + 1,
-                    last_attempt = now();
-            """, order_id, json.dumps(payload), error)
+        await get_pending_writer().add(order_id, payload, error, error_class, retry_after)
+        ORDERS_FAILED.labels(error_class).inc()
         logger.info(f"Order {order_id} saved/updated in pending_sync due to error: {error}")
     except Exception as e:
         logger.exception(f"Failed to save order {order_id} to pending_sync: {e}")
 
+async def schedule_pending_retry(conn, pending_id: int, error: str, error_class: str = "other", retry_after: float | None = None):
+    """Увеличивает счетчик попыток записи pending_sync и планирует следующую попытку."""
+    await conn.execute(_SCHEDULE_RETRY_SQL, error, pending_id, *_backoff_args(error_class, retry_after))
+    ORDERS_FAILED.labels(error_class).inc()
+
+async def move_to_dead_letter(conn, pending_ids: list[int] | None = None, limit: int = 500) -> list[asyncpg.Record]:
+    """Атомарно переносит записи из pending_sync в dead_letter_sync одним запросом (DELETE ... RETURNING + INSERT).
+    Без pending_ids переносит до limit записей, исчерпавших MAX_RETRIES. Возвращает перенесенные записи.
+    """
+    if pending_ids is not None:
+        condition, args = "id = ANY($1::int[])", (pending_ids,)
+    else:
+        # Только по retry_count: запись не зависнет, если next_attempt_at задан, а MAX_RETRIES уменьшили
+        condition, args = "retry_count >= $1", (MAX_RETRIES,)
+    moved = await conn.fetch(f"""
+        WITH moved AS (
+            DELETE FROM pending_sync
+            WHERE id IN (
+                SELECT id FROM pending_sync
+                WHERE {condition}
+                ORDER BY id
+                LIMIT {int(limit)}
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, order_id, order_payload, error_message
+        )
+        INSERT INTO dead_letter_sync (original_pending_id, order_id, order_payload, final_error_message, failed_at)
+        SELECT id, order_id, order_payload, error_message, now() FROM moved
+        RETURNING original_pending_id, order_id
+    """, *args)
+    ORDERS_DEAD_LETTERED.inc(len(moved))
+    return moved
+
+async def add_to_dead_letter(order_id: int, payload: dict, error: str):
+    """Записывает заказ, который нельзя повторить автоматически, сразу в dead_letter_sync. Ошибки БД пробрасываются."""
+    async with get_connection() as conn:
+        await conn.execute("""
+            INSERT INTO dead_letter_sync (order_id, order_payload, final_error_message, failed_at)
+            VALUES ($1, $2, $3, now())
+        """, order_id, json.dumps(payload), error)
+    ORDERS_DEAD_LETTERED.inc()
+
+async def update_pending_metrics(conn):
+    """Обновляет метрики глубины pending_sync и возраста самой старой записи."""
+    row = await conn.fetchrow(
+        "SELECT count(*) AS depth, EXTRACT(EPOCH FROM now() - min(created_at)) AS oldest_age FROM pending_sync"
+    )
+    PENDING_DEPTH.set(row["depth"])
+    PENDING_OLDEST_AGE.set(float(row["oldest_age"] or 0))
+
+# --- Курсоры инкрементальной синхронизации (таблица sync_cursor) ---
+
+async def get_sync_cursor(name: str) -> datetime | None:
+    """Возвращает сохраненную отметку (high-water mark) синхронизации по имени или None."""
+    async with get_connection() as conn:
+        return await conn.fetchval("SELECT cursor_value FROM sync_cursor WHERE name = $1", name)
+
+async def set_sync_cursor(name: str, value: datetime):
+    """Сохраняет отметку синхронизации. Отметка только растет: более старое значение не перезапишет новое."""
+    async with get_connection() as conn:
+        await conn.execute("""
+            INSERT INTO sync_cursor (name, cursor_value, updated_at)
+            VALUES ($1, $2, now())
+            ON CONFLICT (name) DO UPDATE SET
+                cursor_value = GREATEST(sync_cursor.cursor_value, EXCLUDED.cursor_value),
+                updated_at = now()
+        """, name, value)
+
+# --- Зеркало состояния заказов (таблица order_state) ---
+
+def order_state_hash(ms_uuid: str | None, wc_status: str | None, ms_status: str | None) -> str:
+    """Хэш известного состояния заказа для быстрого сравнения."""
+    return hashlib.md5(f"{ms_uuid}|{wc_status}|{ms_status}".encode()).hexdigest()
+
+async def fetch_order_states(wc_order_ids: list[int]) -> dict[int, asyncpg.Record]:
+    """Возвращает последнее известное состояние заказов одним запросом: wc_order_id -> запись order_state."""
+    if not wc_order_ids:
+        return {}
+    async with get_connection() as conn:
+        rows = await conn.fetch("""
+            SELECT wc_order_id, ms_uuid, wc_status, ms_status, state_hash
+            FROM order_state
+            WHERE wc_order_id = ANY($1::int[])
+        """, wc_order_ids)
+    return {row["wc_order_id"]: row for row in rows}
+
+async def upsert_order_states(states: list[tuple[int, str | None, str | None, str | None]]):
+    """Пакетно сохраняет состояние заказов: список (wc_order_id, ms_uuid, wc_status, ms_status)."""
+    if not states:
+        return
+    records = [
+        (wc_order_id, ms_uuid, wc_status, ms_status, order_state_hash(ms_uuid, wc_status, ms_status))
+        for wc_order_id, ms_uuid, wc_status, ms_status in states
+    ]
+    async with get_connection() as conn:
+        await conn.executemany("""
+            INSERT INTO order_state (wc_order_id, ms_uuid, wc_status, ms_status, state_hash, updated_at)
+            VALUES ($1, $2, $3, $4, $5, now())
+            ON CONFLICT (wc_order_id) DO UPDATE SET
+                ms_uuid = COALESCE(EXCLUDED.ms_uuid, order_state.ms_uuid),
+                wc_status = EXCLUDED.wc_status,
+                ms_status = EXCLUDED.ms_status,
+                state_hash = EXCLUDED.state_hash,
+                updated_at = now()
+            WHERE order_state.state_hash IS DISTINCT FROM EXCLUDED.state_hash
+        """, records)
+
+# --- Снимок остатков и цен каталога (таблица catalog_snapshot) ---
+
+def catalog_state_hash(quantity: int, price: int | None) -> str:
+    """Хэш остатка и цены SKU для сравнения со снимком."""
+    return hashlib.md5(f"{quantity}|{price}".encode()).hexdigest()
+
+async def fetch_catalog_snapshot(skus: list[str]) -> dict[str, asyncpg.Record]:
+    """Возвращает снимок SKU одним запросом: sku -> запись catalog_snapshot."""
+    if not skus:
+        return {}
+    async with get_connection() as conn:
+        rows = await conn.fetch("""
+            SELECT sku, state_hash, wc_product_id, wc_parent_id
+            FROM catalog_snapshot
+            WHERE sku = ANY($1::text[])
+        """, skus)
+    return {row["sku"]: row for row in rows}
+
+async def upsert_catalog_snapshot(entries: list[tuple[str, str, int | None, int]]):
+    """Пакетно сохраняет снимок одним запросом: список (sku, state_hash, wc_product_id, wc_parent_id).
+    wc_product_id = NULL - SKU не найден в WooCommerce.
+    """
+    if not entries:
+        return
+    async with get_connection() as conn:
+        await conn.execute("""
+            INSERT INTO catalog_snapshot (sku, state_hash, wc_product_id, wc_parent_id, synced_at)
+            SELECT e.sku, e.state_hash, e.wc_product_id, e.wc_parent_id, now()
+            FROM unnest($1::text[], $2::text[], $3::int[], $4::int[]) AS e(sku, state_hash, wc_product_id, wc_parent_id)
+            ON CONFLICT (sku) DO UPDATE SET
+                state_hash = EXCLUDED.state_hash,
+                wc_product_id = EXCLUDED.wc_product_id,
+                wc_parent_id = EXCLUDED.wc_parent_id,
+                synced_at = now()
+        """, *(list(column) for column in zip(*entries)))
+
+# --- Журнал идемпотентности создания заказов (таблица order_sync_ledger) ---
+# Шаги заказа: received -> ms_created -> wc_updated -> done; failed - попытки шага исчерпаны (заказ в dead_letter_sync).
+# Заказы пошагового конвейера (app.tasks.pipeline) отличаются заданным next_attempt_at.
+
+LEDGER_RECEIVED = "received"
+LEDGER_MS_CREATED = "ms_created"
+LEDGER_WC_UPDATED = "wc_updated"
+LEDGER_DONE = "done"
+
+LEDGER_CLAIM_TIMEOUT = float(os.getenv("LEDGER_CLAIM_TIMEOUT", "300")) # Сек. аренды попытки синхронизации заказа
+
+# ON CONFLICT DO UPDATE блокирует строку: параллельная попытка ждет фиксации и видит уже продленную аренду.
+# Строки с действующей арендой не обновляются и не возвращаются.
+_CLAIM_LEDGER_SQL = """
+    INSERT INTO order_sync_ledger (wc_order_id, state, attempts, claimed_until)
+    SELECT id, 'received', 1, now() + make_interval(secs => $2) FROM unnest($1::int[]) AS id
+    ON CONFLICT (wc_order_id) DO UPDATE SET
+        attempts = order_sync_ledger.attempts + 1,
+        claimed_until = EXCLUDED.claimed_until,
+        updated_at = now()
+    WHERE order_sync_ledger.claimed_until IS NULL OR order_sync_ledger.claimed_until < now()
+    RETURNING wc_order_id, state, ms_uuid, ms_number, attempts
+"""
+
+async def claim_order_sync(wc_order_ids: list[int], lease: float = LEDGER_CLAIM_TIMEOUT) -> dict[int, asyncpg.Record]:
+    """Отмечает начало попытки синхронизации заказов, берет аренду на lease секунд и возвращает записи журнала
+    одним запросом. attempts = 1 - заказ обрабатывается впервые; state показывает последний пройденный шаг.
+    Заказов, которые сейчас обрабатывает другой воркер (аренда не истекла), в результате нет.
+    Если воркер упал, заказ снова можно забрать после истечения аренды.
+    """
+    if not wc_order_ids:
+        return {}
+    async with get_connection() as conn:
+        rows = await conn.fetch(_CLAIM_LEDGER_SQL, wc_order_ids, lease)
+    return {row["wc_order_id"]: row for row in rows}
+
+async def release_order_claims(wc_order_ids: list[int]):
+    """Снимает аренду попытки с заказов, попытка которых завершилась ошибкой: повтор может начаться сразу."""
+    if not wc_order_ids:
+        return
+    async with get_connection() as conn:
+        await conn.execute("""
+            UPDATE order_sync_ledger SET claimed_until = NULL
+            WHERE wc_order_id = ANY($1::int[]) AND claimed_until IS NOT NULL
+        """, wc_order_ids)
+
+async def record_ms_created(entries: list[tuple[int, str, str]]):
+    """Сохраняет UUID и номер созданных в МойСклад заказов: список (wc_order_id, ms_uuid, ms_number).
+    Заказы конвейера сразу становятся доступны шагу WooCommerce (next_attempt_at = now()).
+    """
+    if not entries:
+        return
+    async with get_connection() as conn:
+        await conn.execute("""
+            UPDATE order_sync_ledger l
+            SET state = 'ms_created', ms_uuid = e.ms_uuid, ms_number = e.ms_number,
+                step_attempts = 0, step_claims = 0, last_error = NULL, updated_at = now(),
+                next_attempt_at = CASE WHEN l.next_attempt_at IS NULL THEN NULL ELSE now() END
+            FROM unnest($1::int[], $2::text[], $3::text[]) AS e(wc_order_id, ms_uuid, ms_number)
+            WHERE l.wc_order_id = e.wc_order_id AND l.state <> 'done'
+        """, [e[0] for e in entries], [e[1] for e in entries], [e[2] for e in entries])
+
+async def mark_orders_done(wc_order_ids: list[int]):
+    """Отмечает заказы полностью синхронизированными (МойСклад создан, WooCommerce обновлен)."""
+    if not wc_order_ids:
+        return
+    async with get_connection() as conn:
+        await conn.execute("""
+            UPDATE order_sync_ledger SET state = 'done', next_attempt_at = NULL, claimed_until = NULL, updated_at = now()
+            WHERE wc_order_id = ANY($1::int[])
+        """, wc_order_ids)
+
+# --- Пошаговый конвейер заказов (app.tasks.pipeline) ---
+
+# Повторное поступление заказа не сбрасывает пройденные шаги. Заказ, выпавший из конвейера
+# (попытки исчерпаны или failed), возвращается в него с шага, на котором остановился.
+_RECORD_RECEIVED_SQL = """
+    INSERT INTO order_sync_ledger (wc_order_id, state, order_payload, next_attempt_at)
+    VALUES ($1, 'received', $2, now())
+    ON CONFLICT (wc_order_id) DO UPDATE SET
+        order_payload = EXCLUDED.order_payload,
+        state = CASE WHEN order_sync_ledger.state <> 'failed' THEN order_sync_ledger.state
+            WHEN order_sync_ledger.ms_uuid IS NULL THEN 'received' ELSE 'ms_created' END,
+        step_attempts = CASE WHEN order_sync_ledger.next_attempt_at IS NULL THEN 0 ELSE order_sync_ledger.step_attempts END,
+        next_attempt_at = COALESCE(order_sync_ledger.next_attempt_at, now()),
+        updated_at = now()
+    WHERE order_sync_ledger.state <> 'done'
+"""
+
+_CLAIM_PIPELINE_STEP_SQL = """
+    UPDATE order_sync_ledger
+    SET next_attempt_at = now() + make_interval(secs => $3), step_claims = step_claims + 1, updated_at = now()
+    WHERE wc_order_id IN (
+        SELECT wc_order_id FROM order_sync_ledger
+        WHERE state = $1 AND next_attempt_at <= now()
+        ORDER BY next_attempt_at ASC
+        LIMIT $2
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING wc_order_id, order_payload, ms_uuid, ms_number, step_attempts, step_claims
+"""
+
+_FAIL_PIPELINE_STEP_SQL = f"""
+    UPDATE order_sync_ledger l
+    SET step_attempts = l.step_attempts + 1,
+        last_error = e.error,
+        updated_at = now(),
+        next_attempt_at = {_next_attempt_sql("l.step_attempts + 1", "$3", "$4", "$5", "$6")}
+    FROM unnest($1::int[], $2::text[]) AS e(wc_order_id, error)
+    WHERE l.wc_order_id = e.wc_order_id AND l.state <> 'done'
+"""
+
+async def record_received_orders(orders: list[tuple[int, dict]]):
+    """Записывает заказы в журнал со статусом received и payload МойСклад одним executemany в транзакции."""
+    if not orders:
+        return
+    async with get_connection() as conn:
+        async with conn.transaction():
+            await conn.executemany(_RECORD_RECEIVED_SQL, [(order_id, json.dumps(payload)) for order_id, payload in orders])
+
+async def claim_pipeline_step(state: str, limit: int, lease: float) -> list[asyncpg.Record]:
+    """Забирает до limit заказов на шаге state, у которых подошло время попытки (частичный индекс order_sync_ledger_step_idx).
+    FOR UPDATE SKIP LOCKED пропускает строки других воркеров; next_attempt_at сдвигается на lease секунд,
+    поэтому заказ упавшего воркера вернется в выборку после истечения аренды. step_claims > 1 - шаг уже забирался,
+    и результат прошлой попытки может быть неизвестен.
+    """
+    async with get_connection() as conn:
+        return await conn.fetch(_CLAIM_PIPELINE_STEP_SQL, state, limit, lease)
+
+async def advance_pipeline(wc_order_ids: list[int], to_state: str):
+    """Переводит заказы на следующий шаг; шаг доступен сразу, счетчик попыток шага сбрасывается."""
+    if not wc_order_ids:
+        return
+    async with get_connection() as conn:
+        await conn.execute("""
+            UPDATE order_sync_ledger
+            SET state = $2, step_attempts = 0, step_claims = 0, last_error = NULL, next_attempt_at = now(), updated_at = now()
+            WHERE wc_order_id = ANY($1::int[]) AND state <> 'done'
+        """, wc_order_ids, to_state)
+
+async def fail_pipeline_step(failures: list[tuple[int, str]], error_class: str = "other", retry_after: float | None = None):
+    """Планирует повтор текущего шага заказов: список (wc_order_id, ошибка). Задержка - как у pending_sync
+    (RETRY_BACKOFF по классу ошибки); после MAX_RETRIES попыток next_attempt_at = NULL и заказ ждет переноса в dead_letter_sync.
+    """
+    if not failures:
+        return
+    async with get_connection() as conn:
+        await conn.execute(
+            _FAIL_PIPELINE_STEP_SQL,
+            [order_id for order_id, _ in failures], [error for _, error in failures],
+            *_backoff_args(error_class, retry_after),
+        )
+    ORDERS_FAILED.labels(error_class).inc(len(failures))
+
+async def finalize_pipeline_orders(wc_order_ids: list[int]) -> int:
+    """Завершает заказы шага wc_updated одной транзакцией: state = done и удаление их записей pending_sync,
+    оставшихся от прежних попыток. Возвращает количество завершенных заказов.
+    """
+    if not wc_order_ids:
+        return 0
+    async with get_connection() as conn:
+        async with conn.transaction():
+            done = await conn.fetch("""
+                UPDATE order_sync_ledger SET state = 'done', next_attempt_at = NULL, updated_at = now()
+                WHERE wc_order_id = ANY($1::int[]) AND state = 'wc_updated'
+                RETURNING wc_order_id
+            """, wc_order_ids)
+            done_ids = [row["wc_order_id"] for row in done]
+            if done_ids:
+                await conn.execute("DELETE FROM pending_sync WHERE order_id = ANY($1::int[])", done_ids)
+    return len(done_ids)
+
+async def move_failed_pipeline_orders(limit: int = 500) -> list[asyncpg.Record]:
+    """Атомарно переводит до limit заказов конвейера, исчерпавших MAX_RETRIES, в failed и копирует их в dead_letter_sync.
+    Журнал сохраняет пройденные шаги: повторное поступление заказа продолжит его с места остановки.
+    """
+    async with get_connection() as conn:
+        moved = await conn.fetch(f"""
+            WITH failed AS (
+                UPDATE order_sync_ledger SET state = 'failed', updated_at = now()
+                WHERE wc_order_id IN (
+                    SELECT wc_order_id FROM order_sync_ledger
+                    WHERE next_attempt_at IS NULL AND state IN ('received', 'ms_created', 'wc_updated')
+                        AND step_attempts >= $1
+                    ORDER BY wc_order_id
+                    LIMIT {int(limit)}
+                    FOR UPDATE SKIP LOCKED
+                )
+                RETURNING wc_order_id, order_payload, last_error
+            )
+            INSERT INTO dead_letter_sync (order_id, order_payload, final_error_message, failed_at)
+            SELECT wc_order_id, COALESCE(order_payload, '{{}}'::jsonb), last_error, now() FROM failed
+            RETURNING order_id
+        """, MAX_RETRIES)
+    ORDERS_DEAD_LETTERED.inc(len(moved))
+    return moved
+
+async def get_due_pipeline_steps() -> list[str]:
+    """Возвращает шаги конвейера, у которых есть заказы с подошедшим временем попытки."""
+    async with get_connection() as conn:
+        rows = await conn.fetch("""
+            SELECT DISTINCT state FROM order_sync_ledger
+            WHERE next_attempt_at <= now() AND state IN ('received', 'ms_created', 'wc_updated')
+        """)
+    return [row["state"] for row in rows]
+
 # Функция init_db удалена, так как схема управляется миграциями/SQL скриптами
 # async def init_db():
 #    conn = await get_connection()
@@ -0,0 +1,179 @@
+import os
+import sys
+import copy
+import json
+import queue
+import random
+import logging
+import zlib
+from contextlib import contextmanager
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
+
+from opentelemetry import trace
+
+# --- Настройки логирования (из переменных окружения) ---
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+# Уровни по модулям: "app.tasks.orders=DEBUG,httpx=WARNING"
+LOG_LEVELS = os.getenv("LOG_LEVELS", "")
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json").lower() # json или text
+LOG_FILE = os.getenv("LOG_FILE", "app_worker.log") # Пустое значение - только stdout
+# Доля сохраняемых повторяющихся INFO записей по заказам (помеченных extra={"sample": True})
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "0.1"))
+# Сколько символов тела ответа API попадает в запись лога об ошибке
+LOG_BODY_LIMIT = int(os.getenv("LOG_BODY_LIMIT", "500"))
+
+# Поля контекста (order_id, ms_uuid, task_id), добавляемые ко всем записям текущей задачи/корутины
+_log_context: ContextVar[dict] = ContextVar("log_context", default={})
+
+_listener: QueueListener | None = None
+_queue_handler: QueueHandler | None = None
+
+
+@contextmanager
+def log_context(**fields):
+    """Добавляет поля к записям лога внутри блока: with log_context(order_id=order_id): ..."""
+    token = _log_context.set({**_log_context.get(), **fields})
+    try:
+        yield
+    finally:
+        _log_context.reset(token)
+
+
+def bind_log_context(**fields):
+    """Добавляет поля к записям лога до reset_log_context(token). Для сигналов Celery, где нет общего блока with."""
+    return _log_context.set({**_log_context.get(), **fields})
+
+
+def reset_log_context(token):
+    _log_context.reset(token)
+
+
+class ContextFilter(logging.Filter):
+    """Переносит поля контекста и trace_id текущего span в запись (в потоке вызова, до постановки в очередь)."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for key, value in _log_context.get().items():
+            if not hasattr(record, key):
+                setattr(record, key, value)
+        span_context = trace.get_current_span().get_span_context()
+        if span_context.is_valid:
+            record.trace_id = format(span_context.trace_id, "032x")
+        return True
+
+
+class SamplingFilter(logging.Filter):
+    """Пропускает долю LOG_SAMPLE_RATE записей, помеченных extra={"sample": True}.
+    Решение принимается по order_id, поэтому все записи одного заказа либо сохраняются, либо нет.
+    """
+
+    def __init__(self, rate: float = LOG_SAMPLE_RATE):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not getattr(record, "sample", False) or self.rate >= 1:
+            return True
+        order_id = getattr(record, "order_id", None)
+        if order_id is None:
+            return random.random() < self.rate
+        return zlib.crc32(str(order_id).encode()) % 10000 < self.rate * 10000
+
+
+_STANDARD_ATTRS = set(vars(logging.makeLogRecord({}))) | {"message", "asctime", "sample"}
+
+
+class JsonFormatter(logging.Formatter):
+    """Одна запись - один JSON объект: время, уровень, логгер, сообщение и дополнительные поля (extra, контекст)."""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _STANDARD_ATTRS and not key.startswith("_"):
+                entry[key] = value
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class _PreparedQueueHandler(QueueHandler):
+    """QueueHandler, сохраняющий трейсбек отдельным полем (exc_text), а не внутри текста сообщения."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+
+def _build_handlers() -> list[logging.Handler]:
+    if LOG_FORMAT == "json":
+        formatter: logging.Formatter = JsonFormatter()
+    else:
+        formatter = logging.Formatter("%(asctime)s - %(name)s - %(levelname)s - %(message)s")
+    handlers: list[logging.Handler] = [logging.StreamHandler(sys.stdout)]
+    if LOG_FILE:
+        handlers.append(logging.FileHandler(LOG_FILE, encoding="utf-8"))
+    for handler in handlers:
+        handler.setFormatter(formatter)
+    return handlers
+
+
+def _apply_levels():
+    logging.getLogger().setLevel(LOG_LEVEL)
+    for item in LOG_LEVELS.split(","):
+        name, sep, level = item.partition("=")
+        if sep and name.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+
+def configure_logging():
+    """Настраивает логирование процесса: запись через очередь (QueueHandler), вывод в фоновом потоке (QueueListener).
+    Event loop не блокируется на записи в файл/консоль. Повторный вызов ничего не меняет.
+    """
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+
+    log_queue: queue.Queue = queue.Queue(-1)
+    _queue_handler = _PreparedQueueHandler(log_queue)
+    _queue_handler.addFilter(ContextFilter())
+    _queue_handler.addFilter(SamplingFilter())
+    root.addHandler(_queue_handler)
+    _apply_levels()
+
+    _listener = QueueListener(log_queue, *_build_handlers(), respect_handler_level=True)
+    _listener.start()
+
+
+def restart_logging_listener():
+    """Запускает поток записи логов заново после fork (поток родителя в дочернем процессе не существует)."""
+    global _listener
+    if _listener is None or _queue_handler is None:
+        configure_logging()
+        return
+    log_queue: queue.Queue = queue.Queue(-1)
+    _queue_handler.queue = log_queue
+    _listener = QueueListener(log_queue, *_listener.handlers, respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """Дописывает оставшиеся в очереди записи и останавливает поток записи."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
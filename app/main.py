@@ -0,0 +1,206 @@
+"""Прием вебхуков заказов WooCommerce: проверка подписи, дедупликация и пакетная постановка process_wc_order в очередь.
+
+202 отдается только после записи заказа WooCommerce в Redis (запросы, пришедшие в окне WEBHOOK_FLUSH_WINDOW,
+записываются вместе одним вызовом Lua скрипта); при ошибке записи вебхук получает 503 и WooCommerce повторит доставку.
+Тело заказа МойСклад (ссылки на контрагентов и товары из кэша ms_resolver) собирается в воркере,
+поэтому МойСклад не задерживает ответ вебхуку.
+Запуск: uvicorn app.main:app --host 0.0.0.0 --port 8000
+"""
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import os
+import logging
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+import redis.asyncio as aioredis
+from fastapi import FastAPI, Request, Response
+
+from app.worker import CELERY_BROKER_URL, ORDERS_QUEUE # Настройка логирования и маршрутизации задач
+from app.broker import encode_task_message
+
+logger = logging.getLogger(__name__)
+
+WC_WEBHOOK_SECRET = os.getenv("WC_WEBHOOK_SECRET") # Secret вебхука в настройках WooCommerce
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100")) # Заказов в одной записи в Redis
+WEBHOOK_FLUSH_WINDOW = float(os.getenv("WEBHOOK_FLUSH_WINDOW", "0.05")) # Сек. ожидания неполной пачки
+WEBHOOK_MAX_BUFFER = int(os.getenv("WEBHOOK_MAX_BUFFER", "10000")) # Заказов, ожидающих записи в Redis, после которых вебхуки получают 503
+WEBHOOK_DEDUP_TTL = int(os.getenv("WEBHOOK_DEDUP_TTL", "86400")) # Сек. хранения ключей дедупликации в Redis
+WEBHOOK_DEDUP_CACHE_SIZE = int(os.getenv("WEBHOOK_DEDUP_CACHE_SIZE", "10000")) # Ключей дедупликации в памяти процесса
+
+# KEYS[1] - очередь, KEYS[2..] - ключи дедупликации; ARGV[1] - TTL ключей, ARGV[2..] - сообщения задач
+_ENQUEUE_SCRIPT = """
+local pushed = 0
+for i = 2, #KEYS do
+  if redis.call('SET', KEYS[i], 1, 'NX', 'EX', ARGV[1]) then
+    redis.call('LPUSH', KEYS[1], ARGV[i])
+    pushed = pushed + 1
+  end
+end
+return pushed
+"""
+
+
+def verify_signature(body: bytes, signature: str | None, secret: str | None = WC_WEBHOOK_SECRET) -> bool:
+    """Проверяет X-WC-Webhook-Signature: base64(HMAC-SHA256(secret, тело запроса))."""
+    if not secret or not signature:
+        return False
+    expected = base64.b64encode(hmac.new(secret.encode(), body, hashlib.sha256).digest()).decode()
+    return hmac.compare_digest(expected, signature)
+
+
+def is_order_synced(order: dict) -> bool:
+    """Заказ уже создан в МойСклад (в WC записан _moysklad_uuid) - изменения статуса обрабатывает status_sync."""
+    return any(m.get("key") == "_moysklad_uuid" and m.get("value") for m in order.get("meta_data", []))
+
+
+class OrderEnqueuer:
+    """Буфер заказов из вебхуков. Дедуплицирует по (ID заказа, date_modified_gmt) сначала в памяти процесса,
+    затем в Redis (SET NX, общий для всех реплик), и кладет сообщения process_wc_order в очередь пачками
+    (Lua скрипт: дедупликация и LPUSH пачки выполняются атомарно, поэтому повтор доставки после ошибки безопасен).
+    """
+
+    def __init__(self, redis_url: str = CELERY_BROKER_URL, queue: str = ORDERS_QUEUE,
+                 max_size: int = WEBHOOK_BATCH_SIZE, window: float = WEBHOOK_FLUSH_WINDOW):
+        self.queue = queue
+        self.max_size = max_size
+        self.window = window
+        self._redis = aioredis.from_url(redis_url)
+        self._buffer: list[tuple[str, int, dict, asyncio.Future]] = [] # (ключ дедупликации, order_id, заказ WooCommerce, результат записи)
+        self._seen: OrderedDict[str, None] = OrderedDict()
+        self._timer: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._buffer)
+
+    def _remember(self, key: str) -> bool:
+        """Возвращает False, если ключ уже встречался в этом процессе."""
+        if key in self._seen:
+            self._seen.move_to_end(key)
+            return False
+        self._seen[key] = None
+        if len(self._seen) > WEBHOOK_DEDUP_CACHE_SIZE:
+            self._seen.popitem(last=False)
+        return True
+
+    async def submit(self, order_id: int, modified: str, order: dict) -> bool:
+        """Ставит заказ в буфер и ждет записи его пачки в Redis. Возвращает False для повторной доставки
+        того же изменения заказа. Ошибка записи пробрасывается, а заказ не считается увиденным.
+        """
+        key = f"webhook:seen:{order_id}:{modified}"
+        if not self._remember(key):
+            return False
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append((key, order_id, order, future))
+        if len(self._buffer) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        try:
+            await future
+        except Exception:
+            self._seen.pop(key, None)
+            raise
+        return True
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        task = asyncio.create_task(self._send(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, batch: list[tuple[str, int, dict, asyncio.Future]]):
+        try:
+            messages = [encode_task_message("process_wc_order", (order_id, order), queue=self.queue) for _, order_id, order, _ in batch]
+            # Один атомарный вызов на пачку: дедупликация между репликами и LPUSH только новых заказов
+            pushed = int(await self._redis.eval(
+                _ENQUEUE_SCRIPT, len(batch) + 1, self.queue, *(key for key, _, _, _ in batch), WEBHOOK_DEDUP_TTL, *messages,
+            ))
+            logger.info(f"Enqueued {pushed} orders to '{self.queue}' ({len(batch) - pushed} duplicates skipped).")
+        except Exception as e:
+            # Скрипт не выполнился - вебхуки пачки получат 503, WooCommerce повторит их доставку
+            logger.error(f"Failed to enqueue {len(batch)} orders: {e}")
+            for _, _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for _, _, _, future in batch:
+            if not future.done():
+                future.set_result(None)
+
+    async def drain(self):
+        """Отправляет буфер и дожидается завершения отправок."""
+        self._flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+    async def close(self):
+        await self.drain()
+        await self._redis.aclose()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if not WC_WEBHOOK_SECRET:
+        logger.error("WC_WEBHOOK_SECRET is not set. All webhooks will be rejected.")
+    app.state.enqueuer = OrderEnqueuer()
+    try:
+        yield
+    finally:
+        await app.state.enqueuer.close()
+
+
+app = FastAPI(title="ms_orders webhooks", lifespan=lifespan)
+
+
+@app.post("/webhooks/woocommerce/order")
+async def woocommerce_order_webhook(request: Request) -> Response:
+    """Вебхук WooCommerce order.created / order.updated."""
+    body = await request.body()
+    if request.headers.get("X-WC-Webhook-Topic") is None and body.startswith(b"webhook_id="):
+        # Проверочный запрос WooCommerce при создании вебхука (без подписи)
+        return Response(status_code=200)
+    if not verify_signature(body, request.headers.get("X-WC-Webhook-Signature")):
+        logger.warning(f"Rejected webhook with invalid signature from {request.client.host if request.client else '?'}")
+        return Response(status_code=401)
+
+    try:
+        order = json.loads(body)
+        order_id = int(order["id"])
+    except (ValueError, KeyError, TypeError):
+        logger.warning("Rejected webhook with invalid order body.")
+        return Response(status_code=400)
+
+    if is_order_synced(order):
+        return Response(status_code=200)
+
+    enqueuer: OrderEnqueuer = request.app.state.enqueuer
+    if len(enqueuer) >= WEBHOOK_MAX_BUFFER:
+        logger.error(f"Webhook buffer is full ({len(enqueuer)} orders). Rejecting order {order_id}.")
+        return Response(status_code=503)
+
+    modified = order.get("date_modified_gmt") or order.get("date_modified") or ""
+    try:
+        await enqueuer.submit(order_id, modified, order)
+    except Exception:
+        return Response(status_code=503)
+    return Response(status_code=202)
+
+
+@app.get("/health")
+async def health() -> dict:
+    return {"status": "ok"}
@@ -0,0 +1,84 @@
+import os
+import re
+import logging
+import shutil
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server
+from prometheus_client import multiprocess
+
+logger = logging.getLogger(__name__)
+
+# Порт HTTP эндпоинта /metrics (0 - не запускать)
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+# Каталог для метрик процессов prefork (должен быть задан до импорта prometheus_client)
+PROMETHEUS_MULTIPROC_DIR = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# --- Заказы ---
+ORDERS_SYNCED = Counter("orders_synced_total", "Orders created in Moysklad and written back to WooCommerce")
+ORDERS_FAILED = Counter("orders_failed_total", "Failed order sync attempts saved to pending_sync", ["error_class"])
+ORDERS_DEAD_LETTERED = Counter("orders_dead_lettered_total", "Orders moved to dead_letter_sync")
+PENDING_DEPTH = Gauge("pending_sync_depth", "Rows in pending_sync", multiprocess_mode="mostrecent")
+PENDING_OLDEST_AGE = Gauge("pending_sync_oldest_age_seconds", "Age of the oldest pending_sync row", multiprocess_mode="mostrecent")
+
+# --- Внешние API ---
+API_REQUEST_DURATION = Histogram(
+    "api_request_duration_seconds", "Moysklad / WooCommerce request latency",
+    ["service", "method", "endpoint", "status"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 30),
+)
+
+# --- Кэш ссылок МойСклад (ms_resolver) ---
+MS_RESOLVER_LOOKUPS = Counter("ms_resolver_lookups_total", "Moysklad reference lookups by cache level", ["kind", "source"]) # source: memory, postgres, moysklad
+
+# --- Синхронизация остатков и цен ---
+CATALOG_UPDATES = Counter("catalog_updates_total", "Catalog stock/price sync decisions per SKU", ["result"]) # result: pushed, unchanged, unmatched, failed
+
+# --- Синхронизация статусов ---
+STATUS_UPDATES = Counter("status_updates_total", "Status sync decisions", ["direction", "result"]) # result: sent, skipped, failed
+
+# --- Периодические задачи ---
+TASK_OVERLAPS = Counter("task_overlaps_total", "Task runs that found the previous run still holding its lock", ["task", "policy"])
+
+# --- Пул БД ---
+DB_POOL_IN_USE = Gauge("db_pool_in_use_connections", "Connections checked out from the pool", multiprocess_mode="livesum")
+DB_ACQUIRE_WAIT = Histogram("db_pool_acquire_wait_seconds", "Time waiting for a pool connection",
+                            buckets=(0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+DB_QUERY_DURATION = Histogram("db_query_duration_seconds", "Query latency", ["query"],
+                              buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+_ID_SEGMENT = re.compile(r"/(?:[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}|\d+)(?=/|$)")
+
+
+def endpoint_label(path: str) -> str:
+    """Нормализует путь запроса для метки endpoint: UUID и числовые ID заменяются на {id}."""
+    return _ID_SEGMENT.sub("/{id}", path)
+
+
+def clear_multiprocess_dir():
+    """Очищает каталог метрик процессов перед стартом воркера (вызывается в главном процессе)."""
+    if not PROMETHEUS_MULTIPROC_DIR:
+        return
+    shutil.rmtree(PROMETHEUS_MULTIPROC_DIR, ignore_errors=True)
+    os.makedirs(PROMETHEUS_MULTIPROC_DIR, exist_ok=True)
+
+
+def mark_process_dead(pid: int):
+    """Убирает live-gauge метрики завершившегося процесса prefork."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(pid)
+
+
+def start_metrics_server(port: int = METRICS_PORT):
+    """Запускает HTTP эндпоинт /metrics. В режиме prefork агрегирует метрики всех процессов."""
+    if not port:
+        return
+    try:
+        if PROMETHEUS_MULTIPROC_DIR:
+            registry = CollectorRegistry()
+            multiprocess.MultiProcessCollector(registry)
+            start_http_server(port, registry=registry)
+        else:
+            start_http_server(port)
+        logger.info(f"Metrics endpoint listening on :{port}/metrics")
+    except Exception as e:
+        logger.exception(f"Failed to start metrics endpoint on port {port}: {e}")
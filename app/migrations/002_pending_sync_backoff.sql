@@ -0,0 +1,9 @@
+-- Для существующих баз: время следующей попытки с экспоненциальной задержкой
+ALTER TABLE pending_sync ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP DEFAULT now();
+-- Записи, уже исчерпавшие попытки (MAX_RETRIES по умолчанию - 5), получили now() из DEFAULT: повторять их не нужно
+UPDATE pending_sync SET next_attempt_at = NULL WHERE retry_count >= 5;
+
+-- Частичный индекс для выборки записей, готовых к повтору (next_attempt_at <= now())
+CREATE INDEX IF NOT EXISTS pending_sync_next_attempt_idx
+    ON pending_sync (next_attempt_at)
+    WHERE next_attempt_at IS NOT NULL;
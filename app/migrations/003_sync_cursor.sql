@@ -0,0 +1,6 @@
+-- Отметки (high-water mark) инкрементальной синхронизации статусов
+CREATE TABLE IF NOT EXISTS sync_cursor (
+    name TEXT PRIMARY KEY,
+    cursor_value TIMESTAMP NOT NULL,
+    updated_at TIMESTAMP DEFAULT now()
+);
@@ -0,0 +1,11 @@
+-- Зеркало последнего известного состояния заказов в обеих системах (для пропуска обновлений без изменений)
+CREATE TABLE IF NOT EXISTS order_state (
+    wc_order_id INTEGER PRIMARY KEY,
+    ms_uuid TEXT,
+    wc_status TEXT,
+    ms_status TEXT,
+    state_hash TEXT,
+    updated_at TIMESTAMP DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS order_state_ms_uuid_idx ON order_state (ms_uuid);
@@ -0,0 +1,12 @@
+-- Уведомление воркеров об изменении маппинга статусов (сбрасывает кэш в процессах)
+CREATE OR REPLACE FUNCTION notify_status_mapping_changed() RETURNS trigger AS $$
+BEGIN
+    PERFORM pg_notify('status_mapping_changed', '');
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS status_mapping_changed ON status_mapping;
+CREATE TRIGGER status_mapping_changed
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON status_mapping
+    FOR EACH STATEMENT EXECUTE FUNCTION notify_status_mapping_changed();
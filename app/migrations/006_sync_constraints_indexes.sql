@@ -0,0 +1,16 @@
+-- Уникальность order_id в pending_sync: на нее опирается ON CONFLICT (order_id) в save_to_pending.
+-- Сначала убираем дубликаты, оставляя самую свежую запись по каждому заказу.
+DELETE FROM pending_sync p
+USING pending_sync newer
+WHERE p.order_id = newer.order_id AND p.id < newer.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS pending_sync_order_id_key ON pending_sync (order_id);
+
+-- Записи, исчерпавшие попытки (next_attempt_at = NULL), для переноса в dead_letter_sync
+CREATE INDEX IF NOT EXISTS pending_sync_exhausted_idx
+    ON pending_sync (id)
+    WHERE next_attempt_at IS NULL;
+
+-- Разбор dead letter: поиск по заказу и по времени
+CREATE INDEX IF NOT EXISTS dead_letter_sync_order_id_idx ON dead_letter_sync (order_id);
+CREATE INDEX IF NOT EXISTS dead_letter_sync_failed_at_idx ON dead_letter_sync (failed_at);
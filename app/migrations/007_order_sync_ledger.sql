@@ -0,0 +1,12 @@
+-- Журнал идемпотентности создания заказов: по ID заказа WC хранится UUID созданного заказа МойСклад и пройденный шаг.
+-- state: ms_pending (отправка в МойСклад начата, результат неизвестен), ms_created (заказ есть в МойСклад), done (WC обновлен).
+-- Миграция 008 переименовывает ms_pending в received; актуальные состояния - в app/db.py (LEDGER_*).
+CREATE TABLE IF NOT EXISTS order_sync_ledger (
+    wc_order_id INTEGER PRIMARY KEY,
+    state TEXT NOT NULL DEFAULT 'ms_pending',
+    ms_uuid TEXT,
+    ms_number TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT now(),
+    updated_at TIMESTAMP DEFAULT now()
+);
@@ -0,0 +1,20 @@
+-- Пошаговый конвейер заказов на основе журнала: received -> ms_created -> wc_updated -> done
+-- (failed - попытки шага исчерпаны, заказ перенесен в dead_letter_sync).
+-- next_attempt_at задан только у заказов, которые ведет конвейер; шаги выбирают их по частичному индексу.
+ALTER TABLE order_sync_ledger
+    ADD COLUMN IF NOT EXISTS order_payload JSONB,
+    ADD COLUMN IF NOT EXISTS step_attempts INTEGER NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS next_attempt_at TIMESTAMP,
+    ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+UPDATE order_sync_ledger SET state = 'received' WHERE state = 'ms_pending';
+ALTER TABLE order_sync_ledger ALTER COLUMN state SET DEFAULT 'received';
+
+CREATE INDEX IF NOT EXISTS order_sync_ledger_step_idx
+    ON order_sync_ledger (state, next_attempt_at)
+    WHERE next_attempt_at IS NOT NULL;
+
+-- Заказы, исчерпавшие попытки шага (next_attempt_at = NULL), для переноса в dead_letter_sync
+CREATE INDEX IF NOT EXISTS order_sync_ledger_exhausted_idx
+    ON order_sync_ledger (wc_order_id)
+    WHERE next_attempt_at IS NULL AND state IN ('received', 'ms_created', 'wc_updated');
@@ -0,0 +1,10 @@
+-- Кэш ссылок МойСклад для сборки заказов (app.utils.ms_resolver): вид + ключ (SKU, email, телефон) -> href сущности.
+-- href = NULL - значение не найдено в МойСклад (отметка живет MS_RESOLVER_NEGATIVE_TTL секунд).
+CREATE TABLE IF NOT EXISTS ms_ref_cache (
+    kind TEXT NOT NULL,
+    key TEXT NOT NULL,
+    href TEXT,
+    entity_type TEXT,
+    updated_at TIMESTAMP NOT NULL DEFAULT now(),
+    PRIMARY KEY (kind, key)
+);
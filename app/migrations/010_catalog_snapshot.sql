@@ -0,0 +1,9 @@
+-- Снимок остатков и цен, отправленных в WooCommerce (app.tasks.catalog): по хэшу определяются измененные SKU.
+-- wc_product_id = NULL - SKU не найден в WooCommerce; wc_parent_id - товар вариации (0 для простых товаров).
+CREATE TABLE IF NOT EXISTS catalog_snapshot (
+    sku TEXT PRIMARY KEY,
+    state_hash TEXT NOT NULL,
+    wc_product_id INTEGER,
+    wc_parent_id INTEGER NOT NULL DEFAULT 0,
+    synced_at TIMESTAMP NOT NULL DEFAULT now()
+);
@@ -0,0 +1,3 @@
+-- Аренда попытки синхронизации заказа: пока claimed_until в будущем, заказ обрабатывает другой воркер,
+-- и повторная доставка того же заказа не отправляет его в МойСклад второй раз.
+ALTER TABLE order_sync_ledger ADD COLUMN IF NOT EXISTS claimed_until TIMESTAMP;
@@ -0,0 +1,3 @@
+-- Сколько раз шаг конвейера забирался воркерами. Растет при каждом claim, поэтому заказ, воркер которого упал
+-- после отправки в МойСклад (step_attempts не изменился), при следующем claim ищется по externalCode.
+ALTER TABLE order_sync_ledger ADD COLUMN IF NOT EXISTS step_claims INTEGER NOT NULL DEFAULT 0;
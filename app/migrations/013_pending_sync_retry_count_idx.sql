@@ -0,0 +1,5 @@
+-- Перенос в dead_letter_sync выбирает записи по retry_count >= MAX_RETRIES (без next_attempt_at IS NULL),
+-- чтобы записи с заданным next_attempt_at не оставались в pending_sync после смены MAX_RETRIES
+DROP INDEX IF EXISTS pending_sync_exhausted_idx;
+
+CREATE INDEX IF NOT EXISTS pending_sync_retry_count_idx ON pending_sync (retry_count);
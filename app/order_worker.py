@@ -0,0 +1,315 @@
+"""Высококонкурентный воркер заказов: один процесс, один event loop, до ORDER_WORKER_CONCURRENCY заказов одновременно.
+
+Читает сообщения задач process_order и process_wc_order (заказы из вебхуков) из очереди Redis брокера Celery
+(ORDERS_QUEUE) пачками и выполняет их как корутины. Сообщения с eta в будущем (повторы self.retry, countdown) откладываются
+в sorted set и возвращаются в очередь, когда подойдет время. Требуется Redis 6.2+ (LMOVE/BLMOVE).
+Запуск: python -m app.order_worker
+"""
+import asyncio
+import os
+import signal
+import socket
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import redis.asyncio as aioredis
+
+from app.broker import decode_task_message, encode_task_message
+from app.worker import CELERY_BROKER_URL, ORDERS_QUEUE, MIGRATE_ON_STARTUP # Настройка логирования и маршрутизации задач
+from app.db import init_db_pool, close_db_pool, run_migrations, save_to_pending, add_to_dead_letter, get_pending_writer
+from app.utils.http_client import init_http_clients, close_http_clients
+from app.utils.status_cache import status_cache
+from app.utils.woocommerce import get_wc_write_back_queue
+from app.tasks.orders import _sync_order, _sync_wc_order, get_order_batcher, process_wc_order_task
+from app.metrics import start_metrics_server
+from app.logging_config import log_context, stop_logging
+from app.tracing import init_tracing, shutdown_tracing, attach_context, detach_context
+
+logger = logging.getLogger(__name__)
+
+ORDER_WORKER_CONCURRENCY = int(os.getenv("ORDER_WORKER_CONCURRENCY", "200")) # Заказов одновременно
+ORDER_WORKER_FETCH_SIZE = int(os.getenv("ORDER_WORKER_FETCH_SIZE", "100")) # Сообщений за одно чтение из Redis
+ORDER_WORKER_POLL_TIMEOUT = float(os.getenv("ORDER_WORKER_POLL_TIMEOUT", "1.0")) # Сек. блокирующего ожидания пустой очереди
+ORDER_WORKER_DELAY_POLL = float(os.getenv("ORDER_WORKER_DELAY_POLL", "1.0")) # Сек. между проверками отложенных сообщений
+ORDER_WORKER_ID = os.getenv("ORDER_WORKER_ID") or socket.gethostname() # Имя списка processing; уникально для каждого воркера
+ORDER_WORKER_HEARTBEAT_TTL = float(os.getenv("ORDER_WORKER_HEARTBEAT_TTL", "60")) # Сек. жизни метки активности воркера
+
+# KEYS[1] - отложенные сообщения (score - eta, unix time), KEYS[2] - очередь; ARGV[1] - текущее время, ARGV[2] - лимит.
+# Перенос атомарный: при нескольких воркерах сообщение возвращается в очередь один раз.
+_PROMOTE_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, ARGV[2])
+for _, message in ipairs(due) do
+  redis.call('ZREM', KEYS[1], message)
+  redis.call('LPUSH', KEYS[2], message)
+end
+return #due
+"""
+
+
+def parse_eta(value: str | None) -> datetime | None:
+    """Разбирает заголовок eta сообщения Celery (ISO 8601); время без часового пояса считается UTC."""
+    if not value:
+        return None
+    try:
+        eta = datetime.fromisoformat(value)
+    except (TypeError, ValueError):
+        logger.warning(f"Unexpected eta in task message: {value}")
+        return None
+    return eta if eta.tzinfo else eta.replace(tzinfo=timezone.utc)
+
+
+class OrderWorker:
+    """Забирает сообщения process_order из Redis и выполняет их конкурентно с ограничением.
+    Сообщение переносится в личный список {queue}:processing:{worker_id} (LMOVE) и удаляется оттуда после обработки.
+    Пока воркер жив, он продлевает метку {queue}:worker:{worker_id}; списки processing воркеров без метки
+    (упавших или пересозданных под другим именем) возвращаются в очередь любым работающим воркером.
+    Сообщения с eta в будущем ждут в общем для всех воркеров sorted set {queue}:delayed.
+    """
+
+    def __init__(self, redis_url: str = CELERY_BROKER_URL, queue: str = ORDERS_QUEUE,
+                 concurrency: int = ORDER_WORKER_CONCURRENCY, fetch_size: int = ORDER_WORKER_FETCH_SIZE,
+                 worker_id: str = ORDER_WORKER_ID):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.processing = f"{queue}:processing:{worker_id}"
+        self.heartbeat = f"{queue}:worker:{worker_id}"
+        self.delayed = f"{queue}:delayed"
+        self.concurrency = concurrency
+        self.fetch_size = fetch_size
+        self._redis = aioredis.from_url(redis_url)
+        self._inflight: set[asyncio.Task] = set()
+        self._stopping = asyncio.Event()
+        self._next_promote = 0.0
+        self._next_heartbeat = 0.0
+        self._token = uuid.uuid4().hex # Отличает метку этого процесса от метки другого воркера с тем же worker_id
+
+    def stop(self):
+        if not self._stopping.is_set():
+            logger.info("Stop requested. Draining in-flight orders...")
+            self._stopping.set()
+
+    async def _acquire_worker_id(self) -> bool:
+        """Занимает worker_id: ставит метку активности, если ее нет. Пока метку держит другой процесс
+        (тот же ORDER_WORKER_ID у двух воркеров или метка упавшего процесса еще не истекла), ждет.
+        Возвращает False, если остановка запрошена раньше.
+        """
+        while not await self._redis.set(self.heartbeat, self._token, nx=True, ex=int(ORDER_WORKER_HEARTBEAT_TTL)):
+            if self._stopping.is_set():
+                return False
+            logger.warning(f"Worker id '{self.worker_id}' is in use (key {self.heartbeat}). Waiting for it to expire...")
+            await asyncio.sleep(ORDER_WORKER_HEARTBEAT_TTL / 3)
+        self._next_heartbeat = time.monotonic() + ORDER_WORKER_HEARTBEAT_TTL / 3
+        return True
+
+    async def _keep_alive(self):
+        """Продлевает метку активности и возвращает в очередь списки processing воркеров без метки."""
+        now = time.monotonic()
+        if now < self._next_heartbeat:
+            return
+        self._next_heartbeat = now + ORDER_WORKER_HEARTBEAT_TTL / 3
+        try:
+            owner = await self._redis.get(self.heartbeat)
+            if owner is not None and owner.decode() != self._token:
+                logger.error(f"Worker id '{self.worker_id}' is held by another process. Stopping.")
+                self.stop()
+                return
+            await self._redis.set(self.heartbeat, self._token, ex=int(ORDER_WORKER_HEARTBEAT_TTL))
+            await self._requeue_orphans()
+        except Exception as e:
+            logger.warning(f"Failed to renew worker heartbeat {self.heartbeat}: {e}")
+
+    async def _requeue(self, processing: str) -> int:
+        count = 0
+        while await self._redis.lmove(processing, self.queue, "RIGHT", "RIGHT"):
+            count += 1
+        if count:
+            logger.warning(f"Requeued {count} unfinished messages from {processing}.")
+        return count
+
+    async def _requeue_leftovers(self):
+        """Возвращает в очередь сообщения, оставшиеся в processing после прошлого запуска."""
+        await self._requeue(self.processing)
+
+    async def _requeue_orphans(self):
+        """Возвращает в очередь сообщения из списков processing воркеров, метка активности которых истекла."""
+        prefix = f"{self.queue}:processing:"
+        async for key in self._redis.scan_iter(match=f"{prefix}*"):
+            worker_id = key.decode()[len(prefix):]
+            if worker_id == self.worker_id or await self._redis.exists(f"{self.queue}:worker:{worker_id}"):
+                continue
+            await self._requeue(key.decode())
+
+    async def _fetch(self, limit: int) -> list[bytes]:
+        """Забирает до limit сообщений; если очередь пуста, ждет первое не дольше ORDER_WORKER_POLL_TIMEOUT."""
+        pipe = self._redis.pipeline(transaction=False)
+        for _ in range(limit):
+            # Celery (kombu) кладет сообщения через LPUSH, забирает с правого конца
+            pipe.lmove(self.queue, self.processing, "RIGHT", "LEFT")
+        messages = [m for m in await pipe.execute() if m is not None]
+        if not messages:
+            message = await self._redis.blmove(self.queue, self.processing, ORDER_WORKER_POLL_TIMEOUT, "RIGHT", "LEFT")
+            if message is not None:
+                messages.append(message)
+        return messages
+
+    async def _delay(self, raw: bytes, eta: datetime):
+        """Откладывает сообщение до eta; повторное откладывание того же сообщения ничего не меняет."""
+        await self._redis.zadd(self.delayed, {raw: eta.timestamp()})
+
+    async def _promote_due(self):
+        """Возвращает в очередь отложенные сообщения, у которых подошло время (не чаще ORDER_WORKER_DELAY_POLL)."""
+        now = time.monotonic()
+        if now < self._next_promote:
+            return
+        self._next_promote = now + ORDER_WORKER_DELAY_POLL
+        moved = 0
+        try:
+            while True:
+                count = int(await self._redis.eval(_PROMOTE_SCRIPT, 2, self.delayed, self.queue, time.time(), self.fetch_size))
+                moved += count
+                if count < self.fetch_size:
+                    break
+        except Exception as e:
+            logger.warning(f"Failed to move due messages from {self.delayed}: {e}")
+        if moved:
+            logger.info(f"Moved {moved} delayed messages back to {self.queue}.")
+
+    async def _handle(self, raw: bytes):
+        try:
+            task_name, args, kwargs, headers = decode_task_message(raw)
+            if task_name not in ("process_order", process_wc_order_task.name):
+                # Чужие задачи возвращаем в общую очередь Celery без изменений
+                logger.warning(f"Unexpected task '{task_name}' in queue {self.queue}. Forwarding to 'celery' queue.")
+                await self._redis.lpush("celery", raw)
+                return
+            order_id = kwargs.get("order_id", args[0] if args else None)
+            # process_order - тело заказа МойСклад, process_wc_order - заказ WooCommerce из вебхука
+            payload_arg = "order_payload" if task_name == "process_order" else "order"
+            order_payload = kwargs.get(payload_arg, args[1] if len(args) > 1 else None)
+        except Exception as e:
+            logger.exception(f"Failed to decode message from {self.queue}, dropping it: {e}")
+            return
+
+        eta = parse_eta(headers.get("eta"))
+        if eta is not None and eta > datetime.now(timezone.utc):
+            # Повтор задачи (self.retry / countdown): выполнится, когда подойдет время
+            try:
+                await self._delay(raw, eta)
+                return
+            except Exception as e:
+                logger.warning(f"Failed to delay order {order_id} until {eta.isoformat()}, processing it now: {e}")
+
+        # Продолжаем трейс отправителя задачи (traceparent в заголовках сообщения Celery)
+        token = attach_context(headers)
+        try:
+            with log_context(order_id=order_id, task_id=headers.get("id")):
+                if task_name == process_wc_order_task.name:
+                    await self._handle_wc_order(int(order_id), order_payload, args, kwargs, headers)
+                else:
+                    await _sync_order(int(order_id), order_payload)
+        except Exception as e:
+            logger.exception(f"Unhandled error processing order {order_id}: {e}")
+            if task_name == process_wc_order_task.name:
+                # В pending_sync хранятся тела заказов МойСклад, а не заказы WooCommerce
+                try:
+                    await add_to_dead_letter(int(order_id), order_payload, f"Unexpected Error: {str(e)}")
+                except Exception as dlq_error:
+                    logger.exception(f"Failed to move order {order_id} to dead_letter_sync: {dlq_error}")
+            else:
+                await save_to_pending(int(order_id), order_payload, f"Unexpected Error: {str(e)}")
+        finally:
+            detach_context(token)
+
+    async def _handle_wc_order(self, order_id: int, order: dict, args: list, kwargs: dict, headers: dict):
+        """Заказ WooCommerce из вебхука. Повторы - как у process_wc_order_task в Celery: сообщение с retries + 1
+        откладывается на default_retry_delay; после max_retries заказ переносится в dead_letter_sync.
+        """
+        retries = int(headers.get("retries") or 0)
+        try:
+            await _sync_wc_order(order_id, order, final_attempt=retries >= process_wc_order_task.max_retries)
+        except Exception as e:
+            eta = datetime.now(timezone.utc) + timedelta(seconds=process_wc_order_task.default_retry_delay)
+            logger.warning(f"Retrying order {order_id} at {eta.isoformat()} due to exception: {e}")
+            message = encode_task_message(process_wc_order_task.name, args, kwargs, queue=self.queue, retries=retries + 1, eta=eta)
+            await self._delay(message, eta)
+
+    async def _run_one(self, raw: bytes):
+        try:
+            await self._handle(raw)
+        finally:
+            # Подтверждение: сообщение обработано (успех или сохранено в pending_sync)
+            await self._redis.lrem(self.processing, 1, raw)
+
+    async def run(self):
+        if not await self._acquire_worker_id():
+            await self._redis.aclose()
+            return
+        await self._requeue_leftovers()
+        await self._requeue_orphans()
+        logger.info(f"Order worker started: queue={self.queue}, worker_id={self.worker_id}, concurrency={self.concurrency}.")
+        while not self._stopping.is_set():
+            await self._keep_alive()
+            await self._promote_due()
+            free = self.concurrency - len(self._inflight)
+            if free <= 0:
+                # Backpressure: не читаем новые сообщения, пока не освободится слот
+                await asyncio.wait(self._inflight, return_when=asyncio.FIRST_COMPLETED)
+                continue
+            try:
+                messages = await self._fetch(min(free, self.fetch_size))
+            except Exception as e:
+                logger.exception(f"Failed to read from {self.queue}: {e}")
+                await asyncio.sleep(ORDER_WORKER_POLL_TIMEOUT)
+                continue
+            for raw in messages:
+                task = asyncio.create_task(self._run_one(raw))
+                self._inflight.add(task)
+                task.add_done_callback(self._inflight.discard)
+
+        await self.drain()
+
+    async def drain(self):
+        """Дожидается обработки забранных сообщений и отправки накопленных пачек."""
+        if self._inflight:
+            logger.info(f"Waiting for {len(self._inflight)} in-flight orders...")
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+        await get_order_batcher().drain()
+        await get_wc_write_back_queue().drain()
+        await get_pending_writer().drain()
+        # Метку снимаем, только если она наша: processing пуст, перезапуск с тем же worker_id не ждет ее истечения
+        try:
+            if await self._redis.get(self.heartbeat) == self._token.encode():
+                await self._redis.delete(self.heartbeat)
+        except Exception as e:
+            logger.warning(f"Failed to remove worker heartbeat {self.heartbeat}: {e}")
+        await self._redis.aclose()
+        logger.info("Order worker drained.")
+
+
+async def main():
+    start_metrics_server()
+    init_tracing()
+    await init_db_pool()
+    if MIGRATE_ON_STARTUP:
+        await run_migrations()
+    await init_http_clients()
+    await status_cache.start_listener()
+
+    worker = OrderWorker()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        loop.add_signal_handler(sig, worker.stop)
+    try:
+        await worker.run()
+    finally:
+        await status_cache.stop_listener()
+        await close_http_clients()
+        await close_db_pool()
+        shutdown_tracing()
+        stop_logging()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,134 @@
+# tasks/catalog.py
+
+import asyncio
+import os
+import logging
+
+from app.worker import celery_app
+from app.db import fetch_catalog_snapshot, upsert_catalog_snapshot, catalog_state_hash
+from app.metrics import CATALOG_UPDATES
+from app.utils.moysklad import iter_moysklad_rows
+from app.utils.ms_resolver import get_ms_resolver, MS_SKU_FIELD
+from app.utils.woocommerce import update_wc_products_batch, find_wc_products_by_sku, WC_BATCH_SIZE
+from app.utils.task_lock import singleton, SKIP, COALESCE
+
+logger = logging.getLogger(__name__)
+
+# Синхронизация остатков и цен МойСклад -> WooCommerce
+CATALOG_SYNC_PRICES = os.getenv("CATALOG_SYNC_PRICES", "true").lower() in ("1", "true", "yes") # Обновлять regular_price из цены продажи
+CATALOG_WC_CONCURRENCY = int(os.getenv("CATALOG_WC_CONCURRENCY", "4")) # Сколько запросов products/batch выполнять одновременно
+
+@celery_app.task(name="warm_moysklad_ref_cache")
+@singleton("warm_moysklad_ref_cache", SKIP)
+async def warm_ms_ref_cache_task():
+    """Задача Celery: прогрев кэша ссылок МойСклад (ms_ref_cache) из полных выборок ассортимента и контрагентов,
+    чтобы сборка заказов из вебхуков не делала запросов к МойСклад.
+    """
+    logger.info("Starting warm_moysklad_ref_cache task...")
+    await get_ms_resolver().warm()
+
+def _parse_stock_row(row: dict) -> tuple[str, int, int | None] | None:
+    """Строка отчета об остатках -> (SKU, свободный остаток, цена продажи в копейках или None)."""
+    sku = (row.get(MS_SKU_FIELD) or "").strip()
+    if not sku:
+        return None
+    quantity = max(0, int((row.get("stock") or 0) - (row.get("reserve") or 0)))
+    price = row.get("salePrice") if CATALOG_SYNC_PRICES else None
+    return sku, quantity, round(price) if price is not None else None
+
+def _wc_stock_update(product_id: int, quantity: int, price: int | None) -> dict:
+    update = {"id": product_id, "manage_stock": True, "stock_quantity": quantity}
+    if price is not None:
+        update["regular_price"] = f"{price / 100:.2f}"
+    return update
+
+async def _sync_stock_page(rows: list[dict], full: bool, semaphore: asyncio.Semaphore, totals: dict[str, int]):
+    """Сравнивает страницу отчета со снимком и отправляет в WooCommerce только измененные SKU.
+    Снимок обновляется только для отправленных успешно (и не найденных в WooCommerce) SKU,
+    поэтому неуспешные обновления повторятся при следующем запуске.
+    """
+    items: dict[str, tuple[int, int | None, str]] = {} # sku -> (остаток, цена, хэш)
+    for row in rows:
+        parsed = _parse_stock_row(row)
+        if parsed:
+            sku, quantity, price = parsed
+            items[sku] = (quantity, price, catalog_state_hash(quantity, price))
+    if not items:
+        return
+
+    snapshot = await fetch_catalog_snapshot(list(items))
+    changed = [sku for sku, (_, _, state_hash) in items.items()
+               if full or sku not in snapshot or snapshot[sku]["state_hash"] != state_hash]
+    totals["unchanged"] += len(items) - len(changed)
+    if not changed:
+        return
+
+    # ID товаров WooCommerce берутся из снимка; новые и ранее не найденные SKU ищутся в WooCommerce
+    products: dict[str, tuple[int, int]] = {
+        sku: (snapshot[sku]["wc_product_id"], snapshot[sku]["wc_parent_id"])
+        for sku in changed if sku in snapshot and snapshot[sku]["wc_product_id"]
+    }
+    unknown = [sku for sku in changed if sku not in products]
+    if unknown:
+        found = await find_wc_products_by_sku(unknown)
+        products.update({sku: found[sku] for sku in unknown if sku in found})
+
+    entries: list[tuple[str, str, int | None, int]] = []
+    unmatched = [sku for sku in changed if sku not in products]
+    entries.extend((sku, items[sku][2], None, 0) for sku in unmatched)
+    totals["unmatched"] += len(unmatched)
+
+    # Простые товары - /products/batch, вариации - /products/{parent_id}/variations/batch
+    groups: dict[int, list[str]] = {}
+    for sku, (_, parent_id) in products.items():
+        groups.setdefault(parent_id, []).append(sku)
+    batches = [(parent_id, skus[start:start + WC_BATCH_SIZE])
+               for parent_id, skus in groups.items() for start in range(0, len(skus), WC_BATCH_SIZE)]
+
+    async def push(parent_id: int, skus: list[str]) -> dict[int, str | None]:
+        updates = [_wc_stock_update(products[sku][0], *items[sku][:2]) for sku in skus]
+        async with semaphore:
+            try:
+                return await update_wc_products_batch(updates, parent_id)
+            except Exception as e:
+                logger.error(f"WC products batch update of {len(updates)} SKUs failed: {e}")
+                return {update["id"]: str(e) for update in updates}
+
+    results = await asyncio.gather(*(push(parent_id, skus) for parent_id, skus in batches))
+    for (parent_id, skus), result in zip(batches, results):
+        for sku in skus:
+            product_id = products[sku][0]
+            error = result.get(product_id)
+            if error:
+                totals["failed"] += 1
+                logger.warning(f"Failed to update stock of WC product {product_id} (SKU: {sku}): {error}")
+            else:
+                totals["pushed"] += 1
+                entries.append((sku, items[sku][2], product_id, parent_id))
+    await upsert_catalog_snapshot(entries)
+
+@celery_app.task(name="sync_catalog_stock")
+@singleton("sync_catalog_stock", COALESCE)
+async def sync_catalog_stock_task(full: bool = False):
+    """Задача Celery: синхронизирует остатки (и цены продажи) МойСклад -> WooCommerce.
+    Отчет /report/stock/all читается постранично; пока обрабатывается страница, загружается следующая,
+    поэтому в памяти не больше двух страниц. В WooCommerce уходят только SKU, у которых хэш остатка и цены
+    отличается от снимка catalog_snapshot; full=True отправляет все SKU и заново ищет не найденные в WooCommerce.
+    """
+    logger.info(f"Starting sync_catalog_stock task (full={full})...")
+    totals = {"pushed": 0, "unchanged": 0, "unmatched": 0, "failed": 0}
+    semaphore = asyncio.Semaphore(CATALOG_WC_CONCURRENCY)
+    processing: asyncio.Task | None = None
+    try:
+        async for rows in iter_moysklad_rows("/report/stock/all", {"filter": "stockMode=all"}):
+            if processing is not None:
+                await processing
+            processing = asyncio.create_task(_sync_stock_page(rows, full, semaphore, totals))
+        if processing is not None:
+            await processing
+    finally:
+        if processing is not None and not processing.done():
+            processing.cancel()
+        for result, count in totals.items():
+            CATALOG_UPDATES.labels(result).inc(count)
+        logger.info(f"Catalog stock sync finished: {totals}")
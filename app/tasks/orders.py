@@ -1,14 +1,23 @@
 import json
+import asyncio
 import httpx # Используем httpx для асинхронных запросов
 import asyncpg
 import os
 import logging
 # Импортируем celery_app из модуля worker
 from app.worker import celery_app
-from app.db import get_connection # Импортируем функцию для получения соединения
+from app.metrics import ORDERS_SYNCED
+from app.tracing import tracer, record_error
+from app.logging_config import log_context, LOG_BODY_LIMIT
+from app.db import get_connection, save_to_pending, schedule_pending_retry, move_to_dead_letter, add_to_dead_letter, update_pending_metrics, MAX_RETRIES # Работа с БД и pending_sync
+from app.db import claim_order_sync, release_order_claims, record_ms_created, mark_orders_done, LEDGER_RECEIVED, LEDGER_MS_CREATED, LEDGER_DONE, LEDGER_CLAIM_TIMEOUT # Журнал идемпотентности
+from app.utils.http_client import get_moysklad_client # Общий HTTP клиент процесса
+from app.utils.rate_limit import get_retry_after
+from app.utils.moysklad import create_moysklad_orders, find_moysklad_orders_by_external_code, build_moysklad_order_payload
+from app.utils.woocommerce import get_wc_write_back_queue
+from app.utils.task_lock import singleton, SKIP # Один запуск периодической задачи во всех воркерах
 
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.INFO)
 
 # --- Константы и конфигурация ---
 MOYSKLAD_API_URL = os.getenv("MOYSKLAD_API_URL", "https://online.moysklad.ru/api/remap/1.2")
@@ -19,10 +28,22 @@ WC_API_URL = os.getenv("WC_API_URL") # Обязателен
 WC_CONSUMER_KEY = os.getenv("WC_CONSUMER_KEY") # Обязателен
 WC_CONSUMER_SECRET = os.getenv("WC_CONSUMER_SECRET") # Обязателен
 
-# Максимальное количество попыток повторной синхронизации
-MAX_RETRIES = 5
-# Таймаут для HTTP запросов
-HTTP_TIMEOUT = 15.0
+# Пакетная отправка заказов в МойСклад (API принимает до 1000 элементов в одном POST).
+# Пачки собираются только в app.order_worker, где в одном event loop обрабатываются сотни заказов одновременно
+# (в docker-compose флаг включен для сервиса order_worker). В Celery prefork процесс выполняет одну задачу за раз:
+# одиночный заказ уходит сразу, без ожидания окна.
+MS_BATCH_MAX_SIZE = 1000
+MS_BATCH_SIZE = max(1, min(int(os.getenv("MS_BATCH_SIZE", "100")), MS_BATCH_MAX_SIZE))
+MS_BATCH_WINDOW = float(os.getenv("MS_BATCH_WINDOW", "0.5")) # Сек. ожидания накопления пачки при конкурентных заказах
+MS_BATCH_ENABLED = os.getenv("MS_BATCH_ENABLED", "false").lower() in ("1", "true", "yes")
+# Пошаговый конвейер: создание в МойСклад и обновление WooCommerce - отдельные задачи (app.tasks.pipeline)
+ORDER_PIPELINE_ENABLED = os.getenv("ORDER_PIPELINE_ENABLED", "false").lower() in ("1", "true", "yes")
+
+# Повтор отложенных заказов (retry_pending_orders)
+RETRY_BATCH_SIZE = int(os.getenv("RETRY_BATCH_SIZE", "100")) # Сколько записей забирать за один запрос
+RETRY_CONCURRENCY = int(os.getenv("RETRY_CONCURRENCY", "10")) # Сколько заказов обрабатывать одновременно
+RETRY_TIME_BUDGET = float(os.getenv("RETRY_TIME_BUDGET", "240")) # Сек. на один запуск задачи
+RETRY_CLAIM_TIMEOUT = float(os.getenv("RETRY_CLAIM_TIMEOUT", "300")) # Сек., на которые забранная запись скрыта от других воркеров
 
 # --- Вспомогательные функции ---
 
@@ -37,29 +58,9 @@ def validate_moysklad_response(response_json: dict) -> bool:
         logger.error(f"Error validating Moysklad response: {e}", exc_info=True)
         return False
 
-async def save_to_pending(order_id: int, payload: dict, error: str = ""):
-    """Сохраняет заказ в таблицу отложенной синхронизации."""
-    try:
-        async with get_connection() as conn:
-            await conn.execute("""
-                INSERT INTO pending_sync (order_id, order_payload, error_message, last_attempt)
-                VALUES ($1, $2, $3, now())
-                ON CONFLICT (order_id) DO UPDATE SET -- Если заказ уже есть, обновляем ошибку и время
-                    order_payload = EXCLUDED.order_payload,
-                    error_message = EXCLUDED.error_message,
-                    last_attempt = now(),
-                    retry_count = pending_sync.retry_count + 1 -- Увеличиваем счетчик при перезаписи ошибки
-            """, order_id, json.dumps(payload), error)
-        logger.info(f"Order {order_id} saved/updated in pending_sync due to error: {error}")
-    except Exception as e:
-        logger.exception(f"Failed to save order {order_id} to pending_sync: {e}")
-
-
-async def update_wc_order_after_ms_sync(order_id: int, moysklad_uuid: str, moysklad_number: str) -> None:
-    """Обновляет номер заказа и метаданные в WooCommerce после успешной синхронизации с МойСклад."""
-    url = f"{WC_API_URL}/orders/{order_id}"
-    auth = (WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
-    payload = {
+def build_wc_sync_update(moysklad_uuid: str, moysklad_number: str) -> dict:
+    """Обновление заказа WooCommerce после создания заказа в МойСклад (без "id")."""
+    return {
         "number": moysklad_number, # Устанавливаем номер заказа WC равным номеру из МС
         "meta_data": [
             {"key": "_moysklad_uuid", "value": moysklad_uuid},
@@ -67,20 +68,185 @@ async def update_wc_order_after_ms_sync(order_id: int, moysklad_uuid: str, moysk
         ]
     }
 
-    async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-        response = await client.put(url, json=payload, auth=auth)
-        response.raise_for_status() # Вызовет исключение для HTTP ошибок 4xx/5xx
-    logger.info(f"WooCommerce order {order_id} updated with Moysklad number {moysklad_number} and UUID {moysklad_uuid}")
+async def update_wc_order_after_ms_sync(order_id: int, moysklad_uuid: str, moysklad_number: str) -> None:
+    """Обновляет номер заказа и метаданные в WooCommerce после успешной синхронизации с МойСклад.
+    Обновление уходит через пакетную очередь /orders/batch вместе с другими заказами процесса.
+    """
+    # Вызовет исключение при HTTP ошибке пакета или ошибке по этому заказу
+    await get_wc_write_back_queue().submit(order_id, build_wc_sync_update(moysklad_uuid, moysklad_number))
+    logger.info(f"WooCommerce order {order_id} updated with Moysklad number {moysklad_number} and UUID {moysklad_uuid}", extra={"sample": True})
 
 # --- Основная логика синхронизации (Асинхронная) ---
 
-async def _process_order(order_id: int, order_payload: dict):
-    """Асинхронно обрабатывает один заказ: отправляет в МойСклад и обновляет WooCommerce."""
-    if not MOYSKLAD_TOKEN or not WC_API_URL or not WC_CONSUMER_KEY or not WC_CONSUMER_SECRET:
-        logger.error("Missing required environment variables (MOYSKLAD_TOKEN, WC_API_URL, WC_CONSUMER_KEY, WC_CONSUMER_SECRET). Skipping order processing.")
-        # Возможно, стоит сохранить в pending, но с особой пометкой об ошибке конфигурации
-        await save_to_pending(order_id, order_payload, "Configuration Error: Missing API credentials or URLs.")
-        return # Прекращаем обработку этого заказа
+def _config_missing() -> bool:
+    return not MOYSKLAD_TOKEN or not WC_API_URL or not WC_CONSUMER_KEY or not WC_CONSUMER_SECRET
+
+def classify_error(exc: Exception) -> tuple[str, float | None]:
+    """Определяет класс ошибки для расчета задержки повтора: network, 5xx, 429, 4xx или other.
+    Для 429 также возвращает паузу из заголовков ответа.
+    """
+    if isinstance(exc, httpx.HTTPStatusError):
+        status = exc.response.status_code
+        if status == 429:
+            return "429", get_retry_after(exc.response)
+        if status >= 500:
+            return "5xx", None
+        if status >= 400:
+            return "4xx", None
+    if isinstance(exc, httpx.RequestError):
+        return "network", None
+    return "other", None
+
+async def _save_failed_order(order_id: int, order_payload: dict, exc: Exception):
+    """Логирует ошибку синхронизации заказа и сохраняет его в pending_sync с задержкой по классу ошибки."""
+    error_class, retry_after = classify_error(exc)
+    record_error(exc)
+    if isinstance(exc, httpx.HTTPStatusError):
+        error_body = exc.response.text[:LOG_BODY_LIMIT]
+        error_msg = f"HTTP error syncing order {order_id} to Moysklad/WooCommerce: {exc.request.url} - {exc.response.status_code} - Body: {error_body}"
+        logger.error(error_msg, exc_info=exc)
+        await save_to_pending(order_id, order_payload, f"HTTP Error: {exc.response.status_code}", error_class, retry_after)
+    elif isinstance(exc, httpx.RequestError):
+        error_msg = f"Network error syncing order {order_id}: {exc.request.url} - {exc}"
+        logger.error(error_msg, exc_info=exc)
+        await save_to_pending(order_id, order_payload, f"Network Error: {exc}", error_class)
+    else:
+        logger.error(f"Generic error syncing order {order_id}: {exc}", exc_info=exc)
+        await save_to_pending(order_id, order_payload, f"Unexpected Error: {str(exc)}", error_class)
+
+def _ms_payload(order_id: int, order_payload: dict) -> dict:
+    """Тело заказа для МойСклад с externalCode = ID заказа WC: по нему повторная попытка находит уже созданный заказ."""
+    return {**order_payload, "externalCode": str(order_id)}
+
+async def _resume_from_ledger(orders: list[tuple[int, dict]]) -> tuple[list[int], dict[int, tuple[str, str]], list[tuple[int, dict]], list[tuple[int, dict]]]:
+    """Определяет по журналу идемпотентности, с какого шага продолжать каждый заказ, и берет аренду попытки.
+    Возвращает (уже синхронизированные order_id, {order_id: (ms_uuid, ms_number)} уже созданных в МойСклад,
+    заказы для создания, заказы в обработке у другого воркера). Заказы, прошлая отправка которых завершилась
+    неизвестно чем (received), ищутся в МойСклад по externalCode одним запросом, чтобы не создать дубль.
+    """
+    ledger = await claim_order_sync([order_id for order_id, _ in orders])
+    done: list[int] = []
+    created: dict[int, tuple[str, str]] = {}
+    to_create: list[tuple[int, dict]] = []
+    unknown: list[tuple[int, dict]] = []
+    busy: list[tuple[int, dict]] = []
+    for order_id, order_payload in orders:
+        entry = ledger.get(order_id)
+        if entry is None:
+            # Аренда не истекла: заказ сейчас отправляет другой воркер
+            busy.append((order_id, order_payload))
+        elif entry["state"] == LEDGER_RECEIVED and entry["attempts"] <= 1:
+            to_create.append((order_id, order_payload))
+        elif entry["state"] == LEDGER_DONE:
+            done.append(order_id)
+        elif entry["state"] == LEDGER_MS_CREATED and entry["ms_uuid"]:
+            created[order_id] = (entry["ms_uuid"], entry["ms_number"])
+        else:
+            unknown.append((order_id, order_payload))
+
+    if unknown:
+        found = await find_moysklad_orders_by_external_code([str(order_id) for order_id, _ in unknown])
+        recovered = []
+        for order_id, order_payload in unknown:
+            data = found.get(str(order_id))
+            if data and validate_moysklad_response(data):
+                logger.info(f"Order {order_id} already exists in Moysklad (UUID: {data['id']}). Skipping creation.")
+                created[order_id] = (data["id"], data["name"])
+                recovered.append((order_id, data["id"], data["name"]))
+            else:
+                to_create.append((order_id, order_payload))
+        await record_ms_created(recovered)
+    return done, created, to_create, busy
+
+async def _defer_busy_order(order_id: int, order_payload: dict):
+    """Откладывает заказ, который обрабатывает другой воркер: повтор после истечения аренды проверит его по журналу
+    (успешный заказ будет пропущен, заказ упавшего воркера - продолжен с невыполненного шага).
+    """
+    logger.info(f"Order {order_id} is being synced by another worker (idempotency ledger lease). Deferring.")
+    await save_to_pending(order_id, order_payload, "In progress in another worker", retry_after=LEDGER_CLAIM_TIMEOUT)
+
+async def _release_claims(order_ids: list[int]):
+    """Снимает аренду с заказов после неуспешной попытки (они уже сохранены в pending_sync)."""
+    try:
+        await release_order_claims(order_ids)
+    except Exception as e:
+        logger.warning(f"Failed to release idempotency ledger lease of {len(order_ids)} orders (expires in {LEDGER_CLAIM_TIMEOUT:.0f}s): {e}")
+
+async def _update_wc_order(order_id: int, order_payload: dict, moysklad_uuid: str, moysklad_number: str, mark_done: bool = True) -> bool:
+    """Шаг WooCommerce для заказа, уже созданного в МойСклад.
+    Возвращает True при успехе, иначе сохраняет заказ в pending_sync (повтор начнется с этого шага) и возвращает False.
+    """
+    with log_context(order_id=order_id, ms_uuid=moysklad_uuid), \
+            tracer.start_as_current_span("update_wc_order", attributes={"order.id": order_id, "moysklad.uuid": moysklad_uuid}):
+        try:
+            # Обновляем заказ в WooCommerce
+            await update_wc_order_after_ms_sync(order_id, moysklad_uuid, moysklad_number)
+        except Exception as e:
+            await _save_failed_order(order_id, order_payload, e)
+            return False
+
+        if mark_done:
+            try:
+                await mark_orders_done([order_id])
+            except Exception as e:
+                logger.warning(f"Failed to mark order {order_id} as done in idempotency ledger: {e}")
+        logger.info(f"Successfully synced order {order_id} with Moysklad (UUID: {moysklad_uuid}, Number: {moysklad_number}) and updated WooCommerce.", extra={"sample": True})
+    ORDERS_SYNCED.inc()
+    return True
+
+async def _complete_order(order_id: int, order_payload: dict, data: dict) -> bool:
+    """Проверяет ответ МойСклад по заказу, записывает созданный заказ в журнал и обновляет заказ в WooCommerce.
+    Возвращает True при успехе, иначе сохраняет заказ в pending_sync и возвращает False.
+    """
+    if not validate_moysklad_response(data):
+        error_msg = f"Invalid response format from Moysklad for order {order_id}: {str(data)[:LOG_BODY_LIMIT]}"
+        logger.error(error_msg)
+        await save_to_pending(order_id, order_payload, "Invalid API response format")
+        return False
+
+    moysklad_uuid = data["id"]
+    moysklad_number = data["name"]
+    try:
+        await record_ms_created([(order_id, moysklad_uuid, moysklad_number)])
+    except Exception as e:
+        # Не критично: повторная попытка найдет заказ в МойСклад по externalCode
+        logger.warning(f"Failed to record Moysklad order {moysklad_uuid} for order {order_id} in idempotency ledger: {e}")
+    return await _update_wc_order(order_id, order_payload, moysklad_uuid, moysklad_number)
+
+async def _process_order(order_id: int, order_payload: dict) -> bool:
+    """Асинхронно обрабатывает один заказ: отправляет в МойСклад и обновляет WooCommerce.
+    Повторная попытка продолжает с невыполненного шага (журнал order_sync_ledger), не создавая дубль в МойСклад.
+    Возвращает True, если заказ полностью синхронизирован.
+    """
+    with log_context(order_id=order_id), tracer.start_as_current_span("process_order", attributes={"order.id": order_id}):
+        if _config_missing():
+            logger.error("Missing required environment variables (MOYSKLAD_TOKEN, WC_API_URL, WC_CONSUMER_KEY, WC_CONSUMER_SECRET). Skipping order processing.")
+            # Возможно, стоит сохранить в pending, но с особой пометкой об ошибке конфигурации
+            await save_to_pending(order_id, order_payload, "Configuration Error: Missing API credentials or URLs.")
+            return False # Прекращаем обработку этого заказа
+
+        try:
+            done, created, _, busy = await _resume_from_ledger([(order_id, order_payload)])
+        except Exception as e:
+            await _save_failed_order(order_id, order_payload, e)
+            return False
+        if busy:
+            await _defer_busy_order(order_id, order_payload)
+            return False
+        ok = await _process_claimed_order(order_id, order_payload, done, created)
+        if not ok:
+            await _release_claims([order_id])
+        return ok
+
+async def _process_claimed_order(order_id: int, order_payload: dict, done: list[int], created: dict[int, tuple[str, str]]) -> bool:
+    """Выполняет невыполненные шаги заказа, на который взята аренда в журнале."""
+    if done:
+        logger.info(f"Order {order_id} is already synced (idempotency ledger). Skipping.")
+        return True
+    if order_id in created:
+        moysklad_uuid, moysklad_number = created[order_id]
+        logger.info(f"Order {order_id} already created in Moysklad (UUID: {moysklad_uuid}). Resuming at WooCommerce update.")
+        return await _update_wc_order(order_id, order_payload, moysklad_uuid, moysklad_number)
 
     headers = {
         "Authorization": f"Bearer {MOYSKLAD_TOKEN}",
@@ -90,56 +256,273 @@ async def _process_order(order_id: int, order_payload: dict):
     ms_url = f"{MOYSKLAD_API_URL}/entity/customerorder"
 
     try:
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-            logger.info(f"Sending order {order_id} to Moysklad...")
-            response = await client.post(ms_url, json=order_payload, headers=headers)
-            response.raise_for_status() # Проверка на HTTP ошибки
-
+        client = get_moysklad_client()
+        logger.info(f"Sending order {order_id} to Moysklad...", extra={"sample": True})
+        response = await client.post(ms_url, json=_ms_payload(order_id, order_payload), headers=headers)
+        response.raise_for_status() # Проверка на HTTP ошибки
         data = response.json()
-
-        if not validate_moysklad_response(data):
-            error_msg = f"Invalid response format from Moysklad for order {order_id}: {data}"
-            logger.error(error_msg)
-            await save_to_pending(order_id, order_payload, "Invalid API response format")
-            return
-
-        moysklad_uuid = data["id"]
-        moysklad_number = data["name"]
-
-        # Обновляем заказ в WooCommerce
-        await update_wc_order_after_ms_sync(order_id, moysklad_uuid, moysklad_number)
-
-        logger.info(f"Successfully synced order {order_id} with Moysklad (UUID: {moysklad_uuid}, Number: {moysklad_number}) and updated WooCommerce.")
-
-    except httpx.HTTPStatusError as e:
-        error_body = e.response.text
-        error_msg = f"HTTP error syncing order {order_id} to Moysklad/WooCommerce: {e.request.url} - {e.response.status_code} - Body: {error_body}"
-        logger.error(error_msg, exc_info=True)
-        await save_to_pending(order_id, order_payload, f"HTTP Error: {e.response.status_code}")
-    except httpx.RequestError as e:
-        error_msg = f"Network error syncing order {order_id}: {e.request.url} - {e}"
-        logger.error(error_msg, exc_info=True)
-        await save_to_pending(order_id, order_payload, f"Network Error: {e}")
     except Exception as e:
-        logger.exception(f"Generic error syncing order {order_id}: {e}")
-        await save_to_pending(order_id, order_payload, f"Unexpected Error: {str(e)}")
+        await _save_failed_order(order_id, order_payload, e)
+        return False
 
+    return await _complete_order(order_id, order_payload, data)
+
+def _format_ms_errors(result: dict) -> str:
+    """Собирает текст ошибок МойСклад для одного элемента пакетного ответа."""
+    errors = result.get("errors") or []
+    messages = [err.get("error", "") for err in errors if isinstance(err, dict)]
+    return "; ".join(m for m in messages if m) or "Unknown error"
+
+async def _process_orders_batch(orders: list[tuple[int, dict]]) -> dict[int, bool]:
+    """Отправляет пачку заказов в МойСклад одним запросом на каждые MS_BATCH_SIZE заказов.
+    Результат каждого элемента сопоставляется с order_id WooCommerce; в pending_sync попадают только неуспешные заказы.
+    Возвращает словарь order_id -> True/False.
+    """
+    results: dict[int, bool] = {}
+    if not orders:
+        return results
+
+    if _config_missing():
+        logger.error("Missing required environment variables (MOYSKLAD_TOKEN, WC_API_URL, WC_CONSUMER_KEY, WC_CONSUMER_SECRET). Skipping batch processing.")
+        for order_id, order_payload in orders:
+            await save_to_pending(order_id, order_payload, "Configuration Error: Missing API credentials or URLs.")
+            results[order_id] = False
+        return results
+
+    for start in range(0, len(orders), MS_BATCH_SIZE):
+        chunk = orders[start:start + MS_BATCH_SIZE]
+        try:
+            done, created, to_create, busy = await _resume_from_ledger(chunk)
+        except Exception as e:
+            logger.error(f"Failed to check idempotency ledger for batch of {len(chunk)} orders: {e}")
+            for order_id, order_payload in chunk:
+                await _save_failed_order(order_id, order_payload, e)
+                results[order_id] = False
+            continue
+        for order_id in done:
+            results[order_id] = True
+        for order_id, order_payload in busy:
+            await _defer_busy_order(order_id, order_payload)
+            results[order_id] = False
+        busy_ids = {order_id for order_id, _ in busy}
+
+        ms_results: list = []
+        if to_create:
+            try:
+                with tracer.start_as_current_span("create_moysklad_orders", attributes={"orders.count": len(to_create)}):
+                    ms_results = await create_moysklad_orders([_ms_payload(order_id, payload) for order_id, payload in to_create])
+            except Exception as e:
+                # Весь запрос не прошел - все заказы пачки уходят в pending_sync
+                logger.error(f"Batch of {len(to_create)} orders failed to reach Moysklad: {e}")
+                for order_id, order_payload in to_create:
+                    await _save_failed_order(order_id, order_payload, e)
+                    results[order_id] = False
+                to_create = []
+
+        new_entries = []
+        for (order_id, order_payload), data in zip(to_create, ms_results):
+            if isinstance(data, dict) and "errors" in data:
+                error_msg = _format_ms_errors(data)
+                logger.error(f"Moysklad rejected order {order_id} in batch: {error_msg}")
+                await save_to_pending(order_id, order_payload, f"Moysklad Error: {error_msg}", "4xx")
+                results[order_id] = False
+            elif not validate_moysklad_response(data):
+                logger.error(f"Invalid response format from Moysklad for order {order_id}: {str(data)[:LOG_BODY_LIMIT]}")
+                await save_to_pending(order_id, order_payload, "Invalid API response format")
+                results[order_id] = False
+            else:
+                created[order_id] = (data["id"], data["name"])
+                new_entries.append((order_id, data["id"], data["name"]))
+        try:
+            await record_ms_created(new_entries)
+        except Exception as e:
+            logger.warning(f"Failed to record {len(new_entries)} Moysklad orders in idempotency ledger: {e}")
+
+        # Обновления в WooCommerce выполняем параллельно
+        payloads = dict(chunk)
+        completions = [
+            (order_id, _update_wc_order(order_id, payloads[order_id], moysklad_uuid, moysklad_number, mark_done=False))
+            for order_id, (moysklad_uuid, moysklad_number) in created.items()
+        ]
+        updated = await asyncio.gather(*(coro for _, coro in completions))
+        for (order_id, _), ok in zip(completions, updated):
+            results[order_id] = ok
+        try:
+            await mark_orders_done([order_id for (order_id, _), ok in zip(completions, updated) if ok])
+        except Exception as e:
+            logger.warning(f"Failed to mark batch orders as done in idempotency ledger: {e}")
+        # Аренду заказов, которые обрабатывает другой воркер, не трогаем
+        await _release_claims([order_id for order_id, _ in chunk if order_id not in busy_ids and not results.get(order_id)])
+
+    synced = sum(1 for ok in results.values() if ok)
+    logger.info(f"Batch processed: {synced}/{len(orders)} orders synced.")
+    return results
+
+
+class OrderBatcher:
+    """Накапливает заказы и отправляет их в МойСклад пачкой по размеру (max_size) или по истечении окна (window сек.).
+    Если заказ в буфере один и пачек в полете нет, других отправителей в процессе нет - он уходит сразу.
+    """
+
+    def __init__(self, max_size: int = MS_BATCH_SIZE, window: float = MS_BATCH_WINDOW):
+        self.max_size = max_size
+        self.window = window
+        self._buffer: list[tuple[int, dict, asyncio.Future]] = []
+        self._timer: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+    async def submit(self, order_id: int, order_payload: dict) -> bool:
+        """Добавляет заказ в текущую пачку и ждет результата его синхронизации."""
+        future = asyncio.get_running_loop().create_future()
+        self._buffer.append((order_id, order_payload, future))
+        if len(self._buffer) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        return await future
+
+    async def _flush_later(self):
+        # Первый шаг таймера выполняется после уже запущенных конкурентных submit (они успевают попасть в буфер)
+        await asyncio.sleep(0)
+        if len(self._buffer) > 1 or self._inflight:
+            await asyncio.sleep(self.window)
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._buffer:
+            return
+        batch, self._buffer = self._buffer, []
+        task = asyncio.create_task(self._send(batch))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, batch: list[tuple[int, dict, asyncio.Future]]):
+        try:
+            results = await _process_orders_batch([(order_id, payload) for order_id, payload, _ in batch])
+        except Exception as e:
+            logger.exception(f"Order batch of {len(batch)} failed: {e}")
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for order_id, _, future in batch:
+            if not future.done():
+                future.set_result(results.get(order_id, False))
+
+    async def drain(self):
+        """Отправляет накопленные заказы и дожидается всех пачек в полете."""
+        self._flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+_order_batcher: OrderBatcher | None = None
+
+def get_order_batcher() -> OrderBatcher:
+    """Возвращает батчер заказов текущего процесса (создается лениво внутри event loop)."""
+    global _order_batcher
+    if _order_batcher is None:
+        _order_batcher = OrderBatcher()
+    return _order_batcher
+
+
+async def _sync_order(order_id: int, order_payload: dict) -> bool:
+    """Синхронизирует заказ: через пошаговый конвейер, пакетную отправку (если включены) или отдельным запросом.
+    В режиме конвейера True означает, что заказ принят (записан в журнал); дальше его шаги ведет app.tasks.pipeline.
+    """
+    if ORDER_PIPELINE_ENABLED:
+        from app.tasks.pipeline import submit_orders_to_pipeline # Импорт здесь: pipeline импортирует этот модуль
+        await submit_orders_to_pipeline([(order_id, order_payload)])
+        return True
+    if MS_BATCH_ENABLED:
+        # Заказ уходит в МойСклад в составе пачки вместе с другими заказами процесса
+        return await get_order_batcher().submit(order_id, order_payload)
+    return await _process_order(order_id, order_payload)
+
+# Классы ошибок сборки заказа, которые имеет смысл повторить позже
+TRANSIENT_ERROR_CLASSES = ("network", "5xx", "429")
+
+async def _sync_wc_order(order_id: int, order: dict, final_attempt: bool = True) -> bool:
+    """Синхронизирует заказ WooCommerce из вебхука: собирает тело заказа МойСклад (кэш ms_resolver) и передает в _sync_order.
+    Временные ошибки сборки (сеть, 5xx, 429) пробрасываются для повтора задачи, пока final_attempt не True;
+    остальные ошибки и ошибка последней попытки переносят заказ WooCommerce в dead_letter_sync.
+    """
+    with log_context(order_id=order_id):
+        try:
+            order_payload = await build_moysklad_order_payload(order)
+        except Exception as e:
+            error_class, _ = classify_error(e)
+            if error_class in TRANSIENT_ERROR_CLASSES and not final_attempt:
+                raise
+            record_error(e)
+            logger.error(f"Failed to build Moysklad payload for order {order_id}. Moving to dead letter queue: {e}", exc_info=e)
+            await add_to_dead_letter(order_id, order, f"Payload Build Error: {type(e).__name__}: {str(e)[:LOG_BODY_LIMIT]}")
+            return False
+    return await _sync_order(order_id, order_payload)
+
+# Частые запросы держим постоянным текстом: asyncpg подготавливает их один раз на соединение (statement cache)
+_CLAIM_PENDING_SQL = """
+    UPDATE pending_sync
+    SET last_attempt = now(),
+        next_attempt_at = now() + make_interval(secs => $3)
+    WHERE id IN (
+        SELECT id FROM pending_sync
+        WHERE next_attempt_at <= now() AND retry_count < $1
+        ORDER BY next_attempt_at ASC -- Обрабатываем сначала просроченные
+        LIMIT $2
+        FOR UPDATE SKIP LOCKED
+    )
+    RETURNING id, order_id, order_payload, retry_count, error_message
+"""
+_DELETE_PENDING_SQL = "DELETE FROM pending_sync WHERE id = $1"
+
+async def _claim_pending_rows(limit: int) -> list[asyncpg.Record]:
+    """Забирает до limit записей pending_sync, у которых подошло время следующей попытки (next_attempt_at).
+    Выборка идет по частичному индексу pending_sync_next_attempt_idx. FOR UPDATE SKIP LOCKED пропускает строки,
+    которые забирает другой воркер, а сдвиг next_attempt_at на RETRY_CLAIM_TIMEOUT исключает забранные строки
+    из выборки до завершения попытки. Блокировка держится только на время UPDATE.
+    """
+    async with get_connection() as conn:
+        return await conn.fetch(_CLAIM_PENDING_SQL, MAX_RETRIES, limit, RETRY_CLAIM_TIMEOUT)
+
+async def _retry_pending_row(row: asyncpg.Record, semaphore: asyncio.Semaphore) -> bool:
+    """Повторяет синхронизацию одной записи pending_sync. Соединение с БД не удерживается во время HTTP запросов."""
+    order_id = row["order_id"]
+    pending_id = row["id"]
 
-async def move_to_dead_letter(conn: asyncpg.Connection, row: asyncpg.Record):
-    """Перемещает запись из pending_sync в dead_letter_sync."""
-    logger.warning(f"Order {row['order_id']} (pending_id: {row['id']}) reached max retries ({MAX_RETRIES}). Moving to dead letter queue.")
     try:
-        await conn.execute("""
-            INSERT INTO dead_letter_sync (original_pending_id, order_id, order_payload, final_error_message, failed_at)
-            VALUES ($1, $2, $3, $4, now())
-        """, row['id'], row['order_id'], row['order_payload'], row['error_message'])
+        order_payload_dict = json.loads(row["order_payload"])
+    except json.JSONDecodeError:
+        logger.error(f"Failed to decode JSON payload for pending sync record id {pending_id}, order_id {order_id}. Moving to dead letter queue.")
+        # Перемещаем некорректный JSON сразу в dead letter
+        try:
+            async with get_connection() as conn:
+                await move_to_dead_letter(conn, [pending_id])
+        except Exception as e:
+            logger.exception(f"Failed to move order {order_id} to dead_letter_sync for pending_id {pending_id}: {e}")
+        return False
 
-        await conn.execute("DELETE FROM pending_sync WHERE id = $1", row["id"])
-        logger.info(f"Order {row['order_id']} moved to dead_letter_sync and removed from pending_sync.")
-    except Exception as e:
-        logger.exception(f"Failed to move order {row['order_id']} to dead_letter_sync for pending_id {row['id']}: {e}")
-        # Важно: если перемещение не удалось, запись остается в pending_sync,
-        # но может быть выбрана снова. Рассмотреть добавление флага is_dead или другой механизм.
+    async with semaphore:
+        logger.info(f"Retrying order {order_id} (Attempt: {row['retry_count'] + 1})")
+        try:
+            ok = await _sync_order(order_id, order_payload_dict)
+        except Exception as e:
+            # Ошибка до сохранения в pending_sync - обновляем счетчик здесь
+            error_msg = f"Retry attempt failed for order {order_id} (in retry task): {str(e)}"
+            logger.error(error_msg)
+            async with get_connection() as conn:
+                await schedule_pending_retry(conn, pending_id, error_msg, *classify_error(e))
+            return False
+
+    if ok:
+        # Если успешно, удаляем из очереди (неуспешные уже сохранены в pending_sync с новой ошибкой)
+        async with get_connection() as conn:
+            await conn.execute(_DELETE_PENDING_SQL, pending_id)
+        logger.info(f"Order {order_id} retried successfully and removed from pending_sync")
+    return ok
 
 # --- Задачи Celery ---
 
@@ -147,77 +530,67 @@ async def move_to_dead_letter(conn: asyncpg.Connection, row: asyncpg.Record):
 async def process_order_task(self, order_id: int, order_payload: dict):
     """Задача Celery для асинхронной обработки заказа."""
     try:
-        await _process_order(order_id, order_payload)
+        await _sync_order(order_id, order_payload)
     except Exception as exc:
          # Используем механизм ретраев Celery для временных ошибок
         logger.warning(f"Retrying task for order {order_id} due to exception: {exc}")
         raise self.retry(exc=exc)
 
 
+@celery_app.task(name="process_wc_order", bind=True, max_retries=3, default_retry_delay=60)
+async def process_wc_order_task(self, order_id: int, order: dict):
+    """Задача Celery для заказа WooCommerce из вебхука: тело заказа МойСклад собирается в воркере, а не при приеме вебхука."""
+    try:
+        await _sync_wc_order(order_id, order, final_attempt=self.request.retries >= self.max_retries)
+    except Exception as exc:
+        logger.warning(f"Retrying task for order {order_id} due to exception: {exc}")
+        raise self.retry(exc=exc)
+
+
 @celery_app.task(name="retry_pending_orders")
+@singleton("retry_pending_orders", SKIP)
 async def retry_pending_orders_task():
-    """Задача Celery для повторной попытки синхронизации отложенных заказов."""
+    """Задача Celery для повторной попытки синхронизации отложенных заказов.
+    Забирает записи пачками через FOR UPDATE SKIP LOCKED (несколько воркеров могут разбирать очередь параллельно),
+    обрабатывает их конкурентно (не более RETRY_CONCURRENCY одновременно) и продолжает,
+    пока очередь не опустеет или не истечет RETRY_TIME_BUDGET секунд.
+    """
     logger.info("Running retry_pending_orders task")
-    processed_ids = set() # Отслеживаем ID, обработанные в этом запуске
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + RETRY_TIME_BUDGET
+    semaphore = asyncio.Semaphore(RETRY_CONCURRENCY)
+    total = synced = 0
 
     try:
-        async with get_connection() as conn: # Используем пул
-            retry_rows = await conn.fetch("""
-                SELECT id, order_id, order_payload, retry_count
-                FROM pending_sync
-                WHERE retry_count < $1
-                ORDER BY last_attempt ASC -- Обрабатываем сначала старые
-                LIMIT 20 -- Обрабатываем пачками
-            """, MAX_RETRIES)
-
-            if not retry_rows:
-                logger.info("No pending orders to retry.")
-            else:
-                logger.info(f"Found {len(retry_rows)} pending orders to retry.")
-
-                for row in retry_rows:
-                    order_id = row["order_id"]
-                    pending_id = row["id"]
-                    processed_ids.add(pending_id) # Добавляем ID в обработанные
-
-                    try:
-                        order_payload_dict = json.loads(row["order_payload"])
-                    except json.JSONDecodeError:
-                        logger.error(f"Failed to decode JSON payload for pending sync record id {pending_id}, order_id {order_id}. Moving to dead letter queue.")
-                        # Перемещаем некорректный JSON сразу в dead letter
-                        await move_to_dead_letter(conn, row)
-                        continue
-
-                    try:
-                        logger.info(f"Retrying order {order_id} (Attempt: {row['retry_count'] + 1})")
-                        await _process_order(order_id, order_payload_dict)
-                        # Если успешно, удаляем из очереди
-                        await conn.execute("DELETE FROM pending_sync WHERE id = $1", pending_id)
-                        logger.info(f"Order {order_id} retried successfully and removed from pending_sync")
-                    except Exception as e:
-                        # Ошибка при ретрае, _process_order должен был сохранить ошибку в pending_sync.
-                        # Обновляем счетчик здесь на всякий случай, если _process_order упал до save_to_pending
-                        error_msg = f"Retry attempt failed for order {order_id} (in retry task): {str(e)}"
-                        logger.error(error_msg)
-                        await conn.execute("""
-                            UPDATE pending_sync
-                            SET retry_count = retry_count + 1,
-                                last_attempt = now(),
-                                error_message = $1
-                            WHERE id = $2
-                        """, error_msg, pending_id)
-
-            # 2. Обрабатываем заказы, достигшие лимита ретраев (уже или после неудачной попытки выше)
-            dead_letter_rows = await conn.fetch("""
-                SELECT id, order_id, order_payload, retry_count, error_message
-                FROM pending_sync
-                WHERE retry_count >= $1
-                LIMIT 50 -- Обрабатываем пачками
-            """, MAX_RETRIES)
-
-            for row in dead_letter_rows:
-                if row['id'] not in processed_ids: # Проверяем, не обработали ли уже в этом запуске
-                    await move_to_dead_letter(conn, row)
+        while loop.time() < deadline:
+            rows = await _claim_pending_rows(RETRY_BATCH_SIZE)
+            if not rows:
+                break
+            logger.info(f"Claimed {len(rows)} pending orders to retry.")
+            results = await asyncio.gather(*(_retry_pending_row(row, semaphore) for row in rows))
+            total += len(rows)
+            synced += sum(1 for ok in results if ok)
+
+        if total:
+            logger.info(f"Retried {total} pending orders, {synced} synced successfully.")
+        else:
+            logger.info("No pending orders to retry.")
+
+        # Переносим заказы, достигшие лимита ретраев, пачками (каждая пачка - один атомарный запрос)
+        moved_total = 0
+        while True:
+            async with get_connection() as conn:
+                moved = await move_to_dead_letter(conn)
+            for row in moved:
+                logger.warning(f"Order {row['order_id']} (pending_id: {row['original_pending_id']}) reached max retries ({MAX_RETRIES}). Moved to dead letter queue.")
+            moved_total += len(moved)
+            if not moved or loop.time() >= deadline:
+                break
+        if moved_total:
+            logger.info(f"Moved {moved_total} orders to dead_letter_sync.")
+
+        async with get_connection() as conn:
+            await update_pending_metrics(conn)
 
     except Exception as e:
-         logger.exception(f"Retry task failed globally: {e}") 
\ No newline at end of file
+         logger.exception(f"Retry task failed globally: {e}")
@@ -0,0 +1,204 @@
+# tasks/pipeline.py
+"""Пошаговый конвейер синхронизации заказов с состоянием в order_sync_ledger.
+
+received -> ms_created -> wc_updated -> done. Каждый шаг - отдельная задача Celery, которая забирает готовые заказы
+своего шага пачками (FOR UPDATE SKIP LOCKED) и повторяет только свой шаг с задержкой по классу ошибки.
+Медленный WooCommerce не задерживает создание заказов в МойСклад: шаги работают независимо и параллельно.
+Включается ORDER_PIPELINE_ENABLED (см. app.tasks.orders._sync_order).
+"""
+import asyncio
+import json
+import os
+import logging
+import time
+
+from app.worker import celery_app
+from app.metrics import ORDERS_SYNCED
+from app.tracing import tracer, record_error
+from app.logging_config import LOG_BODY_LIMIT
+from app.db import (
+    record_received_orders, claim_pipeline_step, advance_pipeline, fail_pipeline_step, record_ms_created,
+    finalize_pipeline_orders, move_failed_pipeline_orders, get_due_pipeline_steps,
+    LEDGER_RECEIVED, LEDGER_MS_CREATED, LEDGER_WC_UPDATED,
+)
+from app.utils.moysklad import create_moysklad_orders, find_moysklad_orders_by_external_code
+from app.utils.woocommerce import update_wc_orders_batch, WC_BATCH_SIZE
+from app.utils.task_lock import singleton, SKIP
+from app.tasks.orders import (
+    build_wc_sync_update, validate_moysklad_response, classify_error, _ms_payload, _format_ms_errors, _config_missing,
+    MS_BATCH_SIZE,
+)
+
+logger = logging.getLogger(__name__)
+
+PIPELINE_CLAIM_TIMEOUT = float(os.getenv("PIPELINE_CLAIM_TIMEOUT", "300")) # Сек., на которые забранный заказ скрыт от других воркеров
+PIPELINE_TIME_BUDGET = float(os.getenv("PIPELINE_TIME_BUDGET", "240")) # Сек. на один запуск задачи шага
+PIPELINE_KICK_DELAY = float(os.getenv("PIPELINE_KICK_DELAY", "0.5")) # Сек. накопления заказов перед запуском шага
+
+# --- Запуск задач шагов ---
+
+_kick_at: dict[str, float] = {} # имя задачи -> время, когда запланированная задача начнет выборку
+
+async def _kick(task):
+    """Ставит задачу шага в очередь с задержкой PIPELINE_KICK_DELAY. Пока запланированная задача не стартовала,
+    повторные вызовы в процессе пропускаются: она и так заберет все заказы, готовые к моменту старта.
+    """
+    now = time.monotonic()
+    if _kick_at.get(task.name, 0.0) > now:
+        return
+    _kick_at[task.name] = now + PIPELINE_KICK_DELAY
+    try:
+        await asyncio.to_thread(task.apply_async, countdown=PIPELINE_KICK_DELAY)
+    except Exception as e:
+        # Заказы останутся в журнале: их подберет order_pipeline_sweep
+        _kick_at.pop(task.name, None)
+        logger.warning(f"Failed to enqueue pipeline task {task.name}: {e}")
+
+async def submit_orders_to_pipeline(orders: list[tuple[int, dict]]):
+    """Записывает заказы в журнал (received) и запускает шаг создания в МойСклад. Ошибки записи в БД пробрасываются."""
+    await record_received_orders(orders)
+    await _kick(create_ms_orders_task)
+
+async def _run_step(state: str, handler, batch_size: int) -> tuple[int, bool]:
+    """Забирает заказы шага state пачками по batch_size и обрабатывает их, пока шаг не опустеет
+    или не истечет PIPELINE_TIME_BUDGET. Возвращает (количество обработанных заказов, истек ли бюджет времени).
+    """
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + PIPELINE_TIME_BUDGET
+    processed = 0
+    while True:
+        rows = await claim_pipeline_step(state, batch_size, PIPELINE_CLAIM_TIMEOUT)
+        if not rows:
+            return processed, False
+        await handler(rows)
+        processed += len(rows)
+        if loop.time() >= deadline:
+            logger.info(f"Pipeline step '{state}' time budget exhausted after {processed} orders, continuing in a new task.")
+            return processed, True
+
+async def _fail_rows(rows, exc: Exception):
+    """Планирует повтор шага для всех заказов пачки после ошибки запроса целиком."""
+    error_class, retry_after = classify_error(exc)
+    record_error(exc)
+    error = f"{type(exc).__name__}: {str(exc)[:LOG_BODY_LIMIT]}"
+    await fail_pipeline_step([(row["wc_order_id"], error) for row in rows], error_class, retry_after)
+
+# --- Шаги ---
+
+async def _step_create_ms(rows):
+    """received -> ms_created: один POST массива в МойСклад на пачку.
+    Заказы, которые уже забирались раньше (step_claims > 1, в том числе воркером, упавшим после отправки),
+    сначала ищутся по externalCode: результат той отправки неизвестен.
+    """
+    created: list[tuple[int, str, str]] = []
+    failures: list[tuple[int, str]] = []
+    to_create: list[tuple[int, dict]] = []
+    try:
+        retried = [str(row["wc_order_id"]) for row in rows if row["step_claims"] > 1]
+        found = await find_moysklad_orders_by_external_code(retried) if retried else {}
+    except Exception as e:
+        logger.error(f"Failed to look up {len(rows)} orders in Moysklad by externalCode: {e}")
+        await _fail_rows(rows, e)
+        return
+    for row in rows:
+        order_id = row["wc_order_id"]
+        data = found.get(str(order_id))
+        if data and validate_moysklad_response(data):
+            created.append((order_id, data["id"], data["name"]))
+            continue
+        try:
+            to_create.append((order_id, json.loads(row["order_payload"])))
+        except (TypeError, json.JSONDecodeError):
+            failures.append((order_id, "Invalid order payload"))
+
+    if to_create:
+        try:
+            with tracer.start_as_current_span("create_moysklad_orders", attributes={"orders.count": len(to_create)}):
+                results = await create_moysklad_orders([_ms_payload(order_id, payload) for order_id, payload in to_create])
+        except Exception as e:
+            logger.error(f"Batch of {len(to_create)} orders failed to reach Moysklad: {e}")
+            sent = {order_id for order_id, _ in to_create}
+            await _fail_rows([row for row in rows if row["wc_order_id"] in sent], e)
+            to_create, results = [], []
+        for (order_id, _), data in zip(to_create, results):
+            if isinstance(data, dict) and "errors" in data:
+                failures.append((order_id, f"Moysklad Error: {_format_ms_errors(data)}"))
+            elif not validate_moysklad_response(data):
+                failures.append((order_id, f"Invalid API response format: {str(data)[:LOG_BODY_LIMIT]}"))
+            else:
+                created.append((order_id, data["id"], data["name"]))
+
+    for order_id, error in failures:
+        logger.error(f"Moysklad step failed for order {order_id}: {error}")
+    await fail_pipeline_step(failures, "4xx")
+    await record_ms_created(created)
+    logger.info(f"Pipeline: {len(created)}/{len(rows)} orders created in Moysklad.")
+    if created:
+        await _kick(update_wc_orders_task)
+
+async def _step_update_wc(rows):
+    """ms_created -> wc_updated: один POST /orders/batch на пачку до WC_BATCH_SIZE заказов."""
+    updates = [{"id": row["wc_order_id"], **build_wc_sync_update(row["ms_uuid"], row["ms_number"])} for row in rows]
+    try:
+        with tracer.start_as_current_span("update_wc_orders", attributes={"orders.count": len(updates)}):
+            results = await update_wc_orders_batch(updates)
+    except Exception as e:
+        logger.error(f"Batch of {len(updates)} orders failed to reach WooCommerce: {e}")
+        await _fail_rows(rows, e)
+        return
+    updated = [order_id for order_id, error in results.items() if error is None]
+    failures = [(order_id, f"WooCommerce Error: {error}") for order_id, error in results.items() if error is not None]
+    await advance_pipeline(updated, LEDGER_WC_UPDATED)
+    await fail_pipeline_step(failures, "4xx")
+    if updated:
+        await _kick(finalize_orders_task)
+
+async def _step_finalize(rows):
+    """wc_updated -> done: закрытие заказов в журнале и очистка pending_sync одной транзакцией."""
+    done = await finalize_pipeline_orders([row["wc_order_id"] for row in rows])
+    ORDERS_SYNCED.inc(done)
+    logger.info(f"Pipeline: {done} orders fully synced.")
+
+# --- Задачи Celery ---
+
+async def _run_step_task(task, state: str, handler, batch_size: int):
+    if state != LEDGER_WC_UPDATED and _config_missing():
+        logger.error("Missing required environment variables (MOYSKLAD_TOKEN, WC_API_URL, WC_CONSUMER_KEY, WC_CONSUMER_SECRET). Skipping pipeline step.")
+        return
+    _, exhausted = await _run_step(state, handler, batch_size)
+    if exhausted:
+        # Бюджет времени исчерпан, а заказы шага еще есть - продолжаем в новой задаче
+        await _kick(task)
+
+@celery_app.task(name="order_pipeline_create_ms")
+async def create_ms_orders_task():
+    """Шаг конвейера: создание заказов в МойСклад."""
+    await _run_step_task(create_ms_orders_task, LEDGER_RECEIVED, _step_create_ms, MS_BATCH_SIZE)
+
+@celery_app.task(name="order_pipeline_update_wc")
+async def update_wc_orders_task():
+    """Шаг конвейера: запись номера и UUID МойСклад в заказы WooCommerce."""
+    await _run_step_task(update_wc_orders_task, LEDGER_MS_CREATED, _step_update_wc, WC_BATCH_SIZE)
+
+@celery_app.task(name="order_pipeline_finalize")
+async def finalize_orders_task():
+    """Шаг конвейера: завершение синхронизированных заказов."""
+    await _run_step_task(finalize_orders_task, LEDGER_WC_UPDATED, _step_finalize, 1000)
+
+_STEP_TASKS = {
+    LEDGER_RECEIVED: create_ms_orders_task,
+    LEDGER_MS_CREATED: update_wc_orders_task,
+    LEDGER_WC_UPDATED: finalize_orders_task,
+}
+
+@celery_app.task(name="order_pipeline_sweep")
+@singleton("order_pipeline_sweep", SKIP)
+async def sweep_pipeline_task():
+    """Периодическая задача: переносит заказы, исчерпавшие попытки шага, в dead_letter_sync
+    и запускает шаги, у которых подошло время повторов (отложенные попытки и истекшие аренды).
+    """
+    moved = await move_failed_pipeline_orders()
+    if moved:
+        logger.warning(f"Moved {len(moved)} pipeline orders to dead_letter_sync after exhausting retries.")
+    for state in await get_due_pipeline_steps():
+        await _kick(_STEP_TASKS[state])
@@ -1,34 +1,46 @@
 # tasks/status_sync.py
 
+import asyncio
 import asyncpg
 import os
 import logging
-from app.db import get_connection
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+from app.db import get_sync_cursor, set_sync_cursor, fetch_order_states, upsert_order_states
 from app.worker import celery_app # Импортируем Celery app
+from app.metrics import STATUS_UPDATES
 # Импортируем функции из utils
-from app.utils.woocommerce import update_wc_order_status, get_wc_orders_for_status_sync
-from app.utils.moysklad import fetch_moysklad_orders, update_moysklad_order_status
+from app.utils.woocommerce import queue_wc_order_status, iter_wc_orders, parse_wc_datetime
+from app.utils.status_cache import status_cache
+from app.utils.task_lock import singleton, COALESCE
+from app.utils.moysklad import iter_moysklad_orders, get_moysklad_state_names, parse_moysklad_datetime, update_moysklad_order_status, MS_TIMEZONE
 
 logger = logging.getLogger(__name__)
 
+# Имя курсора инкрементальной синхронизации МойСклад -> WooCommerce в таблице sync_cursor
+MS_TO_WC_CURSOR = "ms_to_wc_status"
+# Глубина первой синхронизации без курсора (даты МойСклад - в часовом поясе MS_TIMEZONE)
+MS_STATUS_SYNC_LOOKBACK_HOURS = float(os.getenv("MS_STATUS_SYNC_LOOKBACK_HOURS", "24"))
+# Имя курсора синхронизации WooCommerce -> МойСклад (дата изменения заказа WC, GMT) и глубина первой синхронизации
+WC_TO_MS_CURSOR = "wc_to_ms_status"
+WC_STATUS_SYNC_LOOKBACK_HOURS = float(os.getenv("WC_STATUS_SYNC_LOOKBACK_HOURS", "24"))
+
 async def get_status_mapping():
-    """Загружает маппинг статусов из БД."""
+    """Возвращает маппинг статусов из кэша процесса (перезагружается по TTL и по NOTIFY из БД)."""
     try:
-        async with get_connection() as conn:
-            rows = await conn.fetch("SELECT moysklad_status, woocommerce_status FROM status_mapping")
-            ms_to_wc = {row["moysklad_status"]: row["woocommerce_status"] for row in rows}
-            wc_to_ms = {v: k for k, v in ms_to_wc.items()} # Генерируем обратный маппинг
-            return {
-                "ms_to_wc": ms_to_wc,
-                "wc_to_ms": wc_to_ms
-            }
+        return await status_cache.get_mapping()
     except Exception as e:
         logger.exception("Failed to get status mapping from DB")
         return None # Возвращаем None при ошибке
 
 @celery_app.task(name="sync_statuses_from_moysklad_task")
+@singleton("sync_statuses_from_moysklad_task", COALESCE)
 async def sync_statuses_from_moysklad():
-    """Задача Celery: Синхронизирует статусы ИЗ МойСклад В WooCommerce."""
+    """Задача Celery: Синхронизирует статусы ИЗ МойСклад В WooCommerce.
+    Инкрементально: выбирает только заказы, измененные с прошлого запуска (курсор в sync_cursor), постранично.
+    Курсор сдвигается только после успешного запуска и не дальше самого раннего заказа, который не удалось обновить:
+    такой заказ будет перечитан при следующем запуске.
+    """
     logger.info("Starting sync_statuses_from_moysklad task...")
     mapping_data = await get_status_mapping()
     if not mapping_data:
@@ -36,46 +48,108 @@ async def sync_statuses_from_moysklad():
         return
 
     ms_to_wc = mapping_data["ms_to_wc"]
-    # Получаем заказы из МС (можно добавить фильтры)
-    ms_orders = await fetch_moysklad_orders(params={'expand': 'state'}) # Расширяем, чтобы получить объект статуса
-
-    updated_count = 0
-    for order in ms_orders:
-        # externalCode должен содержать ID заказа WC
-        wc_order_id_str = order.get("externalCode")
-        ms_status_obj = order.get("state")
-        ms_status_name = ms_status_obj.get("name") if ms_status_obj else None
-        ms_uuid = order.get("id")
+    try:
+        # Имена статусов по href (без expand=state, чтобы страницы могли быть по 1000 заказов)
+        state_names = await get_moysklad_state_names()
+        updated_from = await get_sync_cursor(MS_TO_WC_CURSOR)
+    except Exception as e:
+        logger.exception(f"Cannot sync statuses from Moysklad: failed to load state metadata or sync cursor: {e}")
+        return
+    if updated_from is None:
+        updated_from = datetime.now(ZoneInfo(MS_TIMEZONE)).replace(tzinfo=None) - timedelta(hours=MS_STATUS_SYNC_LOOKBACK_HOURS)
+    logger.info(f"Fetching Moysklad orders updated since {updated_from}")
 
-        if not wc_order_id_str or not ms_status_name:
-            # logger.debug(f"Skipping MS order {ms_uuid}: missing externalCode or state name.")
-            continue
+    updated_count = fetched_count = skipped_count = 0
+    watermark: datetime | None = None # updated последнего заказа полностью обработанных страниц
+    failed_from: datetime | None = None # updated самого раннего заказа, статус которого не удалось обновить
+    try:
+        async for ms_orders in iter_moysklad_orders(updated_from=updated_from):
+            fetched_count += len(ms_orders)
+            page_watermark = watermark
+            candidates: list[tuple[int, str, str, str, datetime | None]] = [] # (wc_order_id, ms_uuid, ms_status_name, target_wc_status, updated)
+            for order in ms_orders:
+                order_updated = parse_moysklad_datetime(order.get("updated"))
+                if order_updated and (page_watermark is None or order_updated > page_watermark):
+                    page_watermark = order_updated
+
+                # externalCode должен содержать ID заказа WC
+                wc_order_id_str = order.get("externalCode")
+                ms_status_href = (order.get("state") or {}).get("meta", {}).get("href")
+                ms_status_name = state_names.get(ms_status_href)
+                ms_uuid = order.get("id")
+
+                if not wc_order_id_str or not ms_status_name:
+                    # logger.debug(f"Skipping MS order {ms_uuid}: missing externalCode or state name.")
+                    continue
+
+                try:
+                    wc_order_id = int(wc_order_id_str)
+                except ValueError:
+                    logger.warning(f"Invalid externalCode '{wc_order_id_str}' for MS order {ms_uuid}. Skipping.")
+                    continue
+
+                if ms_status_name in ms_to_wc:
+                    candidates.append((wc_order_id, ms_uuid, ms_status_name, ms_to_wc[ms_status_name], order_updated))
+                # else:
+                    # logger.debug(f"No mapping found for MS status '{ms_status_name}'")
+
+            # Сверяемся с зеркалом order_state: обновляем WC только при реальной смене статуса
+            known = await fetch_order_states([c[0] for c in candidates])
+            updates = []
+            synced_states = []
+            for wc_order_id, ms_uuid, ms_status_name, target_wc_status, order_updated in candidates:
+                state = known.get(wc_order_id)
+                if state and state["wc_status"] == target_wc_status:
+                    skipped_count += 1
+                    STATUS_UPDATES.labels("ms_to_wc", "skipped").inc()
+                    if state["ms_status"] != ms_status_name:
+                        # Статус МС сменился без смены статуса WC - запоминаем новое состояние
+                        synced_states.append((wc_order_id, ms_uuid, target_wc_status, ms_status_name))
+                    continue
+                logger.info(f"Updating WC order {wc_order_id} to status '{target_wc_status}' from MS status '{ms_status_name}'", extra={"order_id": wc_order_id, "ms_uuid": ms_uuid, "sample": True})
+                updates.append((wc_order_id, ms_uuid, ms_status_name, target_wc_status, order_updated))
+
+            # Обновления страницы уходят в WC пачками через /orders/batch, результат - по каждому заказу
+            results = await asyncio.gather(
+                *(queue_wc_order_status(wc_order_id, status) for wc_order_id, _, _, status, _ in updates),
+                return_exceptions=True,
+            )
+            for (wc_order_id, ms_uuid, ms_status_name, target_wc_status, order_updated), result in zip(updates, results):
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to update WC order {wc_order_id} status: {result}")
+                    STATUS_UPDATES.labels("ms_to_wc", "failed").inc()
+                    if order_updated and (failed_from is None or order_updated < failed_from):
+                        failed_from = order_updated
+                else:
+                    updated_count += 1
+                    STATUS_UPDATES.labels("ms_to_wc", "sent").inc()
+                    synced_states.append((wc_order_id, ms_uuid, target_wc_status, ms_status_name))
+            await upsert_order_states(synced_states)
+            watermark = page_watermark
+    except Exception as e:
+        # Курсор не сдвигается: следующий запуск повторит выборку с прежнего курсора
+        logger.exception(f"Error fetching Moysklad orders for status sync: {e}")
+        return
 
+    # Фильтр updated>= включает границу, поэтому курсор на неуспешном заказе перечитает его при следующем запуске
+    cursor = failed_from if failed_from is not None else watermark
+    if cursor is not None:
         try:
-            wc_order_id = int(wc_order_id_str)
-        except ValueError:
-            logger.warning(f"Invalid externalCode '{wc_order_id_str}' for MS order {ms_uuid}. Skipping.")
-            continue
-
-        if ms_status_name in ms_to_wc:
-            target_wc_status = ms_to_wc[ms_status_name]
-            # TODO: Добавить проверку текущего статуса в WC, чтобы не обновлять без надобности
-            try:
-                logger.info(f"Updating WC order {wc_order_id} to status '{target_wc_status}' from MS status '{ms_status_name}'")
-                await update_wc_order_status(wc_order_id, target_wc_status)
-                updated_count += 1
-            except Exception as e:
-                logger.error(f"Failed to update WC order {wc_order_id} status: {e}")
-                # Можно добавить логику ретраев или сохранения в очередь ошибок
-        # else:
-            # logger.debug(f"No mapping found for MS status '{ms_status_name}'")
-
-    logger.info(f"Finished sync_statuses_from_moysklad task. Updated {updated_count} WC orders.")
+            await set_sync_cursor(MS_TO_WC_CURSOR, cursor)
+        except Exception as e:
+            logger.exception(f"Failed to save sync cursor '{MS_TO_WC_CURSOR}': {e}")
+
+    logger.info(f"Finished sync_statuses_from_moysklad task. Fetched {fetched_count} MS orders, updated {updated_count} WC orders, skipped {skipped_count} unchanged.")
 
 
 @celery_app.task(name="sync_statuses_to_moysklad_task")
+@singleton("sync_statuses_to_moysklad_task", COALESCE)
 async def sync_statuses_to_moysklad():
-    """Задача Celery: Синхронизирует статусы ИЗ WooCommerce В МойСклад."""
+    """Задача Celery: Синхронизирует статусы ИЗ WooCommerce В МойСклад.
+    Инкрементально: выбирает только заказы, измененные с прошлого запуска (modified_after из sync_cursor), постранично.
+    Курсор сдвигается только после успешного запуска: на время начала запуска или на первый заказ, статус которого
+    не удалось обновить в МойСклад (следующий запуск повторит его).
+    """
     logger.info("Starting sync_statuses_to_moysklad task...")
     mapping_data = await get_status_mapping()
     if not mapping_data:
@@ -83,35 +157,79 @@ async def sync_statuses_to_moysklad():
         return
 
     wc_to_ms = mapping_data["wc_to_ms"]
-    # Получаем заказы из WC для синхронизации (можно добавить фильтры)
-    wc_orders = await get_wc_orders_for_status_sync() # Пример: последние измененные
-
-    updated_count = 0
-    for order in wc_orders:
-        wc_id = order.get("id")
-        wc_status = order.get("status")
-        # Ищем UUID МойСклад в метаданных
-        ms_uuid = None
-        for meta in order.get("meta_data", []):
-            if meta.get("key") == "_moysklad_uuid":
-                ms_uuid = meta.get("value")
-                break
-
-        if not ms_uuid or not wc_status:
-            # logger.debug(f"Skipping WC order {wc_id}: missing moysklad_uuid or status.")
-            continue
-
-        if wc_status in wc_to_ms:
-            target_ms_status_name = wc_to_ms[wc_status]
-            # TODO: Добавить проверку текущего статуса в МС, чтобы не обновлять без надобности
-            try:
-                logger.info(f"Updating MS order {ms_uuid} to status '{target_ms_status_name}' from WC order {wc_id} (status: '{wc_status}')")
-                await update_moysklad_order_status(ms_uuid, target_ms_status_name)
-                updated_count += 1
-            except Exception as e:
-                logger.error(f"Failed to update MS order {ms_uuid} status: {e}")
-                # Можно добавить логику ретраев или сохранения в очередь ошибок
-        # else:
-            # logger.debug(f"No mapping found for WC status '{wc_status}'")
-
-    logger.info(f"Finished sync_statuses_to_moysklad task. Updated {updated_count} Moysklad orders.") 
\ No newline at end of file
+    try:
+        modified_after = await get_sync_cursor(WC_TO_MS_CURSOR)
+    except Exception as e:
+        logger.exception(f"Cannot sync statuses to Moysklad: failed to load sync cursor: {e}")
+        return
+    if modified_after is None:
+        modified_after = datetime.utcnow() - timedelta(hours=WC_STATUS_SYNC_LOOKBACK_HOURS)
+    logger.info(f"Fetching WC orders modified after {modified_after} (GMT)")
+
+    # Заказы, измененные после начала запуска, попадут в следующий запуск (страницы идут по id, а не по дате изменения)
+    started_at = datetime.utcnow()
+    updated_count = fetched_count = skipped_count = 0
+    failed_from: datetime | None = None # дата изменения первого заказа, статус которого не удалось обновить
+    try:
+        async for wc_orders in iter_wc_orders(modified_after=modified_after):
+            fetched_count += len(wc_orders)
+            candidates: list[tuple[int, str, str, str, datetime | None]] = [] # (wc_id, ms_uuid, wc_status, target_ms_status_name, modified)
+            for order in wc_orders:
+                order_modified = parse_wc_datetime(order.get("date_modified_gmt"))
+
+                wc_id = order.get("id")
+                wc_status = order.get("status")
+                # Ищем UUID МойСклад в метаданных
+                ms_uuid = None
+                for meta in order.get("meta_data", []):
+                    if meta.get("key") == "_moysklad_uuid":
+                        ms_uuid = meta.get("value")
+                        break
+
+                if not ms_uuid or not wc_status:
+                    # logger.debug(f"Skipping WC order {wc_id}: missing moysklad_uuid or status.")
+                    continue
+
+                if wc_status in wc_to_ms:
+                    candidates.append((wc_id, ms_uuid, wc_status, wc_to_ms[wc_status], order_modified))
+                # else:
+                    # logger.debug(f"No mapping found for WC status '{wc_status}'")
+
+            # Сверяемся с зеркалом order_state: обновляем МС только при реальной смене статуса
+            known = await fetch_order_states([c[0] for c in candidates])
+            synced_states = []
+            for wc_id, ms_uuid, wc_status, target_ms_status_name, order_modified in candidates:
+                state = known.get(wc_id)
+                if state and state["ms_status"] == target_ms_status_name:
+                    skipped_count += 1
+                    STATUS_UPDATES.labels("wc_to_ms", "skipped").inc()
+                    if state["wc_status"] != wc_status:
+                        # Статус WC сменился без смены статуса МС - запоминаем новое состояние
+                        synced_states.append((wc_id, ms_uuid, wc_status, target_ms_status_name))
+                    continue
+                try:
+                    logger.info(f"Updating MS order {ms_uuid} to status '{target_ms_status_name}' from WC order {wc_id} (status: '{wc_status}')", extra={"order_id": wc_id, "ms_uuid": ms_uuid, "sample": True})
+                    await update_moysklad_order_status(ms_uuid, target_ms_status_name)
+                    updated_count += 1
+                    STATUS_UPDATES.labels("wc_to_ms", "sent").inc()
+                    synced_states.append((wc_id, ms_uuid, wc_status, target_ms_status_name))
+                except Exception as e:
+                    logger.error(f"Failed to update MS order {ms_uuid} status: {e}")
+                    STATUS_UPDATES.labels("wc_to_ms", "failed").inc()
+                    if order_modified and (failed_from is None or order_modified < failed_from):
+                        failed_from = order_modified
+            await upsert_order_states(synced_states)
+    except Exception as e:
+        # Курсор не сдвигается: следующий запуск повторит выборку с прежнего курсора
+        logger.exception(f"Error fetching WC orders for status sync: {e}")
+        return
+
+    # modified_after строгий, поэтому курсор ставится на 1 сек. раньше: заказы с той же секундой изменения
+    # (и первый неуспешный заказ) перечитываются при следующем запуске
+    cursor = failed_from if failed_from is not None else started_at
+    try:
+        await set_sync_cursor(WC_TO_MS_CURSOR, cursor - timedelta(seconds=1))
+    except Exception as e:
+        logger.exception(f"Failed to save sync cursor '{WC_TO_MS_CURSOR}': {e}")
+
+    logger.info(f"Finished sync_statuses_to_moysklad task. Fetched {fetched_count} WC orders, updated {updated_count} Moysklad orders, skipped {skipped_count} unchanged.")
@@ -0,0 +1,92 @@
+import os
+import logging
+
+from opentelemetry import context, propagate, trace
+from opentelemetry.sdk.resources import Resource
+from opentelemetry.sdk.trace import TracerProvider
+from opentelemetry.sdk.trace.export import BatchSpanProcessor, ConsoleSpanExporter
+
+logger = logging.getLogger(__name__)
+
+# Экспорт трейсов: none (выключено), otlp, console, file
+TRACING_EXPORTER = os.getenv("TRACING_EXPORTER", "none").lower()
+# Файл для TRACING_EXPORTER=file (по одному span в JSON на строку)
+TRACING_FILE = os.getenv("TRACING_FILE", "traces.jsonl")
+# Имя сервиса в трейсах; адрес коллектора OTLP задается стандартной OTEL_EXPORTER_OTLP_ENDPOINT
+OTEL_SERVICE_NAME = os.getenv("OTEL_SERVICE_NAME", "ms_orders")
+
+# Трейсер приложения. До init_tracing() spans не записываются (no-op провайдер)
+tracer = trace.get_tracer("app")
+
+_provider: TracerProvider | None = None
+_trace_file = None
+
+
+def _build_exporter():
+    global _trace_file
+    if TRACING_EXPORTER == "otlp":
+        from opentelemetry.exporter.otlp.proto.http.trace_exporter import OTLPSpanExporter
+        return OTLPSpanExporter()
+    if TRACING_EXPORTER == "console":
+        return ConsoleSpanExporter()
+    if TRACING_EXPORTER == "file":
+        _trace_file = open(TRACING_FILE, "a", encoding="utf-8")
+        return ConsoleSpanExporter(out=_trace_file, formatter=lambda span: span.to_json(indent=None) + os.linesep)
+    return None
+
+
+def init_tracing():
+    """Настраивает экспорт трейсов и инструментирует Celery (контекст в заголовках задач), httpx и asyncpg.
+    Вызывается в каждом процессе после fork: фоновый поток экспорта не переживает fork.
+    """
+    global _provider
+    if _provider is not None or TRACING_EXPORTER in ("", "none"):
+        return
+    exporter = _build_exporter()
+    if exporter is None:
+        logger.warning(f"Unknown TRACING_EXPORTER '{TRACING_EXPORTER}'. Tracing disabled.")
+        return
+
+    from opentelemetry.instrumentation.asyncpg import AsyncPGInstrumentor
+    from opentelemetry.instrumentation.celery import CeleryInstrumentor
+    from opentelemetry.instrumentation.httpx import HTTPXClientInstrumentor
+
+    _provider = TracerProvider(resource=Resource.create({"service.name": OTEL_SERVICE_NAME}))
+    _provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(_provider)
+    CeleryInstrumentor().instrument()
+    HTTPXClientInstrumentor().instrument()
+    AsyncPGInstrumentor().instrument()
+    logger.info(f"Tracing enabled (exporter={TRACING_EXPORTER}, service={OTEL_SERVICE_NAME}).")
+
+
+def shutdown_tracing():
+    """Отправляет накопленные spans и останавливает экспорт."""
+    global _provider, _trace_file
+    if _provider is not None:
+        _provider.shutdown()
+        _provider = None
+    if _trace_file is not None:
+        _trace_file.close()
+        _trace_file = None
+
+
+def attach_context(headers: dict | None):
+    """Делает текущим контекст трейса из заголовков сообщения (traceparent). Возвращает токен для detach_context."""
+    return context.attach(propagate.extract(headers or {}))
+
+
+def detach_context(token):
+    context.detach(token)
+
+
+def inject_context(headers: dict):
+    """Добавляет в заголовки сообщения контекст текущего трейса (traceparent)."""
+    propagate.inject(headers)
+
+
+def record_error(exc: BaseException):
+    """Отмечает текущий span как ошибочный."""
+    span = trace.get_current_span()
+    span.record_exception(exc)
+    span.set_status(trace.Status(trace.StatusCode.ERROR, str(exc)))
@@ -0,0 +1,108 @@
+import httpx
+import os
+import logging
+import time
+
+from app.metrics import API_REQUEST_DURATION, endpoint_label
+from app.utils.rate_limit import MoyskladRateLimitedTransport, RedisTokenBucket, MS_RATE_LIMIT, MS_RATE_PERIOD
+
+logger = logging.getLogger(__name__)
+
+# --- Настройки HTTP клиентов (из переменных окружения) ---
+HTTP_TIMEOUT = float(os.getenv("HTTP_TIMEOUT", "15.0"))
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "20")) # Максимум соединений на клиента
+HTTP_MAX_KEEPALIVE = int(os.getenv("HTTP_MAX_KEEPALIVE", "10")) # Сколько соединений держать открытыми
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30.0")) # Сек. жизни простаивающего соединения
+HTTP_HTTP2 = os.getenv("HTTP_HTTP2", "true").lower() in ("1", "true", "yes")
+MS_RATE_LIMIT_ENABLED = os.getenv("MS_RATE_LIMIT_ENABLED", "true").lower() in ("1", "true", "yes")
+
+try:
+    import h2  # noqa: F401 - нужен httpx для HTTP/2
+    _H2_AVAILABLE = True
+except ImportError:
+    _H2_AVAILABLE = False
+
+# Реестр клиентов процесса воркера: имя -> httpx.AsyncClient
+_clients: dict[str, httpx.AsyncClient] = {}
+
+MOYSKLAD = "moysklad"
+WOOCOMMERCE = "woocommerce"
+
+
+def _latency_hooks(name: str) -> dict[str, list]:
+    """Event hooks httpx, измеряющие время запроса (включая ожидание лимита МойСклад) для метрик."""
+    async def on_request(request: httpx.Request):
+        request.extensions["started_at"] = time.perf_counter()
+
+    async def on_response(response: httpx.Response):
+        request = response.request
+        started_at = request.extensions.get("started_at")
+        if started_at is None:
+            return
+        API_REQUEST_DURATION.labels(
+            name, request.method, endpoint_label(request.url.path), str(response.status_code),
+        ).observe(time.perf_counter() - started_at)
+
+    return {"request": [on_request], "response": [on_response]}
+
+
+def _build_client(name: str) -> httpx.AsyncClient:
+    """Создает AsyncClient с keep-alive, лимитами соединений и HTTP/2 (если доступен).
+    Запросы к МойСклад проходят через транспорт с общим для всех процессов ограничением частоты.
+    """
+    limits = httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+    transport: httpx.AsyncBaseTransport = httpx.AsyncHTTPTransport(limits=limits, http2=HTTP_HTTP2 and _H2_AVAILABLE)
+    if name == MOYSKLAD and MS_RATE_LIMIT_ENABLED:
+        transport = MoyskladRateLimitedTransport(transport, RedisTokenBucket(MOYSKLAD, MS_RATE_LIMIT, MS_RATE_PERIOD))
+    return httpx.AsyncClient(
+        timeout=HTTP_TIMEOUT,
+        transport=transport,
+        headers={"Accept-Encoding": "gzip"},
+        event_hooks=_latency_hooks(name),
+    )
+
+
+async def init_http_clients():
+    """Создает общие HTTP клиенты для МойСклад и WooCommerce."""
+    for name in (MOYSKLAD, WOOCOMMERCE):
+        if name not in _clients:
+            _clients[name] = _build_client(name)
+    if HTTP_HTTP2 and not _H2_AVAILABLE:
+        logger.warning("HTTP/2 requested but 'h2' package is not installed. Falling back to HTTP/1.1.")
+    logger.info(f"HTTP clients initialized (max_connections={HTTP_MAX_CONNECTIONS}, http2={HTTP_HTTP2 and _H2_AVAILABLE}).")
+
+
+async def close_http_clients():
+    """Закрывает все HTTP клиенты процесса."""
+    for name, client in list(_clients.items()):
+        try:
+            await client.aclose()
+        except Exception as e:
+            logger.exception(f"Failed to close HTTP client '{name}': {e}")
+    _clients.clear()
+    logger.info("HTTP clients closed.")
+
+
+def get_http_client(name: str) -> httpx.AsyncClient:
+    """Возвращает общий клиент по имени.
+    Если клиенты еще не инициализированы (например, вне воркера), создает клиент лениво.
+    """
+    client = _clients.get(name)
+    if client is None or client.is_closed:
+        logger.debug(f"HTTP client '{name}' is not initialized. Creating it lazily.")
+        client = _build_client(name)
+        _clients[name] = client
+    return client
+
+
+def get_moysklad_client() -> httpx.AsyncClient:
+    return get_http_client(MOYSKLAD)
+
+
+def get_wc_client() -> httpx.AsyncClient:
+    return get_http_client(WOOCOMMERCE)
+
@@ -1,16 +1,23 @@
 import httpx
 import os
 import logging
-from typing import Any
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo
+from typing import Any, AsyncIterator
+
+from app.utils.http_client import get_moysklad_client
+from app.utils.status_cache import status_cache
+from app.logging_config import LOG_BODY_LIMIT
 
 logger = logging.getLogger(__name__)
 
 MOYSKLAD_API_URL = os.getenv("MOYSKLAD_API_URL", "https://online.moysklad.ru/api/remap/1.2")
 MOYSKLAD_TOKEN = os.getenv("MOYSKLAD_TOKEN")
-HTTP_TIMEOUT = 15.0
-
-# Кэш для метаданных статусов МойСклад (простая реализация)
-_status_meta_cache: dict[str, str] = {}
+# Часовой пояс дат МойСклад (поля moment, updated)
+MS_TIMEZONE = os.getenv("MS_TIMEZONE", "Europe/Moscow")
+# Юрлицо (по умолчанию - первое юрлицо аккаунта) и контрагент для покупателей, не найденных по email/телефону (href сущностей МойСклад)
+MS_ORGANIZATION_HREF = os.getenv("MS_ORGANIZATION_HREF")
+MS_DEFAULT_AGENT_HREF = os.getenv("MS_DEFAULT_AGENT_HREF")
 
 async def _get_ms_auth_headers() -> dict[str, str]:
     if not MOYSKLAD_TOKEN:
@@ -22,63 +29,247 @@ async def _get_ms_auth_headers() -> dict[str, str]:
         "Accept-Encoding": "gzip"
     }
 
-async def fetch_moysklad_orders(params: dict | None = None) -> list[dict]:
-    """Получает заказы из МойСклад.
-    (Требуется реальная реализация - определить нужные фильтры)
+MS_PAGE_SIZE = 1000 # Максимальный limit МойСклад для выборок без expand
+MS_DATETIME_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def parse_moysklad_datetime(value: str | None) -> datetime | None:
+    """Разбирает дату МойСклад ("2024-01-31 12:00:00.123") в datetime (часовой пояс аккаунта, без tzinfo)."""
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value[:19], MS_DATETIME_FORMAT)
+    except ValueError:
+        logger.warning(f"Unexpected Moysklad datetime format: {value}")
+        return None
+
+async def iter_moysklad_rows(path: str, params: dict | None = None, page_size: int = MS_PAGE_SIZE) -> AsyncIterator[list[dict]]:
+    """Постранично получает строки выборки МойСклад (offset/limit), например path="/entity/assortment".
+    Отдает страницы по мере загрузки, чтобы не держать всю выборку в памяти. Ошибки HTTP пробрасываются.
+    Смещение подходит для выборок без сортировки по изменяемому полю; заказы по updated - iter_moysklad_orders.
     """
     headers = await _get_ms_auth_headers()
-    url = f"{MOYSKLAD_API_URL}/entity/customerorder"
-    # Пример параметров: последние 10 измененных
-    default_params = {'order': 'updated,desc', 'limit': 10}
-    if params:
-        default_params.update(params)
+    url = f"{MOYSKLAD_API_URL}{path}"
+    base_params = {"limit": page_size, **(params or {})}
 
-    try:
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-            response = await client.get(url, headers=headers, params=default_params)
-            response.raise_for_status()
-            data = response.json()
-            orders = data.get("rows", [])
-            logger.info(f"Fetched {len(orders)} orders from Moysklad.")
-            return orders
-    except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error fetching Moysklad orders: {e.response.status_code} - {e.response.text}")
-        return []
-    except Exception as e:
-        logger.exception(f"Error fetching Moysklad orders: {e}")
-        return []
+    client = get_moysklad_client()
+    offset = 0
+    while True:
+        response = await client.get(url, headers=headers, params={**base_params, "offset": offset})
+        response.raise_for_status()
+        rows = response.json().get("rows", [])
+        if rows:
+            yield rows
+        if len(rows) < base_params["limit"]:
+            break
+        offset += len(rows)
 
-async def get_moysklad_status_meta(status_name: str) -> str | None:
-    """Получает метаданные статуса заказа МойСклад по имени (с кэшированием).
-    (Требуется реальная реализация)
+async def iter_moysklad_orders(updated_from: datetime | None = None, params: dict | None = None, page_size: int = MS_PAGE_SIZE) -> AsyncIterator[list[dict]]:
+    """Постранично получает заказы МойСклад, измененные начиная с updated_from, по возрастанию updated.
+    Страницы выбираются по ключу, а не смещением: следующая страница запрашивается с updated>= updated последнего
+    заказа, а уже отданные заказы этой секунды отбрасываются по id. Заказ, измененный во время выборки, уходит в конец
+    и не сдвигает страницы, поэтому другие заказы не пропускаются. Смещение используется только внутри одной секунды,
+    если в нее попало больше page_size заказов. filter из params добавляется к условию по updated. Полная страница без
+    новых заказов (сервер не применил фильтр) завершает выборку. Ошибки HTTP пробрасываются.
     """
-    if status_name in _status_meta_cache:
-        return _status_meta_cache[status_name]
+    headers = await _get_ms_auth_headers()
+    url = f"{MOYSKLAD_API_URL}/entity/customerorder"
+    extra_params = dict(params or {})
+    extra_filter = extra_params.pop("filter", None)
+
+    client = get_moysklad_client()
+    since = updated_from.strftime(MS_DATETIME_FORMAT) if updated_from else None
+    seen: set[str] = set() # id уже отданных заказов с updated в секунде since
+    offset = 0
+    while True:
+        filters = [f"updated>={since}"] if since else []
+        if extra_filter:
+            filters.append(extra_filter)
+        query = {**extra_params, "order": "updated,asc", "limit": page_size, "offset": offset}
+        if filters:
+            query["filter"] = ";".join(filters)
+        response = await client.get(url, headers=headers, params=query)
+        response.raise_for_status()
+        rows = response.json().get("rows", [])
+        fresh = [row for row in rows if row.get("id") not in seen]
+        if fresh:
+            yield fresh
+        if len(rows) < page_size:
+            break
+        if not fresh:
+            logger.warning(f"Moysklad orders page at updated>={since} offset {offset} has no new orders. Stopping pagination.")
+            break
+
+        last = (rows[-1].get("updated") or "")[:19]
+        if not last or last == since:
+            # Вся страница в одной секунде (или без updated) - внутри нее листаем смещением
+            offset += len(rows)
+            seen.update(row.get("id") for row in rows)
+        else:
+            since = last
+            offset = 0
+            seen = {row.get("id") for row in rows if (row.get("updated") or "")[:19] == last}
 
+async def fetch_moysklad_states() -> dict[str, str]:
+    """Загружает все статусы заказов покупателя одним запросом метаданных: имя статуса -> href."""
     headers = await _get_ms_auth_headers()
     url = f"{MOYSKLAD_API_URL}/entity/customerorder/metadata"
+    client = get_moysklad_client()
+    response = await client.get(url, headers=headers)
+    response.raise_for_status()
+    return {
+        state.get("name"): state["meta"]["href"]
+        for state in response.json().get("states", [])
+        if state.get("meta", {}).get("href")
+    }
+
+async def get_moysklad_state_names() -> dict[str, str]:
+    """Возвращает словарь href статуса -> имя статуса (из кэша статусов процесса)."""
+    return await status_cache.get_state_names()
 
+async def create_moysklad_orders(payloads: list[dict]) -> list[dict]:
+    """Создает несколько заказов в МойСклад одним POST запросом (массив до 1000 элементов).
+    Возвращает список ответов в порядке payloads; неуспешные элементы содержат ключ "errors".
+    """
+    headers = await _get_ms_auth_headers()
+    url = f"{MOYSKLAD_API_URL}/entity/customerorder"
+
+    client = get_moysklad_client()
+    response = await client.post(url, headers=headers, json=payloads)
+    # При частичной ошибке МойСклад может вернуть 4xx, но с массивом результатов по каждому элементу
+    if response.is_client_error:
+        try:
+            data = response.json()
+        except ValueError:
+            data = None
+        if isinstance(data, list) and len(data) == len(payloads):
+            return data
+    response.raise_for_status()
+
+    data = response.json()
+    if not isinstance(data, list) or len(data) != len(payloads):
+        raise ValueError(f"Unexpected batch response from Moysklad: expected {len(payloads)} elements")
+    logger.info(f"Sent batch of {len(payloads)} orders to Moysklad.")
+    return data
+
+MS_LOOKUP_CHUNK = 100 # Значений в одном filter (ограничение длины URL)
+
+async def find_moysklad_rows(path: str, field: str, values: list[str]) -> list[dict]:
+    """Ищет строки выборки МойСклад по значениям поля: filter=field=a;field=b (одинаковые условия объединяются по ИЛИ),
+    один запрос на MS_LOOKUP_CHUNK значений. Ошибки HTTP пробрасываются.
+    """
+    headers = await _get_ms_auth_headers()
+    url = f"{MOYSKLAD_API_URL}{path}"
+    client = get_moysklad_client()
+    rows: list[dict] = []
+    for start in range(0, len(values), MS_LOOKUP_CHUNK):
+        chunk = values[start:start + MS_LOOKUP_CHUNK]
+        params = {"filter": ";".join(f"{field}={value}" for value in chunk), "limit": MS_PAGE_SIZE}
+        response = await client.get(url, headers=headers, params=params)
+        response.raise_for_status()
+        rows.extend(response.json().get("rows", []))
+    return rows
+
+async def find_moysklad_orders_by_external_code(external_codes: list[str]) -> dict[str, dict]:
+    """Ищет уже созданные заказы МойСклад по externalCode (ID заказа WC).
+    Возвращает словарь externalCode -> заказ (поля id, name, meta). Ошибки HTTP пробрасываются.
+    """
+    found: dict[str, dict] = {}
+    for row in await find_moysklad_rows("/entity/customerorder", "externalCode", external_codes):
+        found.setdefault(row.get("externalCode"), row)
+    return found
+
+def _meta(href: str, entity_type: str) -> dict:
+    return {"meta": {"href": href, "type": entity_type, "mediaType": "application/json"}}
+
+def _line_item_sku(item: dict) -> str | None:
+    return (item.get("sku") or "").strip() or None
+
+def _order_payload(order: dict, assortment: dict[str, tuple[str, str] | None], agent: tuple[str, str] | None,
+                   organization: tuple[str, str] | None) -> dict:
+    order_id = order["id"]
+    payload: dict[str, Any] = {"externalCode": str(order_id)}
+    if organization:
+        payload["organization"] = _meta(*organization)
+    if agent:
+        payload["agent"] = _meta(*agent)
+    elif MS_DEFAULT_AGENT_HREF:
+        payload["agent"] = _meta(MS_DEFAULT_AGENT_HREF, "counterparty")
+    else:
+        logger.warning(f"Order {order_id}: no Moysklad counterparty found for customer and MS_DEFAULT_AGENT_HREF is not set.")
+
+    created = order.get("date_created_gmt")
+    if created:
+        try:
+            moment = datetime.fromisoformat(created).replace(tzinfo=timezone.utc).astimezone(ZoneInfo(MS_TIMEZONE))
+            payload["moment"] = moment.strftime(MS_DATETIME_FORMAT)
+        except ValueError:
+            logger.warning(f"Unexpected WC datetime format in order {order_id}: {created}")
+
+    billing = order.get("billing") or {}
+    description = [f"WooCommerce #{order.get('number', order_id)}"]
+    customer = " ".join(filter(None, [billing.get("first_name"), billing.get("last_name")]))
+    if customer:
+        description.append(f"Покупатель: {customer}")
+    for key in ("phone", "email"):
+        if billing.get(key):
+            description.append(billing[key])
+    if order.get("customer_note"):
+        description.append(order["customer_note"])
+    payload["description"] = "\n".join(description)
+
+    positions = []
+    for item in order.get("line_items", []):
+        sku = _line_item_sku(item)
+        ref = assortment.get(sku) if sku else None
+        if ref is None:
+            # Явная ссылка на товар МойСклад в meta_data строки заказа
+            product_uuid = next((m.get("value") for m in item.get("meta_data", []) if m.get("key") == "_moysklad_uuid"), None)
+            ref = (f"{MOYSKLAD_API_URL}/entity/product/{product_uuid}", "product") if product_uuid else None
+        if ref is None:
+            logger.warning(f"Order {order_id}: line item '{item.get('name')}' (SKU: {sku}) has no Moysklad product. Skipping position.")
+            continue
+        positions.append({
+            "quantity": item.get("quantity", 1),
+            "price": round(float(item.get("price") or 0) * 100),
+            "assortment": _meta(*ref),
+        })
+    if positions:
+        payload["positions"] = positions
+    return payload
+
+async def build_moysklad_order_payloads(orders: list[dict]) -> list[dict]:
+    """Преобразует заказы WooCommerce (тела вебхуков / REST API) в тела заказов покупателя МойСклад.
+    externalCode = ID заказа WC: по нему статусы сопоставляются обратно. Позиции сопоставляются по SKU,
+    контрагент - по email или телефону покупателя (кэш ms_resolver, ссылки всей пачки разрешаются вместе);
+    без найденного контрагента используется MS_DEFAULT_AGENT_HREF. Цены переводятся в копейки.
+    Ошибки запросов к МойСклад пробрасываются.
+    """
+    from app.utils.ms_resolver import get_ms_resolver # Локальный импорт: ms_resolver использует этот модуль
+
+    resolver = get_ms_resolver()
+    skus = sorted({sku for order in orders for item in order.get("line_items", []) if (sku := _line_item_sku(item))})
+    assortment = await resolver.resolve_assortment(skus)
+    agents = await resolver.resolve_counterparties([order.get("billing") or {} for order in orders])
+    organization = await resolver.get_organization()
+    return [_order_payload(order, assortment, agent, organization) for order, agent in zip(orders, agents)]
+
+async def build_moysklad_order_payload(order: dict) -> dict:
+    """Тело заказа МойСклад для одного заказа WooCommerce (см. build_moysklad_order_payloads)."""
+    return (await build_moysklad_order_payloads([order]))[0]
+
+async def get_moysklad_status_meta(status_name: str) -> str | None:
+    """Получает href статуса заказа МойСклад по имени (из кэша статусов процесса с TTL)."""
     try:
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-            response = await client.get(url, headers=headers)
-            response.raise_for_status()
-            metadata = response.json()
-            statuses = metadata.get("states", [])
-            for state in statuses:
-                if state.get("name") == status_name:
-                    meta_href = state.get("meta", {}).get("href")
-                    if meta_href:
-                        _status_meta_cache[status_name] = meta_href # Кэшируем
-                        logger.info(f"Fetched and cached meta for status '{status_name}'")
-                        return meta_href
-            logger.warning(f"Meta not found for Moysklad status '{status_name}'")
-            return None
+        meta_href = (await status_cache.get_states()).get(status_name)
     except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error fetching Moysklad metadata: {e.response.status_code} - {e.response.text}")
+        logger.error(f"HTTP error fetching Moysklad metadata: {e.response.status_code} - {e.response.text[:LOG_BODY_LIMIT]}")
         return None
     except Exception as e:
         logger.exception(f"Error fetching Moysklad metadata: {e}")
         return None
+    if not meta_href:
+        logger.warning(f"Meta not found for Moysklad status '{status_name}'")
+    return meta_href
 
 async def update_moysklad_order_status(ms_uuid: str, ms_status_name: str):
     """Обновляет статус заказа в МойСклад.
@@ -102,13 +293,13 @@ async def update_moysklad_order_status(ms_uuid: str, ms_status_name: str):
     }
 
     try:
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-            response = await client.put(url, headers=headers, json=payload)
-            response.raise_for_status()
-            logger.info(f"Successfully updated Moysklad order {ms_uuid} status to '{ms_status_name}'")
-            # return response.json()
+        client = get_moysklad_client()
+        response = await client.put(url, headers=headers, json=payload)
+        response.raise_for_status()
+        logger.info(f"Successfully updated Moysklad order {ms_uuid} status to '{ms_status_name}'", extra={"ms_uuid": ms_uuid, "sample": True})
+        # return response.json()
     except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error updating Moysklad order {ms_uuid} status to '{ms_status_name}': {e.response.status_code} - {e.response.text}")
+        logger.error(f"HTTP error updating Moysklad order {ms_uuid} status to '{ms_status_name}': {e.response.status_code} - {e.response.text[:LOG_BODY_LIMIT]}")
         raise
     except Exception as e:
         logger.exception(f"Error updating Moysklad order {ms_uuid} status: {e}")
@@ -0,0 +1,225 @@
+"""Кэш ссылок МойСклад для сборки заказов из WooCommerce: контрагент по email/телефону покупателя, ассортимент по SKU.
+
+Поиск идет по уровням: LRU процесса -> таблица ms_ref_cache в Postgres (общая для всех процессов) ->
+запросы к МойСклад пачками filter=code=a;code=b. Ненайденные значения тоже кэшируются (на MS_RESOLVER_NEGATIVE_TTL),
+чтобы не искать их заново для каждого заказа. warm() заполняет ms_ref_cache из полных выборок ассортимента
+и контрагентов: после прогрева заказ собирается без запросов к МойСклад.
+"""
+import os
+import re
+import logging
+import time
+from collections import OrderedDict
+
+from app.db import get_connection
+from app.metrics import MS_RESOLVER_LOOKUPS
+from app.utils.moysklad import iter_moysklad_rows, find_moysklad_rows, MS_ORGANIZATION_HREF
+
+logger = logging.getLogger(__name__)
+
+MS_SKU_FIELD = os.getenv("MS_SKU_FIELD", "code") # Поле ассортимента МойСклад, в котором хранится SKU WooCommerce: code или article
+MS_RESOLVER_CACHE_SIZE = int(os.getenv("MS_RESOLVER_CACHE_SIZE", "50000")) # Ссылок в LRU процесса
+MS_RESOLVER_TTL = float(os.getenv("MS_RESOLVER_TTL", "86400")) # Сек. жизни найденной ссылки
+MS_RESOLVER_NEGATIVE_TTL = float(os.getenv("MS_RESOLVER_NEGATIVE_TTL", "3600")) # Сек. жизни отметки "не найдено"
+
+# Виды ключей кэша
+ASSORTMENT = "assortment" # SKU -> товар, модификация, комплект или услуга
+EMAIL = "email" # email покупателя (в нижнем регистре) -> контрагент
+PHONE = "phone" # телефон покупателя (только цифры) -> контрагент
+ORGANIZATION = "organization" # "default" -> юрлицо, если не задан MS_ORGANIZATION_HREF
+
+# Выборка и поле фильтра МойСклад для каждого вида
+_SOURCES = {
+    ASSORTMENT: ("/entity/assortment", MS_SKU_FIELD),
+    EMAIL: ("/entity/counterparty", "email"),
+    PHONE: ("/entity/counterparty", "phone"),
+}
+
+Ref = tuple[str, str] # (href, тип сущности МойСклад)
+
+_LOAD_SQL = """
+    SELECT key, href, entity_type FROM ms_ref_cache
+    WHERE kind = $1 AND key = ANY($2::text[])
+        AND updated_at > now() - make_interval(secs => CASE WHEN href IS NULL THEN $4 ELSE $3 END)
+"""
+_SAVE_SQL = """
+    INSERT INTO ms_ref_cache (kind, key, href, entity_type, updated_at)
+    SELECT $1, e.key, e.href, e.entity_type, now()
+    FROM unnest($2::text[], $3::text[], $4::text[]) AS e(key, href, entity_type)
+    ON CONFLICT (kind, key) DO UPDATE SET
+        href = EXCLUDED.href, entity_type = EXCLUDED.entity_type, updated_at = now()
+"""
+
+
+def normalize_phone(phone: str | None) -> str | None:
+    """Оставляет в телефоне только цифры; российский номер с 8 приводится к 7."""
+    digits = re.sub(r"\D", "", phone or "")
+    if len(digits) == 11 and digits.startswith("8"):
+        digits = "7" + digits[1:]
+    return digits if len(digits) >= 5 else None
+
+
+def _row_key(kind: str, row: dict) -> str | None:
+    value = row.get(_SOURCES[kind][1])
+    if not value:
+        return None
+    if kind == EMAIL:
+        return value.strip().lower()
+    if kind == PHONE:
+        return normalize_phone(value)
+    return value
+
+
+def _row_ref(row: dict) -> Ref:
+    return row["meta"]["href"], row["meta"]["type"]
+
+
+class MoyskladResolver:
+    """Разрешает значения из заказа WooCommerce в ссылки МойСклад с кэшем в памяти и в Postgres."""
+
+    def __init__(self, size: int = MS_RESOLVER_CACHE_SIZE, ttl: float = MS_RESOLVER_TTL, negative_ttl: float = MS_RESOLVER_NEGATIVE_TTL):
+        self.size = size
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._lru: OrderedDict[tuple[str, str], tuple[Ref | None, float]] = OrderedDict() # (вид, ключ) -> (ссылка, срок)
+
+    def _remember(self, kind: str, key: str, ref: Ref | None):
+        self._lru[(kind, key)] = (ref, time.monotonic() + (self.ttl if ref else self.negative_ttl))
+        self._lru.move_to_end((kind, key))
+        while len(self._lru) > self.size:
+            self._lru.popitem(last=False)
+
+    async def _load(self, kind: str, keys: list[str]) -> dict[str, Ref | None]:
+        async with get_connection() as conn:
+            rows = await conn.fetch(_LOAD_SQL, kind, keys, self.ttl, self.negative_ttl)
+        return {row["key"]: (row["href"], row["entity_type"]) if row["href"] else None for row in rows}
+
+    async def _save(self, kind: str, entries: dict[str, Ref | None]):
+        """Сохраняет ссылки (None - не найдено) в ms_ref_cache одним запросом. Ошибки БД пробрасываются."""
+        if not entries:
+            return
+        keys = list(entries)
+        async with get_connection() as conn:
+            await conn.execute(
+                _SAVE_SQL, kind, keys,
+                [entries[key][0] if entries[key] else None for key in keys],
+                [entries[key][1] if entries[key] else None for key in keys],
+            )
+
+    async def _fetch(self, kind: str, values: dict[str, str]) -> dict[str, Ref]:
+        """Ищет значения в МойСклад: values - ключ кэша -> значение для filter. Ошибки HTTP пробрасываются."""
+        if kind == ORGANIZATION:
+            async for rows in iter_moysklad_rows("/entity/organization", page_size=1):
+                return {"default": _row_ref(rows[0])}
+            return {}
+        path, field = _SOURCES[kind]
+        found: dict[str, Ref] = {}
+        for row in await find_moysklad_rows(path, field, list(values.values())):
+            key = _row_key(kind, row)
+            if key in values:
+                found.setdefault(key, _row_ref(row))
+        return found
+
+    async def resolve(self, kind: str, values: dict[str, str]) -> dict[str, Ref | None]:
+        """Разрешает значения одного вида: values - ключ кэша -> значение для filter МойСклад.
+        Возвращает ключ -> (href, тип) или None, если значение не найдено. Ошибки МойСклад пробрасываются;
+        при недоступной БД поиск продолжается без уровня Postgres.
+        """
+        result: dict[str, Ref | None] = {}
+        now = time.monotonic()
+        missing: dict[str, str] = {}
+        for key, value in values.items():
+            entry = self._lru.get((kind, key))
+            if entry is not None and entry[1] > now:
+                self._lru.move_to_end((kind, key))
+                result[key] = entry[0]
+            else:
+                missing[key] = value
+        MS_RESOLVER_LOOKUPS.labels(kind, "memory").inc(len(values) - len(missing))
+        if not missing:
+            return result
+
+        try:
+            stored = await self._load(kind, list(missing))
+        except Exception as e:
+            logger.warning(f"Failed to read Moysklad reference cache ({kind}): {e}")
+            stored = {}
+        for key, ref in stored.items():
+            self._remember(kind, key, ref)
+            result[key] = ref
+            del missing[key]
+        MS_RESOLVER_LOOKUPS.labels(kind, "postgres").inc(len(stored))
+        if not missing:
+            return result
+
+        found = await self._fetch(kind, missing)
+        fetched = {key: found.get(key) for key in missing}
+        MS_RESOLVER_LOOKUPS.labels(kind, "moysklad").inc(len(fetched))
+        for key, ref in fetched.items():
+            self._remember(kind, key, ref)
+            result[key] = ref
+        try:
+            await self._save(kind, fetched)
+        except Exception as e:
+            logger.warning(f"Failed to save {len(fetched)} Moysklad references to cache ({kind}): {e}")
+        return result
+
+    async def resolve_assortment(self, skus: list[str]) -> dict[str, Ref | None]:
+        """SKU WooCommerce -> ссылка на ассортимент МойСклад (поле MS_SKU_FIELD)."""
+        return await self.resolve(ASSORTMENT, {sku: sku for sku in skus})
+
+    async def resolve_counterparties(self, customers: list[dict]) -> list[Ref | None]:
+        """Находит контрагентов для списка billing заказов WooCommerce: сначала по email, затем по телефону.
+        Значения всех заказов ищутся вместе - не более одного запроса на каждые MS_LOOKUP_CHUNK новых значений.
+        """
+        emails = [(c.get("email") or "").strip().lower() or None for c in customers]
+        by_email = await self.resolve(EMAIL, {email: email for email in emails if email})
+        refs = [by_email.get(email) if email else None for email in emails]
+
+        phones: dict[str, str] = {}
+        for customer, ref in zip(customers, refs):
+            key = normalize_phone(customer.get("phone")) if ref is None else None
+            if key:
+                phones.setdefault(key, customer["phone"].strip())
+        if phones:
+            by_phone = await self.resolve(PHONE, phones)
+            refs = [ref or by_phone.get(normalize_phone(c.get("phone")) or "") for c, ref in zip(customers, refs)]
+        return refs
+
+    async def get_organization(self) -> Ref | None:
+        """Юрлицо для заказов: MS_ORGANIZATION_HREF или первое юрлицо аккаунта МойСклад."""
+        if MS_ORGANIZATION_HREF:
+            return MS_ORGANIZATION_HREF, "organization"
+        return (await self.resolve(ORGANIZATION, {"default": ""})).get("default")
+
+    async def warm(self) -> dict[str, int]:
+        """Заполняет ms_ref_cache из полных выборок ассортимента и контрагентов (страница - один запрос в БД).
+        LRU процесса не заполняется: ссылки из Postgres подгружаются в него при первом обращении.
+        Возвращает количество сохраненных ссылок по видам. Ошибки пробрасываются.
+        """
+        counts = {ASSORTMENT: 0, EMAIL: 0, PHONE: 0}
+        async for rows in iter_moysklad_rows("/entity/assortment"):
+            entries = {key: _row_ref(row) for row in rows if (key := _row_key(ASSORTMENT, row))}
+            await self._save(ASSORTMENT, entries)
+            counts[ASSORTMENT] += len(entries)
+        async for rows in iter_moysklad_rows("/entity/counterparty"):
+            for kind in (EMAIL, PHONE):
+                entries: dict[str, Ref] = {}
+                for row in rows:
+                    key = _row_key(kind, row)
+                    if key:
+                        entries.setdefault(key, _row_ref(row))
+                await self._save(kind, entries)
+                counts[kind] += len(entries)
+        logger.info(f"Moysklad reference cache warmed: {counts}")
+        return counts
+
+
+_resolver: MoyskladResolver | None = None
+
+def get_ms_resolver() -> MoyskladResolver:
+    """Возвращает кэш ссылок МойСклад текущего процесса."""
+    global _resolver
+    if _resolver is None:
+        _resolver = MoyskladResolver()
+    return _resolver
@@ -0,0 +1,165 @@
+import asyncio
+import httpx
+import os
+import logging
+import time
+
+import redis.asyncio as aioredis
+
+logger = logging.getLogger(__name__)
+
+# Лимит МойСклад: не более MS_RATE_LIMIT запросов за MS_RATE_PERIOD секунд на аккаунт
+MS_RATE_LIMIT = int(os.getenv("MS_RATE_LIMIT", "45"))
+MS_RATE_PERIOD = float(os.getenv("MS_RATE_PERIOD", "3.0"))
+MS_MAX_PARALLEL = int(os.getenv("MS_MAX_PARALLEL", "5")) # Параллельных запросов из одного процесса
+MS_RATE_LIMIT_MAX_RETRIES = int(os.getenv("MS_RATE_LIMIT_MAX_RETRIES", "5")) # Повторов запроса после 429
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL") or os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
+
+# Атомарное резервирование токена в Redis. Токены могут уйти в минус: это очередь ожидающих,
+# каждый вызывающий получает свое время ожидания (мс), что равномерно распределяет запросы всех процессов.
+# Дополнительно учитывается общая пауза (pause_until), выставленная по заголовкам ответа МойСклад.
+_ACQUIRE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local data = redis.call('HMGET', KEYS[1], 'tokens', 'ts')
+local tokens = tonumber(data[1]) or capacity
+local ts = tonumber(data[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - ts) * rate) - 1
+redis.call('HSET', KEYS[1], 'tokens', tokens, 'ts', now)
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate) + 1000)
+local wait = 0
+if tokens < 0 then wait = math.ceil(-tokens / rate) end
+local pause_until = tonumber(redis.call('GET', KEYS[2]) or '0')
+if pause_until - now > wait then wait = pause_until - now end
+return wait
+"""
+
+_PAUSE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) * 1000 + math.floor(tonumber(t[2]) / 1000)
+local until_ms = now + tonumber(ARGV[1])
+local current = tonumber(redis.call('GET', KEYS[1]) or '0')
+if until_ms > current then redis.call('SET', KEYS[1], until_ms, 'PX', tonumber(ARGV[1]) + 1000) end
+return until_ms
+"""
+
+
+def get_retry_after(response: httpx.Response) -> float | None:
+    """Возвращает рекомендуемую паузу перед повтором (сек.) из заголовков ответа.
+    Поддерживает стандартный Retry-After и X-Lognex-Retry-TimeInterval МойСклад (в миллисекундах).
+    """
+    value = response.headers.get("X-Lognex-Retry-TimeInterval")
+    if value:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = response.headers.get("Retry-After")
+    if value:
+        try:
+            return float(value)
+        except ValueError:
+            pass
+    return None
+
+
+class RedisTokenBucket:
+    """Token bucket, общий для всех процессов воркеров через Redis брокера.
+    При недоступности Redis работает локально в процессе (лимит тогда соблюдается только приблизительно).
+    """
+
+    def __init__(self, name: str, limit: int, period: float, redis_url: str = RATE_LIMIT_REDIS_URL):
+        self.capacity = limit
+        self.rate = limit / (period * 1000) # Токенов в миллисекунду
+        self.bucket_key = f"ratelimit:{name}:bucket"
+        self.pause_key = f"ratelimit:{name}:pause_until"
+        self._redis_url = redis_url
+        self._redis: aioredis.Redis | None = None
+        # Локальный запасной вариант
+        self._local_tokens = float(limit)
+        self._local_ts = time.monotonic()
+        self._local_pause_until = 0.0
+
+    def _get_redis(self) -> aioredis.Redis:
+        if self._redis is None:
+            self._redis = aioredis.from_url(self._redis_url)
+        return self._redis
+
+    def _local_reserve(self) -> float:
+        now = time.monotonic()
+        self._local_tokens = min(self.capacity, self._local_tokens + (now - self._local_ts) * self.rate * 1000) - 1
+        self._local_ts = now
+        wait = -self._local_tokens / (self.rate * 1000) if self._local_tokens < 0 else 0.0
+        return max(wait, self._local_pause_until - now)
+
+    async def acquire(self):
+        """Резервирует право на запрос и ждет, если лимит исчерпан или действует пауза."""
+        try:
+            wait = int(await self._get_redis().eval(_ACQUIRE_SCRIPT, 2, self.bucket_key, self.pause_key, self.capacity, self.rate)) / 1000
+        except Exception as e:
+            logger.warning(f"Rate limiter Redis unavailable, using local bucket: {e}")
+            wait = self._local_reserve()
+        if wait > 0:
+            logger.debug(f"Rate limit: waiting {wait:.3f}s before request")
+            await asyncio.sleep(wait)
+
+    async def pause(self, seconds: float):
+        """Приостанавливает запросы всех процессов на seconds секунд."""
+        self._local_pause_until = max(self._local_pause_until, time.monotonic() + seconds)
+        try:
+            await self._get_redis().eval(_PAUSE_SCRIPT, 1, self.pause_key, int(seconds * 1000))
+        except Exception as e:
+            logger.warning(f"Rate limiter Redis unavailable, pausing locally: {e}")
+
+    async def close(self):
+        if self._redis is not None:
+            await self._redis.aclose()
+            self._redis = None
+
+
+class MoyskladRateLimitedTransport(httpx.AsyncBaseTransport):
+    """Транспорт httpx для МойСклад: перед каждым запросом берет токен из общего bucket,
+    по заголовкам X-RateLimit-Remaining / X-Lognex-Reset притормаживает заранее,
+    а при 429 ждет X-Lognex-Retry-TimeInterval и повторяет запрос вместо ошибки.
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport, bucket: RedisTokenBucket, max_parallel: int = MS_MAX_PARALLEL):
+        self._transport = transport
+        self._bucket = bucket
+        self._parallel = asyncio.Semaphore(max_parallel)
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        attempt = 0
+        while True:
+            await self._bucket.acquire()
+            async with self._parallel:
+                response = await self._transport.handle_async_request(request)
+
+            if response.status_code != 429 or attempt >= MS_RATE_LIMIT_MAX_RETRIES:
+                await self._pace(response)
+                return response
+
+            attempt += 1
+            retry_after = get_retry_after(response) or MS_RATE_PERIOD
+            await response.aclose()
+            logger.warning(f"Moysklad rate limit hit (429) for {request.method} {request.url.path}. Retrying in {retry_after:.2f}s (attempt {attempt}).")
+            await self._bucket.pause(retry_after)
+
+    async def _pace(self, response: httpx.Response):
+        """Если лимит почти исчерпан, ставит общую паузу до сброса окна."""
+        remaining = response.headers.get("X-RateLimit-Remaining")
+        if remaining is None:
+            return
+        try:
+            if int(remaining) > 1:
+                return
+            reset_ms = float(response.headers.get("X-Lognex-Reset", MS_RATE_PERIOD * 1000))
+        except ValueError:
+            return
+        await self._bucket.pause(reset_ms / 1000)
+
+    async def aclose(self):
+        await self._transport.aclose()
+        await self._bucket.close()
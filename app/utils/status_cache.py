@@ -0,0 +1,132 @@
+import asyncio
+import asyncpg
+import os
+import logging
+import time
+
+from app.db import DATABASE_URL, get_connection
+
+logger = logging.getLogger(__name__)
+
+STATUS_CACHE_TTL = float(os.getenv("STATUS_CACHE_TTL", "600")) # Сек. жизни кэша маппинга и статусов МС
+# Канал Postgres NOTIFY, в который пишет триггер на таблице status_mapping
+STATUS_MAPPING_CHANNEL = "status_mapping_changed"
+STATUS_LISTENER_RECONNECT_DELAY = float(os.getenv("STATUS_LISTENER_RECONNECT_DELAY", "5")) # Сек. между попытками переподключения LISTEN
+
+
+class StatusCache:
+    """Кэш процесса воркера: маппинг статусов из status_mapping и статусы заказов МойСклад (name <-> href).
+    Данные живут STATUS_CACHE_TTL секунд; маппинг сбрасывается сразу по NOTIFY при изменении status_mapping.
+    Потерянное соединение LISTEN переподключается в фоне; пока его нет, маппинг обновляется по TTL.
+    """
+
+    def __init__(self, ttl: float = STATUS_CACHE_TTL):
+        self.ttl = ttl
+        self._mapping: dict | None = None
+        self._mapping_loaded_at = 0.0
+        self._states: dict[str, str] | None = None # имя статуса -> href
+        self._states_loaded_at = 0.0
+        self._mapping_lock = asyncio.Lock()
+        self._states_lock = asyncio.Lock()
+        self._listener_conn: asyncpg.Connection | None = None
+        self._reconnect_task: asyncio.Task | None = None
+
+    def _fresh(self, loaded_at: float) -> bool:
+        return time.monotonic() - loaded_at < self.ttl
+
+    async def get_mapping(self) -> dict:
+        """Возвращает {"ms_to_wc": {...}, "wc_to_ms": {...}}. Ошибки загрузки пробрасываются."""
+        if self._mapping is not None and self._fresh(self._mapping_loaded_at):
+            return self._mapping
+        async with self._mapping_lock:
+            if self._mapping is None or not self._fresh(self._mapping_loaded_at):
+                async with get_connection() as conn:
+                    rows = await conn.fetch("SELECT moysklad_status, woocommerce_status FROM status_mapping")
+                ms_to_wc = {row["moysklad_status"]: row["woocommerce_status"] for row in rows}
+                wc_to_ms = {v: k for k, v in ms_to_wc.items()} # Генерируем обратный маппинг
+                self._mapping = {"ms_to_wc": ms_to_wc, "wc_to_ms": wc_to_ms}
+                self._mapping_loaded_at = time.monotonic()
+                logger.info(f"Status mapping loaded: {len(ms_to_wc)} entries.")
+        return self._mapping
+
+    async def get_states(self) -> dict[str, str]:
+        """Возвращает словарь имя статуса МойСклад -> href; все статусы загружаются одним запросом метаданных."""
+        if self._states is not None and self._fresh(self._states_loaded_at):
+            return self._states
+        async with self._states_lock:
+            if self._states is None or not self._fresh(self._states_loaded_at):
+                from app.utils.moysklad import fetch_moysklad_states # Локальный импорт: moysklad использует этот кэш
+                self._states = await fetch_moysklad_states()
+                self._states_loaded_at = time.monotonic()
+                logger.info(f"Moysklad order states loaded: {len(self._states)} states.")
+        return self._states
+
+    async def get_state_names(self) -> dict[str, str]:
+        """Возвращает словарь href статуса МойСклад -> имя."""
+        return {href: name for name, href in (await self.get_states()).items()}
+
+    def _on_notify(self, connection, pid, channel, payload):
+        logger.info(f"Received {channel} notification. Reloading status mapping on next use.")
+        self._mapping = None
+
+    async def _connect_listener(self):
+        conn = await asyncpg.connect(dsn=DATABASE_URL)
+        try:
+            await conn.add_listener(STATUS_MAPPING_CHANNEL, self._on_notify)
+        except Exception:
+            await conn.close()
+            raise
+        conn.add_termination_listener(self._on_listener_terminated)
+        self._listener_conn = conn
+
+    def _on_listener_terminated(self, connection):
+        if connection is not self._listener_conn:
+            return # Соединение закрыто stop_listener
+        logger.warning(f"Status mapping listener connection lost. Reconnecting in {STATUS_LISTENER_RECONNECT_DELAY:.0f}s.")
+        self._listener_conn = None
+        self._schedule_reconnect()
+
+    def _schedule_reconnect(self):
+        if self._reconnect_task is None or self._reconnect_task.done():
+            self._reconnect_task = asyncio.create_task(self._reconnect())
+
+    async def _reconnect(self):
+        while self._listener_conn is None:
+            await asyncio.sleep(STATUS_LISTENER_RECONNECT_DELAY)
+            try:
+                await self._connect_listener()
+            except Exception as e:
+                logger.warning(f"Failed to reconnect status mapping listener: {e}")
+                continue
+            # Уведомления, пришедшие без соединения, потеряны - перечитываем маппинг
+            self._mapping = None
+            logger.info(f"Status mapping listener reconnected to '{STATUS_MAPPING_CHANNEL}'.")
+
+    async def start_listener(self):
+        """Подписывается на NOTIFY об изменениях status_mapping на отдельном соединении (не из пула).
+        Если подключиться не удалось или соединение потеряно, переподключение идет в фоне каждые STATUS_LISTENER_RECONNECT_DELAY сек.
+        """
+        if not DATABASE_URL or self._listener_conn is not None:
+            return
+        try:
+            await self._connect_listener()
+            logger.info(f"Listening for '{STATUS_MAPPING_CHANNEL}' notifications.")
+        except Exception as e:
+            # Без LISTEN кэш все равно обновится по TTL
+            logger.exception(f"Failed to start status mapping listener: {e}")
+            self._schedule_reconnect()
+
+    async def stop_listener(self):
+        if self._reconnect_task is not None:
+            self._reconnect_task.cancel()
+            self._reconnect_task = None
+        conn, self._listener_conn = self._listener_conn, None
+        if conn is not None:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.exception(f"Failed to close status mapping listener: {e}")
+
+
+# Единый кэш процесса воркера
+status_cache = StatusCache()
@@ -0,0 +1,218 @@
+import asyncio
+import functools
+import json
+import os
+import logging
+import time
+import uuid
+
+import redis.asyncio as aioredis
+from celery import current_app
+
+from app.metrics import TASK_OVERLAPS
+
+logger = logging.getLogger(__name__)
+
+TASK_LOCKS_ENABLED = os.getenv("TASK_LOCKS_ENABLED", "true").lower() in ("1", "true", "yes")
+TASK_LOCK_REDIS_URL = os.getenv("TASK_LOCK_REDIS_URL") or os.getenv("CELERY_BROKER_URL", "redis://redis:6379/0")
+TASK_LOCK_LEASE = float(os.getenv("TASK_LOCK_LEASE", "60")) # Сек. аренды; продлевается каждую треть аренды
+TASK_LOCK_RETRY_DELAY = float(os.getenv("TASK_LOCK_RETRY_DELAY", "30")) # Сек. до повтора запуска с политикой queue
+# Переопределение политик: "task_name=skip|queue|coalesce,..."
+TASK_OVERLAP_POLICIES = os.getenv("TASK_OVERLAP_POLICIES", "")
+
+SKIP = "skip"
+QUEUE = "queue"
+COALESCE = "coalesce"
+POLICIES = (SKIP, QUEUE, COALESCE)
+
+# KEYS[1] - блокировка; ARGV[1] - токен владельца, ARGV[2] - аренда (мс)
+_RENEW_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+  return redis.call('PEXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+# KEYS[1] - блокировка, KEYS[2] - отложенные запуски (coalesce); ARGV[1] - токен владельца.
+# Освобождение и выборка отложенных запусков атомарны: запрос, пришедший позже, возьмет блокировку сам.
+_RELEASE_SCRIPT = """
+if redis.call('GET', KEYS[1]) ~= ARGV[1] then
+  return {}
+end
+redis.call('DEL', KEYS[1])
+local pending = redis.call('SMEMBERS', KEYS[2])
+redis.call('DEL', KEYS[2])
+return pending
+"""
+
+# KEYS[1] - блокировка, KEYS[2] - отложенные запуски; ARGV[1] - аргументы запуска (JSON), ARGV[2] - срок хранения (мс).
+# Возвращает 1, если запуск отложен (блокировка занята), 0 - блокировка уже свободна.
+_DEFER_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then
+  return 0
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('PEXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+
+def _parse_policies(value: str) -> dict[str, str]:
+    policies = {}
+    for item in value.split(","):
+        name, sep, policy = item.partition("=")
+        policy = policy.strip().lower()
+        if sep and name.strip() and policy in POLICIES:
+            policies[name.strip()] = policy
+        elif item.strip():
+            logger.warning(f"Ignoring invalid TASK_OVERLAP_POLICIES entry: '{item.strip()}'")
+    return policies
+
+_policy_overrides = _parse_policies(TASK_OVERLAP_POLICIES)
+
+_redis: aioredis.Redis | None = None
+
+def _get_redis() -> aioredis.Redis:
+    global _redis
+    if _redis is None:
+        _redis = aioredis.from_url(TASK_LOCK_REDIS_URL)
+    return _redis
+
+
+class TaskLockLost(Exception):
+    """Аренда блокировки истекла во время выполнения задачи; задача прервана."""
+
+
+class TaskLock:
+    """Блокировка с арендой и фоновым продлением. Владелец определяется случайным токеном,
+    поэтому процесс не продлит и не снимет блокировку, перехваченную другим после истечения его аренды.
+    Если аренду продлить не удалось до ее истечения, задача, взявшая блокировку, отменяется.
+    """
+
+    def __init__(self, name: str, lease: float = TASK_LOCK_LEASE):
+        self.name = name
+        self.key = f"tasklock:{name}"
+        self.pending_key = f"tasklock:{name}:pending"
+        self.lease = lease
+        self._token = uuid.uuid4().hex
+        self._renewal: asyncio.Task | None = None
+        self._owner: asyncio.Task | None = None
+        self.lost = False
+
+    async def acquire(self) -> bool:
+        started = time.monotonic()
+        acquired = bool(await _get_redis().set(self.key, self._token, nx=True, px=int(self.lease * 1000)))
+        if acquired:
+            self._owner = asyncio.current_task()
+            self._renewal = asyncio.create_task(self._renew(started + self.lease))
+        return acquired
+
+    async def _renew(self, expires_at: float):
+        while True:
+            await asyncio.sleep(self.lease / 3)
+            started = time.monotonic()
+            try:
+                renewed = await _get_redis().eval(_RENEW_SCRIPT, 1, self.key, self._token, int(self.lease * 1000))
+            except Exception as e:
+                if time.monotonic() < expires_at:
+                    logger.warning(f"Failed to renew task lock '{self.name}': {e}")
+                    continue
+                renewed = 0
+            if not renewed:
+                # Блокировку мог взять другой запуск - прерываем этот, чтобы не выполняться одновременно
+                logger.error(f"Task lock '{self.name}' was lost (lease expired). Cancelling the running task.")
+                self.lost = True
+                if self._owner is not None:
+                    self._owner.cancel()
+                return
+            expires_at = started + self.lease
+
+    async def release(self) -> list[str]:
+        """Снимает блокировку и возвращает отложенные запуски (JSON аргументов) политики coalesce."""
+        if self._renewal is not None:
+            self._renewal.cancel()
+            self._renewal = None
+        pending = await _get_redis().eval(_RELEASE_SCRIPT, 2, self.key, self.pending_key, self._token)
+        return [item.decode() if isinstance(item, bytes) else item for item in pending]
+
+    async def defer(self, args: tuple, kwargs: dict) -> bool:
+        """Запоминает запуск для повтора после снятия блокировки. False - блокировка уже свободна."""
+        payload = json.dumps({"args": list(args), "kwargs": kwargs}, sort_keys=True)
+        ttl_ms = int(max(self.lease, TASK_LOCK_RETRY_DELAY) * 10 * 1000)
+        return bool(await _get_redis().eval(_DEFER_SCRIPT, 2, self.key, self.pending_key, payload, ttl_ms))
+
+
+async def _send_task(task_name: str, args, kwargs, countdown: float | None = None):
+    """Ставит задачу в очередь (send_task блокирующий - выполняется в потоке, event loop не блокируется)."""
+    await asyncio.to_thread(current_app.send_task, task_name, args=list(args), kwargs=kwargs, countdown=countdown)
+
+
+def singleton(task_name: str, policy: str = SKIP, lease: float = TASK_LOCK_LEASE):
+    """Декоратор async задачи Celery: не более одного одновременного запуска task_name во всех воркерах.
+    policy - поведение при пересечении запусков (skip, queue, coalesce); переопределяется TASK_OVERLAP_POLICIES.
+    При недоступном Redis задача выполняется без блокировки; при потере аренды задача прерывается с TaskLockLost.
+    """
+    policy = _policy_overrides.get(task_name, policy)
+
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not TASK_LOCKS_ENABLED:
+                return await func(*args, **kwargs)
+            lock = TaskLock(task_name, lease)
+            try:
+                acquired = await lock.acquire()
+            except Exception as e:
+                logger.warning(f"Task lock Redis unavailable, running '{task_name}' without lock: {e}")
+                return await func(*args, **kwargs)
+
+            if not acquired:
+                TASK_OVERLAPS.labels(task_name, policy).inc()
+                try:
+                    if policy == QUEUE:
+                        logger.info(f"Task '{task_name}' is already running. Re-queued in {TASK_LOCK_RETRY_DELAY:.0f}s.")
+                        await _send_task(task_name, args, kwargs, countdown=TASK_LOCK_RETRY_DELAY)
+                        return None
+                    if policy == COALESCE:
+                        if await lock.defer(args, kwargs):
+                            logger.info(f"Task '{task_name}' is already running. Coalesced into one run after it.")
+                            return None
+                        # Блокировка освободилась между попытками - запускаемся сами
+                        if await lock.acquire():
+                            acquired = True
+                except Exception as e:
+                    logger.warning(f"Failed to apply overlap policy '{policy}' for task '{task_name}': {e}")
+                if not acquired:
+                    logger.info(f"Task '{task_name}' is already running. Skipping this run.")
+                    return None
+
+            try:
+                return await func(*args, **kwargs)
+            except asyncio.CancelledError:
+                if lock.lost:
+                    raise TaskLockLost(f"Task lock '{task_name}' was lost while the task was running")
+                raise
+            finally:
+                try:
+                    pending = await lock.release()
+                except Exception as e:
+                    logger.warning(f"Failed to release task lock '{task_name}' (expires in {lease:.0f}s): {e}")
+                    pending = []
+                for item in pending:
+                    run = json.loads(item)
+                    logger.info(f"Starting coalesced run of task '{task_name}'.")
+                    try:
+                        await _send_task(task_name, run["args"], run["kwargs"])
+                    except Exception as e:
+                        logger.error(f"Failed to enqueue coalesced run of task '{task_name}': {e}")
+
+        return wrapper
+    return decorator
+
+
+async def close_task_locks():
+    """Закрывает соединение с Redis блокировок процесса."""
+    global _redis
+    if _redis is not None:
+        await _redis.aclose()
+        _redis = None
@@ -1,64 +1,245 @@
+import asyncio
 import httpx
 import os
 import logging
+from datetime import datetime
+from typing import AsyncIterator
+
+from app.utils.http_client import get_wc_client
 
 logger = logging.getLogger(__name__)
 
 WC_API_URL = os.getenv("WC_API_URL")
 WC_CONSUMER_KEY = os.getenv("WC_CONSUMER_KEY")
 WC_CONSUMER_SECRET = os.getenv("WC_CONSUMER_SECRET")
-HTTP_TIMEOUT = 15.0
 
-async def update_wc_order_status(order_id: int, new_status: str):
-    """Обновляет статус заказа в WooCommerce.
-    (Требуется реальная реализация)
+WC_PAGE_SIZE = 100 # Максимальный per_page WooCommerce REST API
+WC_PAGE_CONCURRENCY = int(os.getenv("WC_PAGE_CONCURRENCY", "4")) # Сколько страниц загружать одновременно
+WC_STATUS_SYNC_FIELDS = "id,status,meta_data,date_modified_gmt"
+
+def parse_wc_datetime(value: str | None) -> datetime | None:
+    """Разбирает дату WooCommerce в формате ISO8601 ("2024-01-31T12:00:00")."""
+    if not value:
+        return None
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        logger.warning(f"Unexpected WooCommerce datetime format: {value}")
+        return None
+
+async def iter_wc_orders(modified_after: datetime | None = None, params: dict | None = None, fields: str = WC_STATUS_SYNC_FIELDS) -> AsyncIterator[list[dict]]:
+    """Постранично получает заказы WooCommerce, измененные после modified_after (UTC), по возрастанию id.
+    Количество страниц берется из X-WP-TotalPages первой страницы, остальные загружаются параллельно
+    (не более WC_PAGE_CONCURRENCY одновременно) и отдаются по порядку. Запрашиваются только поля fields.
+    Сортировка по неизменяемому id: заказ, измененный во время выборки, не сдвигает страницы. Ошибки HTTP пробрасываются.
     """
     if not all([WC_API_URL, WC_CONSUMER_KEY, WC_CONSUMER_SECRET]):
-        logger.error("WC API credentials missing for status update.")
+        logger.error("WC API credentials missing for getting orders.")
         raise ValueError("Missing WC API configuration.")
 
-    url = f"{WC_API_URL}/orders/{order_id}"
+    url = f"{WC_API_URL}/orders"
     auth = (WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
-    payload = {"status": new_status}
+    base_params = {"orderby": "id", "order": "asc", "per_page": WC_PAGE_SIZE, "_fields": fields}
+    if modified_after:
+        base_params["modified_after"] = modified_after.strftime("%Y-%m-%dT%H:%M:%S")
+        base_params["dates_are_gmt"] = "true"
+    if params:
+        base_params.update(params)
 
-    try:
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-            response = await client.put(url, json=payload, auth=auth)
-            response.raise_for_status()
-            logger.info(f"Successfully updated WC order {order_id} status to {new_status}")
-            # В реальной реализации может потребоваться обработка ответа
-            # return response.json()
-    except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error updating WC order {order_id} status to {new_status}: {e.response.status_code} - {e.response.text}")
-        raise # Передаем исключение дальше
-    except Exception as e:
-        logger.exception(f"Error updating WC order {order_id} status: {e}")
-        raise
-
-async def get_wc_orders_for_status_sync(params: dict | None = None) -> list[dict]:
-    """Получает заказы из WooCommerce для синхронизации статусов.
-    (Требуется реальная реализация - определить критерии выборки)
+    client = get_wc_client()
+
+    async def fetch_page(page: int) -> httpx.Response:
+        response = await client.get(url, params={**base_params, "page": page}, auth=auth)
+        response.raise_for_status()
+        return response
+
+    first = await fetch_page(1)
+    total_pages = int(first.headers.get("X-WP-TotalPages", "1") or 1)
+    logger.info(f"Fetching {first.headers.get('X-WP-Total', '?')} WC orders in {total_pages} pages.")
+    yield first.json()
+
+    for start in range(2, total_pages + 1, WC_PAGE_CONCURRENCY):
+        pages = range(start, min(start + WC_PAGE_CONCURRENCY, total_pages + 1))
+        responses = await asyncio.gather(*(fetch_page(page) for page in pages))
+        for response in responses:
+            yield response.json()
+
+# --- Пакетные обновления заказов через POST /orders/batch ---
+
+WC_BATCH_MAX_SIZE = 100 # Ограничение WooCommerce REST API на количество элементов в batch
+WC_BATCH_SIZE = max(1, min(int(os.getenv("WC_BATCH_SIZE", "100")), WC_BATCH_MAX_SIZE))
+# Окно рассчитано на конкурентных отправителей (status_sync, app.order_worker); одиночное обновление уходит сразу
+WC_BATCH_WINDOW = float(os.getenv("WC_BATCH_WINDOW", "0.2")) # Сек. ожидания накопления пачки
+
+class WCBatchError(Exception):
+    """Ошибка обновления конкретного заказа в пакетном запросе WooCommerce."""
+
+async def _post_wc_batch(path: str, updates: list[dict]) -> dict[int, str | None]:
+    """POST {path} {"update": updates} (до WC_BATCH_MAX_SIZE элементов с "id").
+    Возвращает словарь id -> текст ошибки (None при успехе). Ошибки HTTP пробрасываются.
     """
     if not all([WC_API_URL, WC_CONSUMER_KEY, WC_CONSUMER_SECRET]):
-        logger.error("WC API credentials missing for getting orders.")
-        return []
+        logger.error("WC API credentials missing for batch update.")
+        raise ValueError("Missing WC API configuration.")
+    if len(updates) > WC_BATCH_MAX_SIZE:
+        raise ValueError(f"WooCommerce batch accepts at most {WC_BATCH_MAX_SIZE} updates, got {len(updates)}")
 
-    url = f"{WC_API_URL}/orders"
+    url = f"{WC_API_URL}{path}"
     auth = (WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
-    # Пример параметров: получить последние 10 обновленных заказов
-    default_params = {'orderby': 'modified', 'order': 'desc', 'per_page': 10}
-    if params:
-        default_params.update(params)
 
-    try:
-        async with httpx.AsyncClient(timeout=HTTP_TIMEOUT) as client:
-            response = await client.get(url, params=default_params, auth=auth)
-            response.raise_for_status()
-            logger.info(f"Fetched {len(response.json())} orders from WC for status sync.")
-            return response.json()
-    except httpx.HTTPStatusError as e:
-        logger.error(f"HTTP error fetching WC orders: {e.response.status_code} - {e.response.text}")
-        return []
-    except Exception as e:
-        logger.exception(f"Error fetching WC orders: {e}")
-        return [] 
\ No newline at end of file
+    client = get_wc_client()
+    response = await client.post(url, json={"update": updates}, auth=auth)
+    response.raise_for_status()
+    data = response.json()
+
+    results: dict[int, str | None] = {int(u["id"]): "Missing in batch response" for u in updates}
+    for item in data.get("update", []):
+        try:
+            item_id = int(item.get("id"))
+        except (TypeError, ValueError):
+            continue
+        error = item.get("error")
+        results[item_id] = (error.get("message") or error.get("code") or "Unknown error") if error else None
+    return results
+
+async def update_wc_orders_batch(updates: list[dict]) -> dict[int, str | None]:
+    """Отправляет до WC_BATCH_MAX_SIZE обновлений заказов одним запросом POST /orders/batch.
+    Каждый элемент updates должен содержать "id". Возвращает словарь id -> текст ошибки (None при успехе).
+    """
+    results = await _post_wc_batch("/orders/batch", updates)
+    failed = sum(1 for err in results.values() if err)
+    logger.info(f"WC batch update: {len(updates) - failed}/{len(updates)} orders updated.")
+    return results
+
+async def update_wc_products_batch(updates: list[dict], parent_id: int = 0) -> dict[int, str | None]:
+    """Отправляет до WC_BATCH_MAX_SIZE обновлений товаров одним запросом: POST /products/batch,
+    для вариаций товара parent_id - POST /products/{parent_id}/variations/batch. Результат - как у update_wc_orders_batch.
+    """
+    path = f"/products/{parent_id}/variations/batch" if parent_id else "/products/batch"
+    return await _post_wc_batch(path, updates)
+
+WC_SKU_LOOKUP_CHUNK = 50 # SKU в одном параметре sku (через запятую; ограничение длины URL)
+
+async def find_wc_products_by_sku(skus: list[str]) -> dict[str, tuple[int, int]]:
+    """Ищет товары и вариации WooCommerce по SKU: GET /products?sku=a,b (один запрос на WC_SKU_LOOKUP_CHUNK SKU).
+    Возвращает словарь SKU -> (id, parent_id); у простых товаров parent_id = 0. Ошибки HTTP пробрасываются.
+    """
+    if not all([WC_API_URL, WC_CONSUMER_KEY, WC_CONSUMER_SECRET]):
+        logger.error("WC API credentials missing for product lookup.")
+        raise ValueError("Missing WC API configuration.")
+
+    url = f"{WC_API_URL}/products"
+    auth = (WC_CONSUMER_KEY, WC_CONSUMER_SECRET)
+    client = get_wc_client()
+    found: dict[str, tuple[int, int]] = {}
+    for start in range(0, len(skus), WC_SKU_LOOKUP_CHUNK):
+        chunk = skus[start:start + WC_SKU_LOOKUP_CHUNK]
+        params = {"sku": ",".join(chunk), "per_page": WC_PAGE_SIZE, "_fields": "id,sku,parent_id"}
+        response = await client.get(url, params=params, auth=auth)
+        response.raise_for_status()
+        for product in response.json():
+            if product.get("sku"):
+                found.setdefault(product["sku"], (int(product["id"]), int(product.get("parent_id") or 0)))
+    return found
+
+def _merge_order_update(current: dict, update: dict) -> dict:
+    """Объединяет два обновления одного заказа: поля перезаписываются, meta_data сливается по ключу."""
+    merged = {**current, **update}
+    if "meta_data" in current and "meta_data" in update:
+        meta = {m["key"]: m for m in current["meta_data"]}
+        meta.update({m["key"]: m for m in update["meta_data"]})
+        merged["meta_data"] = list(meta.values())
+    return merged
+
+class WCWriteBackQueue:
+    """Очередь обновлений заказов WooCommerce с объединением (coalescing) по order_id.
+    Обновления отправляются через /orders/batch по размеру (max_size) или по истечении окна (window сек.).
+    Если в очереди только одно обновление и запросов в полете нет (например, задача process_order в Celery prefork),
+    оно отправляется сразу.
+    """
+
+    def __init__(self, max_size: int = WC_BATCH_SIZE, window: float = WC_BATCH_WINDOW):
+        self.max_size = max_size
+        self.window = window
+        self._pending: dict[int, dict] = {} # order_id -> объединенное обновление
+        self._waiters: dict[int, list[asyncio.Future]] = {}
+        self._timer: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+
+    async def submit(self, order_id: int, update: dict):
+        """Ставит обновление заказа в очередь и ждет результата. При ошибке выбрасывает WCBatchError."""
+        order_id = int(order_id)
+        future = asyncio.get_running_loop().create_future()
+        if order_id in self._pending:
+            self._pending[order_id] = _merge_order_update(self._pending[order_id], update)
+        else:
+            self._pending[order_id] = update
+        self._waiters.setdefault(order_id, []).append(future)
+
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.create_task(self._flush_later())
+        await future
+
+    async def _flush_later(self):
+        # Первый шаг таймера выполняется после уже запущенных конкурентных submit (они успевают попасть в очередь)
+        await asyncio.sleep(0)
+        if len(self._pending) > 1 or self._inflight:
+            await asyncio.sleep(self.window)
+        self._timer = None
+        self._flush()
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+        pending, self._pending = self._pending, {}
+        waiters, self._waiters = self._waiters, {}
+        task = asyncio.create_task(self._send(pending, waiters))
+        self._inflight.add(task)
+        task.add_done_callback(self._inflight.discard)
+
+    async def _send(self, pending: dict[int, dict], waiters: dict[int, list[asyncio.Future]]):
+        updates = [{"id": order_id, **update} for order_id, update in pending.items()]
+        try:
+            results = await update_wc_orders_batch(updates)
+        except Exception as e:
+            logger.error(f"WC batch update of {len(updates)} orders failed: {e}")
+            for futures in waiters.values():
+                for future in futures:
+                    if not future.done():
+                        future.set_exception(e)
+            return
+
+        for order_id, futures in waiters.items():
+            error = results.get(order_id)
+            for future in futures:
+                if future.done():
+                    continue
+                if error:
+                    future.set_exception(WCBatchError(f"Failed to update WC order {order_id}: {error}"))
+                else:
+                    future.set_result(None)
+
+    async def drain(self):
+        """Отправляет накопленные обновления и дожидается всех запросов в полете."""
+        self._flush()
+        if self._inflight:
+            await asyncio.gather(*self._inflight, return_exceptions=True)
+
+_write_back_queue: WCWriteBackQueue | None = None
+
+def get_wc_write_back_queue() -> WCWriteBackQueue:
+    """Возвращает очередь обновлений WooCommerce текущего процесса (создается лениво внутри event loop)."""
+    global _write_back_queue
+    if _write_back_queue is None:
+        _write_back_queue = WCWriteBackQueue()
+    return _write_back_queue
+
+async def queue_wc_order_status(order_id: int, new_status: str):
+    """Ставит обновление статуса заказа в пакетную очередь WooCommerce и ждет результата."""
+    await get_wc_write_back_queue().submit(order_id, {"status": new_status})
+    logger.info(f"Successfully updated WC order {order_id} status to {new_status}", extra={"order_id": order_id, "sample": True})
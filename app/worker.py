@@ -1,33 +1,36 @@
 import os
 import logging
-import asyncio # Добавляем asyncio
 from celery import Celery
-from celery.signals import worker_process_init, worker_process_shutdown # Сигналы
+from celery.signals import setup_logging, task_prerun, task_postrun, worker_init, worker_process_init, worker_process_shutdown # Сигналы
 
-from app.db import init_db_pool, close_db_pool # Импортируем функции пула
+from app.logging_config import configure_logging, restart_logging_listener, stop_logging, bind_log_context, reset_log_context # Логирование
+from app.async_task import AsyncTask, run_async, close_worker_loop # Общий event loop процесса
+from app.db import init_db_pool, close_db_pool, run_migrations # Импортируем функции пула
+from app.utils.http_client import init_http_clients, close_http_clients # Общие HTTP клиенты
+from app.utils.status_cache import status_cache # Кэш маппинга статусов
+from app.utils.task_lock import close_task_locks # Блокировки периодических задач
+from app.metrics import clear_multiprocess_dir, mark_process_dead, start_metrics_server # Prometheus
+from app.tracing import init_tracing, shutdown_tracing # OpenTelemetry
 
-# --- Настройка логирования --- (Базовая)
-LOG_FILE = "app_worker.log"
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler(LOG_FILE), # Вывод в файл
-        logging.StreamHandler() # Вывод в консоль
-    ]
-)
+# --- Настройка логирования --- (JSON, запись через очередь в фоновом потоке)
+configure_logging()
 logger = logging.getLogger(__name__)
 
 # Загружаем конфигурацию Celery из переменных окружения
 CELERY_BROKER_URL = os.getenv('CELERY_BROKER_URL', 'redis://redis:6379/0')
 CELERY_RESULT_BACKEND = os.getenv('CELERY_RESULT_BACKEND', 'redis://redis:6379/0')
+# Отдельная очередь для process_order и process_wc_order (ее читает и app.order_worker)
+ORDERS_QUEUE = os.getenv('ORDERS_QUEUE', 'orders')
+# Применять миграции схемы БД при старте процесса воркера
+MIGRATE_ON_STARTUP = os.getenv('MIGRATE_ON_STARTUP', 'true').lower() in ('1', 'true', 'yes')
 
 # Создаем экземпляр Celery
 celery_app = Celery(
     'worker',
     broker=CELERY_BROKER_URL,
     backend=CELERY_RESULT_BACKEND,
-    include=['tasks.orders', 'tasks.status_sync'] # Указываем модули с задачами
+    task_cls=AsyncTask, # async def задачи выполняются на общем event loop процесса
+    include=['app.tasks.orders', 'app.tasks.status_sync', 'app.tasks.pipeline', 'app.tasks.catalog'] # Указываем модули с задачами
 )
 
 # Настройки Celery (можно вынести в отдельный конфиг)
@@ -37,8 +40,14 @@ celery_app.conf.update(
     result_serializer='json',
     timezone='Europe/Moscow', # Пример таймзоны
     enable_utc=True,
-    # Настройки для периодических задач (Beat)
+    task_routes={'process_order': {'queue': ORDERS_QUEUE}, 'process_wc_order': {'queue': ORDERS_QUEUE}},
+    # Настройки для периодических задач (Beat). Пересечение запусков задач разрешается блокировками
+    # app.utils.task_lock (политики skip/queue/coalesce, переопределяются TASK_OVERLAP_POLICIES)
     beat_schedule = {
+        'order-pipeline-sweep': {
+            'task': 'order_pipeline_sweep',
+            'schedule': 60.0, # повторы шагов конвейера и перенос исчерпавших попытки в dead letter
+        },
         'retry-pending-orders-every-5-minutes': {
             'task': 'retry_pending_orders',
             'schedule': 300.0, # каждые 5 минут (в секундах)
@@ -52,22 +61,77 @@ celery_app.conf.update(
             'task': 'sync_statuses_to_moysklad_task',
             'schedule': 3600.0, # каждый час
         },
+        'sync-catalog-stock': {
+            'task': 'sync_catalog_stock',
+            'schedule': 300.0, # каждые 5 минут: только измененные SKU
+        },
+        'sync-catalog-stock-full': {
+            'task': 'sync_catalog_stock',
+            'schedule': 86400.0, # раз в сутки: все SKU, повторный поиск не найденных в WooCommerce
+            'kwargs': {'full': True},
+        },
+        'warm-moysklad-ref-cache': {
+            'task': 'warm_moysklad_ref_cache',
+            'schedule': 21600.0, # каждые 6 часов (MS_RESOLVER_TTL - сутки)
+        },
     }
 )
 
-# --- Управление пулом соединений БД через сигналы Celery ---
+# --- Логирование ---
+@setup_logging.connect
+def on_setup_logging(**kwargs):
+    """Обработчик сигнала отключает перенастройку корневого логгера Celery: логирование уже настроено configure_logging()."""
+    configure_logging()
+
+_task_log_tokens: dict[str, object] = {}
+
+@task_prerun.connect
+def on_task_prerun(task_id=None, **kwargs):
+    """Добавляет task_id ко всем записям лога задачи (контекст наследуют корутины задачи)."""
+    _task_log_tokens[task_id] = bind_log_context(task_id=task_id)
+
+@task_postrun.connect
+def on_task_postrun(task_id=None, **kwargs):
+    token = _task_log_tokens.pop(task_id, None)
+    if token is not None:
+        reset_log_context(token)
+
+# --- Эндпоинт метрик: в главном процессе воркера, агрегирует метрики дочерних процессов ---
+@worker_init.connect
+def on_worker_main_init(**kwargs):
+    """Запуск HTTP эндпоинта /metrics до создания процессов prefork."""
+    clear_multiprocess_dir()
+    start_metrics_server()
+
+# --- Управление пулом соединений БД и HTTP клиентами через сигналы Celery ---
 @worker_process_init.connect
 def on_worker_init(**kwargs):
-    """Инициализация пула при старте воркера Celery."""
-    logger.info("Worker process initializing... Setting up DB pool.")
-    # Запускаем асинхронную функцию инициализации в event loop
-    asyncio.get_event_loop().run_until_complete(init_db_pool())
+    """Инициализация пула и HTTP клиентов при старте воркера Celery."""
+    restart_logging_listener() # Поток записи логов не переживает fork
+    logger.info("Worker process initializing... Setting up DB pool and HTTP clients.")
+    init_tracing() # После fork: у каждого процесса свой поток экспорта spans
+    # Пул и клиенты создаются на том же event loop, на котором потом выполняются задачи
+    run_async(init_db_pool())
+    if MIGRATE_ON_STARTUP:
+        try:
+            run_async(run_migrations())
+        except Exception as e:
+            logger.exception(f"Failed to apply DB migrations: {e}")
+    run_async(init_http_clients())
+    run_async(status_cache.start_listener())
 
 @worker_process_shutdown.connect
 def on_worker_shutdown(**kwargs):
-    """Закрытие пула при остановке воркера Celery."""
-    logger.info("Worker process shutting down... Closing DB pool.")
-    asyncio.get_event_loop().run_until_complete(close_db_pool())
+    """Закрытие пула и HTTP клиентов при остановке воркера Celery."""
+    logger.info("Worker process shutting down... Closing DB pool and HTTP clients.")
+    run_async(status_cache.stop_listener())
+    run_async(close_http_clients())
+    run_async(close_task_locks())
+    run_async(close_db_pool())
+    close_worker_loop()
+    mark_process_dead(os.getpid())
+    shutdown_tracing()
+    stop_logging()
 
 if __name__ == '__main__':
     celery_app.start() 
\ No newline at end of file
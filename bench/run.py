@@ -0,0 +1,253 @@
+"""Офлайн бенчмарк конвейера синхронизации на заглушках МойСклад/WooCommerce и одноразовом Postgres.
+
+Запуск из корня репозитория:
+    python -m bench.run --scenario orders --orders 2000 --concurrency 200
+    python -m bench.run --scenario orders --batch --latency 0.1 --error-rate 0.02
+    python -m bench.run --scenario retry --orders 1000
+    python -m bench.run --scenario status_from_ms --orders 5000
+    python -m bench.run --scenario catalog --orders 30000
+    python -m bench.run --scenario all --json > before.json
+
+Выводит заказов в секунду, p50/p99 задержки заказа (для сценария orders), запросов к БД на заказ
+и количество запросов к API по эндпоинтам.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from bench.postgres import disposable_postgres
+from bench.stubs import MoyskladStub, StubConfig, WooCommerceStub
+
+SCENARIOS = ("orders", "retry", "status_from_ms", "status_to_ms", "catalog")
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenario", choices=SCENARIOS + ("all",), default="orders")
+    parser.add_argument("--orders", type=int, default=1000, help="Заказов в сценарии")
+    parser.add_argument("--concurrency", type=int, default=100, help="Одновременно обрабатываемых заказов (сценарий orders)")
+    parser.add_argument("--batch", action="store_true", help="Пакетная отправка в МойСклад (MS_BATCH_ENABLED)")
+    parser.add_argument("--latency", type=float, default=0.05, help="Средняя задержка ответа заглушек, сек.")
+    parser.add_argument("--jitter", type=float, default=0.5, help="Разброс задержки (доля от latency)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--item-error-rate", type=float, default=0.0, help="Доля ошибочных элементов в пакетных ответах")
+    parser.add_argument("--ms-rate-limit", action="store_true", help="Пропускать запросы МойСклад через ограничитель частоты (Redis или локальный)")
+    parser.add_argument("--database-url", default=os.getenv("BENCH_DATABASE_URL"),
+                        help="Одноразовая база (таблицы синхронизации очищаются). По умолчанию запускается временный Postgres")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="Вывести результаты в JSON")
+    return parser.parse_args(argv)
+
+
+def _configure_env(args: argparse.Namespace, database_url: str):
+    """Настройки приложения читаются при импорте модулей, поэтому окружение задается до импорта app."""
+    os.environ.update({
+        "DATABASE_URL": database_url,
+        "MOYSKLAD_API_URL": MoyskladStub.base,
+        "MOYSKLAD_TOKEN": "bench",
+        "WC_API_URL": WooCommerceStub.base,
+        "WC_CONSUMER_KEY": "bench",
+        "WC_CONSUMER_SECRET": "bench",
+        "MS_BATCH_ENABLED": "true" if args.batch else "false",
+        "MS_RATE_LIMIT_ENABLED": "true" if args.ms_rate_limit else "false",
+    })
+    for key, value in {"LOG_LEVEL": "WARNING", "LOG_FILE": "", "LOG_FORMAT": "text", "TRACING_EXPORTER": "none", "TASK_LOCKS_ENABLED": "false"}.items():
+        os.environ.setdefault(key, value)
+
+
+def _percentile(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+def _order_payload(order_id: int) -> dict:
+    return {
+        "name": f"WC-{order_id}",
+        "externalCode": str(order_id),
+        "organization": {"meta": {"href": f"{MoyskladStub.base}/entity/organization/bench", "type": "organization"}},
+        "agent": {"meta": {"href": f"{MoyskladStub.base}/entity/counterparty/bench", "type": "counterparty"}},
+        "positions": [{"quantity": 1, "price": 10000, "assortment": {"meta": {"href": f"{MoyskladStub.base}/entity/product/bench", "type": "product"}}}],
+    }
+
+
+class Bench:
+    def __init__(self, args: argparse.Namespace):
+        from app import db
+        from app.utils import http_client
+
+        self.args = args
+        self.db = db
+        self.http_client = http_client
+        config = StubConfig(
+            latency=args.latency, jitter=args.jitter, error_rate=args.error_rate,
+            rate_limit_rate=args.rate_limit_rate, item_error_rate=args.item_error_rate, orders=args.orders,
+        )
+        self.ms = MoyskladStub(config, seed=args.seed)
+        self.wc = WooCommerceStub(config, seed=args.seed + 1)
+
+    def install_clients(self):
+        """Подменяет клиенты реестра http_client клиентами на заглушках (с теми же хуками метрик)."""
+        import httpx
+        from app.utils.rate_limit import MoyskladRateLimitedTransport, RedisTokenBucket, MS_RATE_LIMIT, MS_RATE_PERIOD
+
+        hc = self.http_client
+        ms_transport = self.ms.transport()
+        if self.args.ms_rate_limit:
+            ms_transport = MoyskladRateLimitedTransport(ms_transport, RedisTokenBucket(hc.MOYSKLAD, MS_RATE_LIMIT, MS_RATE_PERIOD))
+        hc._clients[hc.MOYSKLAD] = httpx.AsyncClient(transport=ms_transport, event_hooks=hc._latency_hooks(hc.MOYSKLAD))
+        hc._clients[hc.WOOCOMMERCE] = httpx.AsyncClient(transport=self.wc.transport(), event_hooks=hc._latency_hooks(hc.WOOCOMMERCE))
+
+    async def reset_db(self):
+        async with self.db.get_connection() as conn:
+            await conn.execute("TRUNCATE pending_sync, dead_letter_sync, order_state, sync_cursor, order_sync_ledger, catalog_snapshot")
+
+    def _db_queries(self) -> int:
+        return sum(stats[0] for stats in self.db.POOL_STATS.queries.values())
+
+    async def _drain(self):
+        from app.tasks.orders import get_order_batcher
+        from app.utils.woocommerce import get_wc_write_back_queue
+
+        await get_order_batcher().drain()
+        await get_wc_write_back_queue().drain()
+        await self.db.get_pending_writer().drain()
+
+    async def _measure(self, name: str, count: int, run) -> dict:
+        await self.reset_db()
+        self.ms.stats.requests.clear()
+        self.wc.stats.requests.clear()
+        queries_before = self._db_queries()
+        started = time.perf_counter()
+        latencies = await run()
+        await self._drain()
+        elapsed = time.perf_counter() - started
+        queries = self._db_queries() - queries_before
+        async with self.db.get_connection() as conn:
+            pending = await conn.fetchval("SELECT count(*) FROM pending_sync")
+        return {
+            "scenario": name,
+            "orders": count,
+            "seconds": round(elapsed, 3),
+            "orders_per_sec": round(count / elapsed, 1) if elapsed else 0.0,
+            "p50_ms": round(_percentile(latencies, 0.5) * 1000, 1) if latencies else None,
+            "p99_ms": round(_percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+            "db_queries": queries,
+            "db_queries_per_order": round(queries / count, 2) if count else 0.0,
+            "pending_after": pending,
+            "moysklad_requests": dict(self.ms.stats.requests),
+            "woocommerce_requests": dict(self.wc.stats.requests),
+        }
+
+    async def scenario_orders(self) -> dict:
+        """Новые заказы: _sync_order по каждому заказу с ограничением одновременности (как order_worker)."""
+        from app.tasks.orders import _sync_order
+
+        count = self.args.orders
+        semaphore = asyncio.Semaphore(self.args.concurrency)
+
+        async def one(order_id: int) -> float:
+            async with semaphore:
+                started = time.perf_counter()
+                await _sync_order(order_id, _order_payload(order_id))
+                return time.perf_counter() - started
+
+        async def run():
+            return list(await asyncio.gather(*(one(i + 1) for i in range(count))))
+
+        return await self._measure("orders", count, run)
+
+    async def scenario_retry(self) -> dict:
+        """Повтор отложенных заказов: pending_sync заполняется заранее, затем выполняется retry_pending_orders."""
+        from app.tasks.orders import retry_pending_orders_task
+
+        count = self.args.orders
+
+        async def run():
+            async with self.db.get_connection() as conn:
+                await conn.copy_records_to_table(
+                    "pending_sync",
+                    records=[(i + 1, json.dumps(_order_payload(i + 1)), 0, "bench") for i in range(count)],
+                    columns=["order_id", "order_payload", "retry_count", "error_message"],
+                )
+                await conn.execute("UPDATE pending_sync SET next_attempt_at = now()")
+            await retry_pending_orders_task.run()
+            return []
+
+        return await self._measure("retry", count, run)
+
+    async def scenario_status_from_ms(self) -> dict:
+        """Синхронизация статусов МойСклад -> WooCommerce по всем заказам выборки заглушки."""
+        from app.tasks.status_sync import sync_statuses_from_moysklad
+
+        async def run():
+            await sync_statuses_from_moysklad.run()
+            return []
+
+        return await self._measure("status_from_ms", self.args.orders, run)
+
+    async def scenario_status_to_ms(self) -> dict:
+        """Синхронизация статусов WooCommerce -> МойСклад по всем заказам выборки заглушки."""
+        from app.tasks.status_sync import sync_statuses_to_moysklad
+
+        async def run():
+            await sync_statuses_to_moysklad.run()
+            return []
+
+        return await self._measure("status_to_ms", self.args.orders, run)
+
+    async def scenario_catalog(self) -> dict:
+        """Остатки МойСклад -> WooCommerce: первая синхронизация всех SKU (--orders) и повторная после изменения 10% остатков."""
+        from app.tasks.catalog import sync_catalog_stock_task
+
+        async def run():
+            await sync_catalog_stock_task.run()
+            self.ms.stock_version += 1
+            await sync_catalog_stock_task.run()
+            return []
+
+        return await self._measure("catalog", self.args.orders, run)
+
+
+def _print_table(results: list[dict]):
+    columns = ["scenario", "orders", "seconds", "orders_per_sec", "p50_ms", "p99_ms", "db_queries_per_order", "pending_after"]
+    print("  ".join(f"{c:>20}" for c in columns))
+    for result in results:
+        print("  ".join(f"{str(result[c]):>20}" for c in columns))
+    for result in results:
+        print(f"\n[{result['scenario']}] Moysklad: {result['moysklad_requests']}")
+        print(f"[{result['scenario']}] WooCommerce: {result['woocommerce_requests']}")
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    async with disposable_postgres(args.database_url) as database_url:
+        _configure_env(args, database_url)
+        from app.db import init_db_pool, close_db_pool, run_migrations
+        from app.utils.http_client import close_http_clients
+
+        await init_db_pool()
+        await run_migrations()
+        bench = Bench(args)
+        bench.install_clients()
+        try:
+            scenarios = SCENARIOS if args.scenario == "all" else (args.scenario,)
+            results = [await getattr(bench, f"scenario_{name}")() for name in scenarios]
+        finally:
+            await close_http_clients()
+            await close_db_pool()
+
+    if args.json:
+        json.dump(results, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+    else:
+        _print_table(results)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,219 @@
+"""Заглушки API МойСклад и WooCommerce на httpx.MockTransport для офлайн бенчмарков.
+
+Эмулируют эндпоинты, которые использует приложение:
+МойСклад - POST/GET /entity/customerorder (одиночный и массив; GET учитывает filter=updated>= и order=updated,asc), GET /entity/customerorder/metadata, PUT /entity/customerorder/{id},
+GET /report/stock/all;
+WooCommerce - GET /orders (страницы, X-WP-TotalPages), PUT /orders/{id}, POST /orders/batch, GET /products?sku=, POST /products/batch.
+Задержка, доля ошибок 5xx и доля ответов 429 настраиваются через StubConfig.
+"""
+import asyncio
+import json
+import math
+import random
+import uuid
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta
+
+import httpx
+
+MS_STATES = ["Новый", "Подтверждён", "Отложен", "Выполнен", "Отменен"]
+WC_STATUSES = ["processing", "on-hold", "completed", "cancelled"]
+
+
+@dataclass
+class StubConfig:
+    latency: float = 0.05 # Средняя задержка ответа, сек.
+    jitter: float = 0.5 # Разброс задержки: latency * (1 +- jitter)
+    error_rate: float = 0.0 # Доля ответов 500
+    rate_limit_rate: float = 0.0 # Доля ответов 429
+    retry_after_ms: int = 200 # X-Lognex-Retry-TimeInterval / Retry-After для 429
+    item_error_rate: float = 0.0 # Доля элементов с ошибкой в пакетных ответах
+    orders: int = 1000 # Сколько заказов отдают выборки GET (и SKU - отчет об остатках)
+
+
+@dataclass
+class StubStats:
+    requests: dict[str, int] = field(default_factory=dict) # "METHOD endpoint" -> количество
+    errors: int = 0
+    rate_limited: int = 0
+
+    def count(self, key: str):
+        self.requests[key] = self.requests.get(key, 0) + 1
+
+
+class _Stub:
+    def __init__(self, config: StubConfig, seed: int = 0):
+        self.config = config
+        self.stats = StubStats()
+        self._random = random.Random(seed)
+
+    async def _delay(self):
+        if self.config.latency > 0:
+            spread = self.config.latency * self.config.jitter
+            await asyncio.sleep(max(0.0, self.config.latency + self._random.uniform(-spread, spread)))
+
+    def _failure(self) -> httpx.Response | None:
+        roll = self._random.random()
+        if roll < self.config.rate_limit_rate:
+            self.stats.rate_limited += 1
+            return httpx.Response(429, headers=self._retry_headers(), json={"errors": [{"error": "Rate limit exceeded", "code": 1049}]})
+        if roll < self.config.rate_limit_rate + self.config.error_rate:
+            self.stats.errors += 1
+            return httpx.Response(500, json={"errors": [{"error": "Internal server error"}]})
+        return None
+
+    def _retry_headers(self) -> dict[str, str]:
+        return {"Retry-After": str(max(1, self.config.retry_after_ms // 1000))}
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        await self._delay()
+        failure = self._failure()
+        if failure is not None:
+            return failure
+        return self.route(request)
+
+    def route(self, request: httpx.Request) -> httpx.Response:
+        raise NotImplementedError
+
+    def transport(self) -> httpx.MockTransport:
+        return httpx.MockTransport(self.handle)
+
+
+class MoyskladStub(_Stub):
+    """Заглушка МойСклад. Состояние заказов хранится в памяти, чтобы GET отдавал созданные и обновленные заказы."""
+
+    base = "https://ms.stub/api/remap/1.2"
+
+    def __init__(self, config: StubConfig, seed: int = 0):
+        super().__init__(config, seed)
+        self.state_hrefs = {name: f"{self.base}/entity/customerorder/metadata/states/{uuid.UUID(int=i + 1)}" for i, name in enumerate(MS_STATES)}
+        self._number = 0
+        self.created: dict[str, dict] = {} # externalCode -> созданный заказ
+        self._updated_from = datetime(2024, 1, 1)
+        self.stock_version = 0 # Увеличение меняет остатки каждого десятого SKU
+
+    def _stock_row(self, index: int) -> dict:
+        changed = self.stock_version if index % 10 == 0 else 0
+        return {
+            "meta": {"href": f"{self.base}/entity/product/{uuid.UUID(int=20_000_000 + index)}", "type": "product"},
+            "code": f"SKU-{index + 1}",
+            "stock": float((index * 7 + changed) % 50),
+            "reserve": 0.0,
+            "salePrice": float(10000 + index),
+        }
+
+    def _retry_headers(self) -> dict[str, str]:
+        return {"X-Lognex-Retry-TimeInterval": str(self.config.retry_after_ms), "X-RateLimit-Remaining": "0"}
+
+    def _created(self, payload: dict) -> dict:
+        if self._random.random() < self.config.item_error_rate:
+            return {"errors": [{"error": "Ошибка сохранения объекта", "code": 3000}]}
+        self._number += 1
+        order_id = str(uuid.uuid4())
+        order = {
+            "id": order_id,
+            "name": f"{self._number:05d}",
+            "externalCode": payload.get("externalCode", ""),
+            "meta": {"href": f"{self.base}/entity/customerorder/{order_id}", "type": "customerorder"},
+        }
+        self.created[order["externalCode"]] = order
+        return order
+
+    def _order_row(self, index: int) -> dict:
+        return {
+            "id": str(uuid.UUID(int=10_000_000 + index)),
+            "externalCode": str(index + 1),
+            "updated": (self._updated_from + timedelta(seconds=index)).strftime("%Y-%m-%d %H:%M:%S.000"),
+            "state": {"meta": {"href": self.state_hrefs[MS_STATES[index % len(MS_STATES)]]}},
+        }
+
+    def _first_order_index(self, filter_value: str) -> int:
+        """Индекс первого заказа выборки с учетом условия updated>= (заказы упорядочены по updated, шаг - 1 сек.)."""
+        start = 0
+        for part in filter_value.split(";"):
+            if part.startswith("updated>="):
+                since = datetime.strptime(part[len("updated>="):][:19], "%Y-%m-%d %H:%M:%S")
+                start = max(start, math.ceil((since - self._updated_from).total_seconds()))
+        return start
+
+    def route(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.split("/api/remap/1.2", 1)[-1]
+        if path == "/entity/customerorder/metadata":
+            self.stats.count("GET /entity/customerorder/metadata")
+            return httpx.Response(200, json={"states": [{"name": n, "meta": {"href": h}} for n, h in self.state_hrefs.items()]})
+        if path == "/entity/customerorder" and request.method == "POST":
+            body = json.loads(request.content)
+            if isinstance(body, list):
+                self.stats.count("POST /entity/customerorder [array]")
+                return httpx.Response(200, json=[self._created(p) for p in body])
+            self.stats.count("POST /entity/customerorder")
+            return httpx.Response(200, json=self._created(body))
+        if path == "/entity/customerorder" and request.method == "GET":
+            self.stats.count("GET /entity/customerorder")
+            filter_value = request.url.params.get("filter", "")
+            if filter_value.startswith("externalCode="):
+                # Поиск созданных заказов по externalCode (условия через ';' - по ИЛИ)
+                codes = [part.split("=", 1)[1] for part in filter_value.split(";")]
+                rows = [self.created[code] for code in codes if code in self.created]
+                return httpx.Response(200, json={"meta": {"size": len(rows)}, "rows": rows})
+            # Заказы уже упорядочены по updated (order=updated,asc); updated>= отсекает начало выборки
+            first = self._first_order_index(filter_value)
+            offset = int(request.url.params.get("offset", 0))
+            limit = int(request.url.params.get("limit", 1000))
+            rows = [self._order_row(i) for i in range(first + offset, min(first + offset + limit, self.config.orders))]
+            size = max(0, self.config.orders - first)
+            return httpx.Response(200, json={"meta": {"size": size, "limit": limit, "offset": offset}, "rows": rows})
+        if path == "/report/stock/all" and request.method == "GET":
+            self.stats.count("GET /report/stock/all")
+            offset = int(request.url.params.get("offset", 0))
+            limit = int(request.url.params.get("limit", 1000))
+            rows = [self._stock_row(i) for i in range(offset, min(offset + limit, self.config.orders))]
+            return httpx.Response(200, json={"meta": {"size": self.config.orders, "limit": limit, "offset": offset}, "rows": rows})
+        if path.startswith("/entity/customerorder/") and request.method == "PUT":
+            self.stats.count("PUT /entity/customerorder/{id}")
+            return httpx.Response(200, json={"id": path.rsplit("/", 1)[-1]})
+        return httpx.Response(404, json={"errors": [{"error": f"Unknown endpoint {request.method} {path}"}]})
+
+
+class WooCommerceStub(_Stub):
+    """Заглушка WooCommerce REST API v3."""
+
+    base = "https://wc.stub/wp-json/wc/v3"
+
+    def _order(self, index: int) -> dict:
+        return {
+            "id": index + 1,
+            "status": WC_STATUSES[index % len(WC_STATUSES)],
+            "date_modified_gmt": (datetime(2024, 1, 1) + timedelta(seconds=index)).strftime("%Y-%m-%dT%H:%M:%S"),
+            "meta_data": [{"key": "_moysklad_uuid", "value": str(uuid.UUID(int=10_000_000 + index))}],
+        }
+
+    def route(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.split("/wc/v3", 1)[-1]
+        if path == "/products" and request.method == "GET":
+            self.stats.count("GET /products")
+            skus = [sku for sku in request.url.params.get("sku", "").split(",") if sku.startswith("SKU-")]
+            return httpx.Response(200, json=[{"id": 100_000 + int(sku[4:]), "sku": sku, "parent_id": 0} for sku in skus])
+        if path in ("/orders/batch", "/products/batch") and request.method == "POST":
+            self.stats.count(f"POST {path}")
+            updates = json.loads(request.content).get("update", [])
+            result = []
+            for item in updates:
+                if self._random.random() < self.config.item_error_rate:
+                    result.append({"id": item["id"], "error": {"code": "woocommerce_rest_shop_order_invalid_id", "message": "Invalid ID."}})
+                else:
+                    result.append({"id": item["id"], **{k: v for k, v in item.items() if k != "id"}})
+            return httpx.Response(200, json={"update": result})
+        if path == "/orders" and request.method == "GET":
+            self.stats.count("GET /orders")
+            per_page = int(request.url.params.get("per_page", 10))
+            page = int(request.url.params.get("page", 1))
+            total = self.config.orders
+            start = (page - 1) * per_page
+            orders = [self._order(i) for i in range(start, min(start + per_page, total))]
+            total_pages = max(1, -(-total // per_page))
+            return httpx.Response(200, json=orders, headers={"X-WP-Total": str(total), "X-WP-TotalPages": str(total_pages)})
+        if path.startswith("/orders/") and request.method in ("PUT", "POST"):
+            self.stats.count("PUT /orders/{id}")
+            return httpx.Response(200, json={"id": int(path.rsplit("/", 1)[-1])})
+        return httpx.Response(404, json={"code": "rest_no_route", "message": f"No route {request.method} {path}"})